@@ -8,7 +8,7 @@ from firebase_admin import credentials, firestore
 import os
 import json
 import base64
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import threading
 import schedule
@@ -19,6 +19,10 @@ from common.admin_panel import admin_bp
 from products.artale.manual_routes import manual_bp
 from common.disclaimer_routes import disclaimer_bp
 from core.session_manager import session_manager, init_session_manager
+from core.session_store import FirestoreSessionStore
+from core.ttl_sweeper import ttl_sweeper, init_ttl_sweeper
+from core.invalidation_bus import init_invalidation_bus
+from core.activity_rollup import init_activity_rollup
 from core.route_handlers import RouteHandlers
 from core.gumroad_service import GumroadService  # 修復後的 Gumroad 服務
 from core.gumroad_routes import gumroad_bp, init_gumroad_routes  # 修復後的 Gumroad 路由
@@ -285,6 +289,19 @@ def init_services():
         init_session_manager(db)
         logger.info("✅ Session Manager 已初始化")
         
+        # 初始化跨 worker 緩存失效廣播
+        init_invalidation_bus(db)
+        logger.info("✅ Invalidation Bus 已初始化")
+        
+        # 初始化分鐘活動匯總
+        init_activity_rollup(db)
+        logger.info("✅ Activity Rollup 已初始化")
+        
+        # 初始化 TTL 清理器
+        init_ttl_sweeper(db)
+        register_ttl_targets()
+        logger.info("✅ TTL Sweeper 已初始化")
+        
         # 初始化 Gumroad 服務
         gumroad_service = GumroadService(db)
         logger.info("✅ Gumroad Service 已初始化")
@@ -307,13 +324,31 @@ def init_services():
         logger.error(f"❌ 服務初始化失敗: {str(e)}")
         raise
 
+def register_ttl_targets():
+    """註冊需要定期清理的集合"""
+    if isinstance(session_manager.store, FirestoreSessionStore):
+        ttl_sweeper.register('user_sessions', on_delete=session_manager.handle_swept_sessions)
+    ttl_sweeper.register('processed_webhooks')
+    ttl_sweeper.register('processed_sales')
+    ttl_sweeper.register(
+        'unauthorized_attempts', field='timestamp',
+        retention=timedelta(days=int(os.environ.get('UNAUTHORIZED_ATTEMPTS_RETENTION_DAYS', 30)))
+    )
+    ttl_sweeper.register('connection_test', field='timestamp', retention=timedelta(days=1))
+    ttl_sweeper.register('cache_invalidations')
+    ttl_sweeper.register('session_activity')
+    ttl_sweeper.register('unauthorized_attempt_windows')
+
 def cleanup_expired_sessions():
-    """定期清理過期會話"""
+    """定期清理過期會話及其他帶過期時間的集合"""
     try:
         if session_manager and firebase_initialized:
-            deleted_count = session_manager.cleanup_expired_sessions()
+            results = ttl_sweeper.run()
+            if not isinstance(session_manager.store, FirestoreSessionStore):
+                results['user_sessions'] = session_manager.cleanup_expired_sessions()
+            deleted_count = sum(results.values())
             if deleted_count > 0:
-                logger.info(f"🧹 定期清理：刪除了 {deleted_count} 個過期會話")
+                logger.info(f"🧹 定期清理：共刪除 {deleted_count} 個過期文檔 {results}")
     except Exception as e:
         logger.error(f"❌ 定期清理失敗: {str(e)}")
 
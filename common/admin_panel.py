@@ -10,6 +10,8 @@ import logging
 import re
 from firebase_admin import firestore
 
+from core.user_cache import new_user_version, publish_user_change, VERSION_FIELD
+
 logger = logging.getLogger(__name__)
 
 # 創建藍圖
@@ -2148,11 +2150,14 @@ def get_all_users():
             return jsonify({'success': False, 'error': 'Database not available'}), 503
             
         users_ref = db.collection('authorized_users')
-        users = users_ref.stream()
+        users = {user.id: user.to_dict() for user in users_ref.stream()}
+        
+        # 合併尚未寫入的登入次數
+        from core.login_records import login_records
+        login_records.overlay(users, db)
         
         user_list = []
-        for user in users:
-            user_data = user.to_dict()
+        for document_id, user_data in users.items():
             
             # 處理時間格式
             created_at = user_data.get('created_at')
@@ -2180,7 +2185,7 @@ def get_all_users():
                 payment_status = 'refunded'
             
             user_list.append({
-                'document_id': user.id,
+                'document_id': document_id,
                 'uuid_preview': uuid_preview,
                 'original_uuid': original_uuid,
                 'display_name': user_data.get('display_name', 'Unknown'),
@@ -2256,7 +2261,10 @@ def create_user_admin():
         if expires_at:
             user_data["expires_at"] = expires_at
         
+        version = new_user_version()
+        user_data[VERSION_FIELD] = version
         user_ref.set(user_data)
+        publish_user_change(uuid_hash, version)
         
         return jsonify({
             'success': True,
@@ -2295,7 +2303,6 @@ def update_user_admin(document_id):
         
         # 延長有效期
         if 'extend_days' in data:
-            from firebase_admin import firestore
             extend_days = data['extend_days']
             current_data = user_doc.to_dict()
             current_expires = current_data.get('expires_at')
@@ -2320,7 +2327,6 @@ def update_user_admin(document_id):
             expires_at = data['expires_at']
             if expires_at is None or expires_at == '':
                 # 設為永久
-                from firebase_admin import firestore
                 update_data['expires_at'] = firestore.DELETE_FIELD
             else:
                 # 設定具體的到期時間
@@ -2342,7 +2348,10 @@ def update_user_admin(document_id):
         update_data['updated_at'] = datetime.now()
         update_data['updated_by'] = 'admin_dashboard'
         
+        version = new_user_version()
+        update_data[VERSION_FIELD] = version
         user_ref.update(update_data)
+        publish_user_change(document_id, version)
         
         return jsonify({
             'success': True,
@@ -2371,11 +2380,14 @@ def toggle_user_status(document_id):
         if not user_ref.get().exists:
             return jsonify({'success': False, 'error': '用戶不存在'}), 404
         
+        version = new_user_version()
         user_ref.update({
             'active': new_status,
             'status_changed_at': datetime.now(),
-            'status_changed_by': 'admin_dashboard'
+            'status_changed_by': 'admin_dashboard',
+            VERSION_FIELD: version
         })
+        publish_user_change(document_id, version)
         
         return jsonify({
             'success': True,
@@ -2403,6 +2415,10 @@ def delete_user_admin(document_id):
         
         # 刪除用戶
         user_ref.delete()
+        # 文檔已刪除，新版本號只作為失效下限，攔截刪除前發出的讀取
+        publish_user_change(document_id, new_user_version())
+        from core.login_records import login_records
+        login_records.discard(document_id, db)
         
         return jsonify({
             'success': True,
@@ -2682,38 +2698,26 @@ def optimize_database():
         if db is None:
             return jsonify({'success': False, 'error': 'Database not available'}), 503
         
-        # 執行數據庫優化操作
-        # 1. 清理過期的 session 記錄
-        cutoff_date = datetime.now() - timedelta(days=7)
-        old_sessions = db.collection('user_sessions')\
-                        .where('expires_at', '<', cutoff_date)\
-                        .limit(100)\
-                        .stream()
-        
-        session_deleted = 0
-        for session in old_sessions:
-            session.reference.delete()
-            session_deleted += 1
+        # 執行數據庫優化操作：分頁批量清理所有已註冊的過期集合
+        from core.ttl_sweeper import ttl_sweeper
+        if ttl_sweeper.db is None:
+            ttl_sweeper.set_db(db)
         
-        # 2. 清理過期的 webhook 記錄
-        old_webhooks = db.collection('processed_webhooks')\
-                        .where('expires_at', '<', cutoff_date)\
-                        .limit(100)\
-                        .stream()
+        results = ttl_sweeper.run()
+        session_deleted = results.get('user_sessions', 0)
+        webhook_deleted = results.get('processed_webhooks', 0)
+        total_deleted = sum(results.values())
         
-        webhook_deleted = 0
-        for webhook in old_webhooks:
-            webhook.reference.delete()
-            webhook_deleted += 1
-        
-        logger.info(f"數據庫優化完成: 清理了 {session_deleted} 個過期 session, {webhook_deleted} 個過期 webhook")
+        logger.info(f"數據庫優化完成: 清理了 {session_deleted} 個過期 session, {webhook_deleted} 個過期 webhook, 共 {total_deleted} 個過期記錄")
         
         return jsonify({
             'success': True,
-            'message': f'數據庫優化完成，清理了 {session_deleted + webhook_deleted} 個過期記錄',
+            'message': f'數據庫優化完成，清理了 {total_deleted} 個過期記錄',
             'details': {
                 'sessions_deleted': session_deleted,
-                'webhooks_deleted': webhook_deleted
+                'webhooks_deleted': webhook_deleted,
+                'by_collection': results,
+                'sweeper': ttl_sweeper.get_stats()
             }
         })
         
@@ -2748,12 +2752,15 @@ def bulk_cleanup():
                 
                 # 如果已過期且仍然啟用，則停用
                 if expires_at < now and user_data.get('active', False):
+                    version = new_user_version()
                     user_doc.reference.update({
                         'active': False,
                         'deactivated_at': now,
                         'deactivation_reason': 'Bulk cleanup - expired',
-                        'deactivated_by': 'admin_bulk_cleanup'
+                        'deactivated_by': 'admin_bulk_cleanup',
+                        VERSION_FIELD: version
                     })
+                    publish_user_change(user_doc.id, version)
                     processed_count += 1
         
         logger.info(f"批量清理完成: 處理了 {processed_count} 個過期用戶")
@@ -2861,53 +2868,33 @@ def get_online_users():
         if db is None:
             return jsonify({'success': False, 'error': 'Database not available'}), 503
         
-        # 獲取最近 5 分鐘內活動的用戶 session
-        from datetime import datetime, timedelta
-        cutoff_time = datetime.now() - timedelta(minutes=5)
-        
-        # 查詢活躍的 session
-        sessions_ref = db.collection('user_sessions')
-        active_sessions = sessions_ref.where('last_activity', '>=', cutoff_time).stream()
+        # 獲取最近 5 分鐘內有活動的用戶（讀取分鐘活動匯總，不查詢 user_sessions）
+        from core.activity_rollup import activity_rollup
+        recent = activity_rollup.recent_users(minutes=5)
+        
+        # 簽名令牌驗證時不讀 session 記錄，匯總中沒有 IP，按 session ID 補讀
+        from core.session_manager import session_manager
+        if session_manager.store.is_ready():
+            for activity in recent.values():
+                if activity['session_id'] and not activity['ip_address']:
+                    try:
+                        session_data = session_manager.store.get(activity['session_id'])
+                    except Exception as e:
+                        logger.warning(f"無法讀取 session 資訊: {str(e)}")
+                        continue
+                    if session_data:
+                        activity['ip_address'] = session_data.get('client_ip')
+        
+        # 批量讀取用戶資料以取得原始序號和顯示名稱
+        from core.user_projection import get_users_fields
+        user_docs = get_users_fields(db, recent, ('original_uuid', 'display_name'))
         
         online_users = []
         
-        for session in active_sessions:
-            session_data = session.to_dict()
-
-            # 調試：查看 session 數據結構
-            if len(online_users) == 0:  # 只打印第一個
-                logger.info(f"Session 數據: {session_data}")
-                logger.info(f"Session 欄位: {list(session_data.keys())}")            
-            
-            # 處理最後活動時間
-            last_activity = session_data.get('last_activity')
-            if hasattr(last_activity, 'isoformat'):
-                last_activity_str = last_activity.isoformat()
-            else:
-                last_activity_str = str(last_activity)
-            
-            # 從 session 獲取 user_uuid（可能的欄位名稱）
-            user_uuid = (session_data.get('user_uuid') or 
-                        session_data.get('uuid') or 
-                        session_data.get('user_id') or 
-                        'Unknown')
-            
-            display_name = 'Unknown User'
-            
-            # 嘗試從用戶表獲取正確的顯示名稱
-            if user_uuid != 'Unknown':
-                import hashlib
-                try:
-                    # 嘗試通過 UUID hash 查找用戶
-                    uuid_hash = hashlib.sha256(user_uuid.encode()).hexdigest()
-                    user_ref = db.collection('authorized_users').document(uuid_hash)
-                    user_doc = user_ref.get()
-                    
-                    if user_doc.exists:
-                        user_data = user_doc.to_dict()
-                        display_name = user_data.get('display_name', 'Unknown User')
-                except Exception as e:
-                    logger.warning(f"無法查找用戶資訊: {str(e)}")
+        for uuid_hash, activity in recent.items():
+            user_data = user_docs.get(uuid_hash, {})
+            user_uuid = user_data.get('original_uuid', 'Unknown')
+            display_name = user_data.get('display_name', 'Unknown User')
             
             # 生成簡短的 UUID 預覽
             uuid_preview = user_uuid[:8] + '...' if len(user_uuid) > 8 else user_uuid
@@ -2916,9 +2903,9 @@ def get_online_users():
                 'user_uuid': user_uuid,
                 'uuid_preview': uuid_preview,
                 'display_name': display_name,
-                'last_activity': last_activity_str,
-                'session_id': session.id,
-                'ip_address': session_data.get('ip_address', 'Unknown')
+                'last_activity': activity['last_activity'].isoformat(),
+                'session_id': activity['session_id'],
+                'ip_address': activity['ip_address'] or 'Unknown'
             }
             
             online_users.append(online_user)
@@ -2945,6 +2932,52 @@ def get_online_users():
         logger.error(f"Get online users error: {str(e)}")
         return jsonify({'success': False, 'error': 'Internal server error'}), 500
 
+@admin_bp.route('/unauthorized-attempts', methods=['GET'])
+def get_unauthorized_attempts():
+    """按 IP 匯總的未授權嘗試（讀取分鐘窗口匯總）"""
+    if not check_admin_token(request):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+
+    try:
+        from app import db
+        if db is None:
+            return jsonify({'success': False, 'error': 'Database not available'}), 503
+
+        from core.unauthorized_attempts import unauthorized_attempts
+        if unauthorized_attempts.db is None:
+            unauthorized_attempts.set_db(db)
+
+        minutes = min(max(request.args.get('minutes', 60, type=int), 1), 7 * 24 * 60)
+        client_ip = request.args.get('ip')
+
+        def epoch_iso(value):
+            return datetime.fromtimestamp(value).isoformat() if value else None
+
+        if client_ip:
+            # 單個 IP：返回各分鐘窗口
+            windows = unauthorized_attempts.recent_windows(minutes, client_ip=client_ip)
+            for window in windows:
+                window['minute'] = window['minute'].isoformat() if window['minute'] else None
+                window['first_seen'] = epoch_iso(window['first_seen'])
+                window['last_seen'] = epoch_iso(window['last_seen'])
+            return jsonify({'success': True, 'client_ip': client_ip, 'minutes': minutes, 'windows': windows})
+
+        attackers = unauthorized_attempts.attacks_by_ip(minutes, min_count=request.args.get('min_count', 1, type=int))
+        for attacker in attackers:
+            attacker['first_seen'] = epoch_iso(attacker['first_seen'])
+            attacker['last_seen'] = epoch_iso(attacker['last_seen'])
+
+        return jsonify({
+            'success': True,
+            'minutes': minutes,
+            'attackers': attackers,
+            'total_attempts': sum(attacker['attempts'] for attacker in attackers)
+        })
+
+    except Exception as e:
+        logger.error(f"Get unauthorized attempts error: {str(e)}")
+        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+
 @admin_bp.route('/users/<document_id>', methods=['GET'])
 def get_user_details(document_id):
     """獲取單個用戶的詳細資訊"""
@@ -2964,6 +2997,10 @@ def get_user_details(document_id):
         
         user_data = user_doc.to_dict()
         
+        # 合併尚未寫入的登入記錄
+        from core.login_records import login_records
+        login_records.overlay({document_id: user_data}, db)
+        
         # 處理時間格式
         created_at = user_data.get('created_at')
         if hasattr(created_at, 'strftime'):
@@ -2971,6 +3008,8 @@ def get_user_details(document_id):
         else:
             created_at_str = str(created_at)[:16] if created_at else 'Unknown'
         
+        last_login = user_data.get('last_login')
+        
         expires_at = user_data.get('expires_at')
         expires_at_str = None
         if expires_at:
@@ -2985,6 +3024,8 @@ def get_user_details(document_id):
             'active': user_data.get('active', False),
             'expires_at': expires_at_str,
             'login_count': user_data.get('login_count', 0),
+            'last_login': last_login.isoformat() if hasattr(last_login, 'isoformat') else last_login,
+            'last_login_ip': user_data.get('last_login_ip'),
             'created_at': created_at_str,
             'notes': user_data.get('notes', ''),
             'payment_status': user_data.get('payment_status', '手動創建'),
@@ -0,0 +1,201 @@
+"""
+activity_rollup.py - 按分鐘匯總的用戶活動記錄（取代每次驗證都改寫 last_activity）
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from firebase_admin import firestore
+
+from core.shutdown import register_shutdown_hook
+
+logger = logging.getLogger(__name__)
+
+
+def _minute_key(epoch_minute: int) -> str:
+    return datetime.fromtimestamp(epoch_minute * 60, tz=timezone.utc).strftime('%Y%m%d%H%M')
+
+
+class ActivityRollup:
+    """分鐘級活動匯總
+
+    驗證時只在本地當前分鐘的桶中記下 uuid_hash 及其最近使用的 session 與 IP，不做 I/O。
+    每個刷新間隔把各分鐘的用戶以 ArrayUnion、session 與 IP 以按 uuid_hash 的 map 合併寫入
+    session_activity/{YYYYMMDDHHMM}，多個 worker 寫同一分鐘文檔會自動合併。
+    寫入量只與時間成正比，與請求量無關。
+    """
+
+    def __init__(self, collection_name: str = 'session_activity', flush_interval: int = 60,
+                 retention_days: int = 7):
+        self.db = None
+        self.collection_name = collection_name
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+
+        self._buckets = {}  # epoch 分鐘 -> {uuid_hash: (session_id, client_ip)}
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.recorded = 0
+        self.flush_count = 0
+        self.docs_written = 0
+        self.failed = 0
+
+        register_shutdown_hook(self.stop, name='activity-rollup')
+
+    def set_db(self, db):
+        """設置 Firestore 數據庫實例並啟動刷新線程"""
+        self.db = db
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(self.flush_interval):
+                self.flush()
+
+        self._thread = threading.Thread(target=run, name='activity-rollup', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止刷新線程並寫入剩餘數據"""
+        self._stop.set()
+        self.flush()
+
+    def record(self, uuid_hash: str, session_id: Optional[str] = None, client_ip: Optional[str] = None,
+               now: Optional[float] = None):
+        """記錄一次活動，同一分鐘內保留該用戶最近一次的 session 與 IP"""
+        if not uuid_hash:
+            return
+        minute = int((now or time.time()) // 60)
+        with self.lock:
+            bucket = self._buckets.setdefault(minute, {})
+            previous = bucket.get(uuid_hash, (None, None))
+            bucket[uuid_hash] = (session_id or previous[0], client_ip or previous[1])
+            self.recorded += 1
+
+    def flush(self) -> int:
+        """寫入所有本地分鐘桶，返回寫入的文檔數"""
+        if self.db is None:
+            return 0
+
+        with self._flush_lock:
+            with self.lock:
+                buckets = self._buckets
+                self._buckets = {}
+
+            if not buckets:
+                return 0
+
+            written = 0
+            try:
+                batch = self.db.batch()
+                for minute, users in buckets.items():
+                    minute_at = datetime.fromtimestamp(minute * 60, tz=timezone.utc)
+                    fields = {
+                        'minute': minute_at,
+                        'users': firestore.ArrayUnion(sorted(users)),
+                        'expires_at': minute_at + timedelta(days=self.retention_days)
+                    }
+                    # 只寫入有值的欄位，避免覆蓋其他 worker 在同一分鐘寫入的值
+                    sessions = {}
+                    for uuid_hash, (session_id, client_ip) in users.items():
+                        info = {name: value for name, value in (('session_id', session_id),
+                                                                ('ip_address', client_ip)) if value}
+                        if info:
+                            sessions[uuid_hash] = info
+                    if sessions:
+                        fields['sessions'] = sessions
+                    batch.set(self.db.collection(self.collection_name).document(_minute_key(minute)),
+                              fields, merge=True)
+                    written += 1
+                batch.commit()
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ 寫入活動匯總失敗: {str(e)}")
+                with self.lock:
+                    for minute, users in buckets.items():
+                        bucket = self._buckets.setdefault(minute, {})
+                        for uuid_hash, info in users.items():
+                            bucket.setdefault(uuid_hash, info)
+                return 0
+
+            self.flush_count += 1
+            self.docs_written += written
+            return written
+
+    def recent_users(self, minutes: int = 5) -> Dict[str, Dict]:
+        """最近幾分鐘內有活動的用戶
+
+        返回 uuid_hash -> {'last_activity': 最後活動的分鐘, 'session_id', 'ip_address'}，
+        session 與 IP 取最後活動分鐘內記錄的值（沒有記錄時為 None）。
+        讀取對應的分鐘匯總文檔，並合併本地尚未寫入的桶。
+        """
+        current = int(time.time() // 60)
+        wanted = range(current - minutes + 1, current + 1)
+        last_seen = {}
+
+        def mark(minute, users, sessions):
+            minute_at = datetime.fromtimestamp(minute * 60, tz=timezone.utc)
+            for uuid_hash in users:
+                entry = last_seen.get(uuid_hash)
+                if entry is not None and entry['last_activity'] > minute_at:
+                    continue
+                info = sessions.get(uuid_hash) or {}
+                if entry is None or entry['last_activity'] < minute_at:
+                    entry = last_seen[uuid_hash] = {
+                        'last_activity': minute_at, 'session_id': None, 'ip_address': None
+                    }
+                entry['session_id'] = info.get('session_id') or entry['session_id']
+                entry['ip_address'] = info.get('ip_address') or entry['ip_address']
+
+        if self.db is not None:
+            refs = [self.db.collection(self.collection_name).document(_minute_key(m)) for m in wanted]
+            for doc in self.db.get_all(refs):
+                if doc.exists:
+                    data = doc.to_dict()
+                    minute_at = data.get('minute')
+                    minute = int(minute_at.timestamp() // 60) if minute_at else current
+                    mark(minute, data.get('users') or [], data.get('sessions') or {})
+
+        with self.lock:
+            local = {m: dict(users) for m, users in self._buckets.items() if m in wanted}
+        for minute, users in local.items():
+            mark(minute, users, {uuid_hash: {'session_id': session_id, 'ip_address': client_ip}
+                                 for uuid_hash, (session_id, client_ip) in users.items()})
+
+        return last_seen
+
+    def get_stats(self) -> Dict:
+        """獲取匯總統計"""
+        with self.lock:
+            pending_minutes = len(self._buckets)
+            pending_users = sum(len(users) for users in self._buckets.values())
+        return {
+            'flush_interval': self.flush_interval,
+            'recorded': self.recorded,
+            'pending_minutes': pending_minutes,
+            'pending_users': pending_users,
+            'flush_count': self.flush_count,
+            'docs_written': self.docs_written,
+            'failed': self.failed
+        }
+
+
+# 全局活動匯總實例
+activity_rollup = ActivityRollup(
+    flush_interval=int(os.environ.get('ACTIVITY_ROLLUP_FLUSH_INTERVAL', 60)),
+    retention_days=int(os.environ.get('ACTIVITY_ROLLUP_RETENTION_DAYS', 7))
+)
+
+
+def init_activity_rollup(db):
+    """初始化活動匯總"""
+    activity_rollup.set_db(db)
+    return activity_rollup
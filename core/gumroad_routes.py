@@ -5,15 +5,19 @@ from flask import Blueprint, request, jsonify, redirect, render_template_string
 import logging
 import json
 import os
-import time
 import requests
 from datetime import datetime, timedelta
 
+from core.rate_limiter import rate_limiter, RateLimitPolicy
+
 logger = logging.getLogger(__name__)
 
 # 創建藍圖
 gumroad_bp = Blueprint('gumroad', __name__, url_prefix='/gumroad')
 
+# Webhook 速率限制：5分鐘內最多10個請求
+WEBHOOK_RATE_LIMIT_POLICY = RateLimitPolicy(max_requests=10, time_window=300)
+
 # 添加這個安全檢查類
 class SimpleWebhookSecurity:
     def __init__(self, db, access_token):
@@ -22,7 +26,6 @@ class SimpleWebhookSecurity:
         self.webhook_token = os.environ.get('WEBHOOK_SECRET_TOKEN')
         self.enable_security = os.environ.get('ENABLE_WEBHOOK_SECURITY', 'false').lower() == 'true'
         self.enable_sale_verification = os.environ.get('ENABLE_SALE_VERIFICATION', 'false').lower() == 'true'
-        self.rate_limit_cache = {}
         
         logger.info(f"🔒 安全設置: Security={self.enable_security}, Verification={self.enable_sale_verification}")
     
@@ -38,26 +41,12 @@ class SimpleWebhookSecurity:
         return True, "Token OK"
     
     def check_rate_limit(self, client_ip):
-        """簡單速率限制"""
+        """簡單速率限制（5分鐘內最多10個請求，計數與所有 worker 共享）"""
         if not self.enable_security:
             return True
         
-        now = time.time()
-        
-        # 清理過期記錄
-        if client_ip not in self.rate_limit_cache:
-            self.rate_limit_cache[client_ip] = []
-        
-        # 保留最近5分鐘的請求
-        self.rate_limit_cache[client_ip] = [t for t in self.rate_limit_cache[client_ip] if t > now - 300]
-        
-        # 檢查是否超過限制（5分鐘內最多10個請求）
-        if len(self.rate_limit_cache[client_ip]) > 10:
-            return False
-        
-        # 記錄這次請求
-        self.rate_limit_cache[client_ip].append(now)
-        return True
+        allowed, _, _ = rate_limiter.check('gumroad_webhook', client_ip, WEBHOOK_RATE_LIMIT_POLICY)
+        return allowed
     
     def verify_sale(self, sale_data):
         """通過 API 驗證銷售真實性"""
@@ -236,6 +225,9 @@ class GumroadRoutes:
             if result['success']:
                 logger.info(f"✅ Webhook 處理成功")
                 return jsonify({'status': 'success'}), 200
+            elif result.get('retry'):
+                # 非 2xx 響應會讓 Gumroad 重新投遞
+                return jsonify({'error': result['error']}), 503
             else:
                 logger.error(f"❌ 處理失敗: {result['error']}")
                 return jsonify({'error': result['error']}), 400
@@ -14,12 +14,16 @@ from email.mime.multipart import MIMEMultipart
 import json
 import asyncio
 import threading
-from concurrent.futures import ThreadPoolExecutor
 import time
 from typing import Dict, List, Optional, Tuple
 import weakref
 from functools import lru_cache
 
+from core.ttl_sweeper import ttl_sweeper
+from core.job_executor import job_executor, QUEUE_WEBHOOKS, QUEUE_MAINTENANCE
+from core.ttl_cache import TTLCache
+from core.user_cache import new_user_version, publish_user_change, VERSION_FIELD
+
 logger = logging.getLogger(__name__)
 
 class GumroadService:
@@ -31,8 +35,7 @@ class GumroadService:
         self.base_url = 'https://api.gumroad.com/v2'
         self.webhook_secret = os.environ.get('GUMROAD_WEBHOOK_SECRET')
         
-        # 並發處理
-        self.executor = ThreadPoolExecutor(max_workers=5)
+        # 並發處理（webhook 在共用任務執行器的 webhooks 隊列中執行）
         self.processing_lock = threading.RLock()
         self.duplicate_checks = {}  # 使用 WeakValueDictionary 防止記憶體洩露
         self.rate_limiter = RateLimiter(max_requests=100, time_window=3600)
@@ -40,9 +43,10 @@ class GumroadService:
         # 退款處理
         self.refund_handlers = []
         
-        # 緩存管理
+        # 產品信息緩存：過期後 5 分鐘內先返回舊值並後台刷新
         self.cache_timeout = 300  # 5分鐘
-        self.last_cleanup = time.time()
+        self._product_cache = TTLCache(max_size=100, ttl=self.cache_timeout,
+                                       stale_while_revalidate=self.cache_timeout, name='gumroad-products')
         
         if not self.access_token:
             logger.warning("⚠️ GUMROAD_ACCESS_TOKEN 未設定")
@@ -50,19 +54,13 @@ class GumroadService:
             logger.info("✅ Gumroad 服務已初始化")
             self._delayed_setup_webhooks()
     
-    def __del__(self):
-        """清理資源"""
-        if hasattr(self, 'executor'):
-            self.executor.shutdown(wait=True)
-    
     def _delayed_setup_webhooks(self):
         """延遲設置 webhooks"""
         def setup_later():
             time.sleep(5)
             self.setup_webhooks()
         
-        thread = threading.Thread(target=setup_later, daemon=True)
-        thread.start()
+        job_executor.submit(QUEUE_MAINTENANCE, setup_later)
     
     @lru_cache(maxsize=1)
     def get_service_plans(self):
@@ -262,29 +260,17 @@ class GumroadService:
                 }
     
     def _get_product_info_cached(self, product_id):
-        """獲取產品信息 - 帶緩存"""
-        cache_key = f"product_{product_id}"
-        cached = getattr(self, '_product_cache', {}).get(cache_key)
-        
-        if cached and time.time() - cached['timestamp'] < self.cache_timeout:
-            return cached['data']
-        
-        # 從 API 獲取
-        product_info = self._get_product_info(product_id)
-        
-        # 更新緩存
-        if not hasattr(self, '_product_cache'):
-            self._product_cache = {}
+        """獲取產品信息 - 帶緩存（獲取失敗不緩存，後台刷新失敗時保留舊值）"""
+        def load():
+            product_info = self._get_product_info(product_id)
+            if product_info is None:
+                raise LookupError(f"無法獲取產品 {product_id}")
+            return product_info
         
-        self._product_cache[cache_key] = {
-            'data': product_info,
-            'timestamp': time.time()
-        }
-        
-        # 定期清理緩存
-        self._cleanup_cache()
-        
-        return product_info
+        try:
+            return self._product_cache.get_or_load(product_id, load)
+        except LookupError:
+            return None
     
     def _get_product_info(self, product_id):
         """獲取產品信息"""
@@ -305,26 +291,6 @@ class GumroadService:
             logger.error(f"獲取產品信息錯誤: {str(e)}")
             return None
     
-    def _cleanup_cache(self):
-        """清理過期緩存"""
-        if time.time() - self.last_cleanup < 300:  # 5分鐘清理一次
-            return
-        
-        if hasattr(self, '_product_cache'):
-            current_time = time.time()
-            expired_keys = [
-                key for key, value in self._product_cache.items()
-                if current_time - value['timestamp'] > self.cache_timeout
-            ]
-            
-            for key in expired_keys:
-                del self._product_cache[key]
-            
-            if expired_keys:
-                logger.debug(f"清理了 {len(expired_keys)} 個過期緩存項目")
-        
-        self.last_cleanup = time.time()
-    
     def create_payment_record(self, plan_id, plan, user_info):
         """創建付款記錄 - 防止重複"""
         try:
@@ -388,8 +354,11 @@ class GumroadService:
     
     def process_webhook(self, webhook_data):
         """處理 Gumroad webhook - 支援並發和退款"""
-        # 使用異步處理防止阻塞
-        future = self.executor.submit(self._process_webhook_async, webhook_data)
+        # 在有界隊列中處理，隊列已滿時讓 Gumroad 稍後重試
+        future = job_executor.submit(QUEUE_WEBHOOKS, self._process_webhook_async, webhook_data)
+        if future is None:
+            logger.warning("Webhook 處理隊列已滿，要求稍後重試")
+            return {'success': False, 'error': 'Server busy', 'retry': True}
         
         try:
             # 等待最多 30 秒
@@ -603,12 +572,15 @@ class GumroadService:
                 return False
             
             # 更新用戶狀態
+            version = new_user_version()
             user_ref.update({
                 'active': False,
                 'deactivated_at': datetime.now(),
                 'deactivation_reason': reason,
-                'deactivated_by': 'gumroad_refund_system'
+                'deactivated_by': 'gumroad_refund_system',
+                VERSION_FIELD: version
             })
+            publish_user_change(uuid_hash, version)
             
             logger.info(f"用戶帳號已停用: {user_uuid} - {reason}")
             return True
@@ -800,7 +772,10 @@ Scrilab 技術團隊
             if expires_at:
                 user_data["expires_at"] = expires_at
             
+            version = new_user_version()
+            user_data[VERSION_FIELD] = version
             self.db.collection('authorized_users').document(uuid_hash).set(user_data)
+            publish_user_change(uuid_hash, version)
             
             # 更新付款記錄
             self.db.collection('payment_records').document(payment_id).update({
@@ -976,28 +951,14 @@ Scrilab 技術團隊
             }
     
     def cleanup_old_webhooks(self):
-        """清理舊的 webhook 記錄"""
+        """清理過期的 webhook 記錄（由 TTL 清理器分頁批量刪除）"""
         try:
-            cutoff_date = datetime.now() - timedelta(days=30)
-            
-            # 查詢並刪除過期的 webhook 記錄
-            old_webhooks = self.db.collection('processed_webhooks')\
-                              .where('expires_at', '<', cutoff_date)\
-                              .limit(100)\
-                              .stream()
-            
-            deleted_count = 0
-            for webhook_doc in old_webhooks:
-                try:
-                    webhook_doc.reference.delete()
-                    deleted_count += 1
-                except Exception as e:
-                    logger.warning(f"刪除舊 webhook 記錄失敗: {e}")
-            
-            if deleted_count > 0:
-                logger.info(f"🧹 清理了 {deleted_count} 個舊 webhook 記錄")
+            if ttl_sweeper.db is None:
+                ttl_sweeper.set_db(self.db)
+            if 'processed_webhooks' not in ttl_sweeper.targets:
+                ttl_sweeper.register('processed_webhooks')
             
-            return deleted_count
+            return ttl_sweeper.sweep('processed_webhooks')
             
         except Exception as e:
             logger.error(f"清理舊 webhook 記錄失敗: {str(e)}")
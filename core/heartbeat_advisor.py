@@ -0,0 +1,131 @@
+"""
+heartbeat_advisor.py - 根據服務負載計算客戶端下次驗證間隔（/auth/validate 響應中的 next_check_after）
+"""
+import logging
+import math
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+from core.memory_monitor import memory_monitor
+
+logger = logging.getLogger(__name__)
+
+# 錯誤率至少基於這麼多請求才計入，避免低流量時單個錯誤造成大幅退避
+MIN_REQUESTS_FOR_ERROR_RATE = 20
+# 記憶體使用超過此百分比開始退避，每多 10% 間隔翻倍
+MEMORY_PRESSURE_PERCENT = 80
+
+
+class HeartbeatAdvisor:
+    """心跳間隔建議器
+
+    統計本 worker 最近 window 秒內的驗證請求數與 5xx 比例：
+      間隔 = base_interval × max(1, 請求速率 / target_rps) × (1 + 4 × 錯誤率) × 記憶體因子
+    實際返回的退避倍數在 [1, 因子] 間隨機，並加上 ±jitter 的抖動避免客戶端同步，
+    再限制在 [min_interval, max_interval]。
+    提供帳號剩餘有效時間時，間隔不超過剩餘時間（向上取整到秒，不受 min_interval、退避與抖動影響），
+    下次驗證最晚在到期後 1 秒內發生。5xx 響應不知道帳號信息，不提供這個保證。
+    """
+
+    def __init__(self, base_interval: int = 60, min_interval: int = 15, max_interval: int = 600,
+                 target_rps: float = 20.0, window: int = 60, jitter: float = 0.1,
+                 memory_signal: bool = True):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.target_rps = target_rps
+        self.window = window
+        self.jitter = jitter
+        self.memory_signal = memory_signal
+
+        self._buckets = {}  # epoch 秒 -> [請求數, 錯誤數]
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+
+        self.hints_issued = 0
+        self.last_interval = None
+
+    def record(self, status_code: Optional[int] = None, now: Optional[float] = None):
+        """記錄一次驗證請求，5xx 計為錯誤"""
+        now = time.time() if now is None else now
+        second = int(now)
+        with self.lock:
+            bucket = self._buckets.get(second)
+            if bucket is None:
+                bucket = self._buckets[second] = [0, 0]
+                cutoff = second - self.window
+                for stale in [s for s in self._buckets if s <= cutoff]:
+                    del self._buckets[stale]
+            bucket[0] += 1
+            if status_code is not None and status_code >= 500:
+                bucket[1] += 1
+
+    def load_signals(self, now: Optional[float] = None) -> Dict:
+        """當前負載信號：請求速率、錯誤率、記憶體使用"""
+        now = time.time() if now is None else now
+        cutoff = int(now) - self.window
+        with self.lock:
+            requests = errors = 0
+            for second, (count, failed) in self._buckets.items():
+                if second > cutoff:
+                    requests += count
+                    errors += failed
+
+        # 啟動不足一個窗口時按實際經過的時間計算
+        span = max(1.0, min(self.window, now - self.started_at))
+        return {
+            'request_rate': requests / span,
+            'error_rate': errors / requests if requests >= MIN_REQUESTS_FOR_ERROR_RATE else 0.0,
+            'memory_percent': memory_monitor.percent if self.memory_signal else None
+        }
+
+    def next_check_after(self, expires_in: Optional[float] = None, now: Optional[float] = None) -> int:
+        """建議的下次驗證間隔（秒）；expires_in 為帳號剩餘有效秒數"""
+        signals = self.load_signals(now)
+
+        factor = max(1.0, signals['request_rate'] / self.target_rps) if self.target_rps else 1.0
+        factor *= 1 + 4 * signals['error_rate']
+        memory_percent = signals['memory_percent']
+        if memory_percent is not None and memory_percent > MEMORY_PRESSURE_PERCENT:
+            factor *= 2 ** ((memory_percent - MEMORY_PRESSURE_PERCENT) / 10)
+
+        # 退避部分在 [1, factor] 內均勻分佈，把同一時刻被退避的客戶端分散開，避免下一輪再次同時到達
+        spread = 1 + (factor - 1) * random.random()
+        interval = self.base_interval * spread * random.uniform(1 - self.jitter, 1 + self.jitter)
+        interval = min(max(interval, self.min_interval), self.max_interval)
+
+        interval = int(math.ceil(interval))
+
+        # 臨近到期的帳號不受負載退避影響，下次驗證不晚於到期後的第一個整秒
+        if expires_in is not None:
+            interval = min(interval, max(1, int(math.ceil(expires_in))))
+        self.hints_issued += 1
+        self.last_interval = interval
+        return interval
+
+    def get_stats(self) -> Dict:
+        """獲取建議器統計"""
+        signals = self.load_signals()
+        return {
+            'base_interval': self.base_interval,
+            'min_interval': self.min_interval,
+            'max_interval': self.max_interval,
+            'target_rps': self.target_rps,
+            'request_rate': round(signals['request_rate'], 2),
+            'error_rate': round(signals['error_rate'] * 100, 2),
+            'memory_percent': signals['memory_percent'],
+            'hints_issued': self.hints_issued,
+            'last_interval': self.last_interval
+        }
+
+
+# 全局心跳建議器實例（target_rps 為單個 worker 的目標速率）
+heartbeat_advisor = HeartbeatAdvisor(
+    base_interval=int(os.environ.get('HEARTBEAT_BASE_INTERVAL', 60)),
+    min_interval=int(os.environ.get('HEARTBEAT_MIN_INTERVAL', 15)),
+    max_interval=int(os.environ.get('HEARTBEAT_MAX_INTERVAL', 600)),
+    target_rps=float(os.environ.get('HEARTBEAT_TARGET_RPS', 20))
+)
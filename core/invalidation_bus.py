@@ -0,0 +1,366 @@
+"""
+invalidation_bus.py - 跨 worker 緩存失效廣播（本機 Unix domain socket + 跨實例 Firestore 輪詢）
+"""
+import glob
+import json
+import logging
+import os
+import queue
+import secrets
+import socket
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from core.shutdown import register_shutdown_hook
+from core.write_behind import MAX_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# 事件類型
+EVENT_USER = 'user'  # key = uuid_hash 或 uuid_hash:version，用戶數據或會話狀態已變更
+EVENT_TOKEN = 'token'  # key = session token，令牌已撤銷
+
+MAX_DATAGRAM_SIZE = 4096
+
+
+def user_event_key(uuid_hash: str, version: Optional[int] = None) -> str:
+    """EVENT_USER 的 key，用戶文檔寫入後附帶新的版本號"""
+    return uuid_hash if version is None else f"{uuid_hash}:{version}"
+
+
+def parse_user_event_key(key: str) -> Tuple[str, Optional[int]]:
+    """拆分 EVENT_USER 的 key，返回 (uuid_hash, 版本號或 None)"""
+    uuid_hash, _, version = key.partition(':')
+    try:
+        return uuid_hash, int(version) if version else None
+    except ValueError:
+        return uuid_hash, None
+
+
+class InvalidationBus:
+    """緩存失效廣播
+
+    publish 會立即在本進程執行訂閱者，並通過 Unix datagram socket 發送給同一主機上的
+    其他 worker（每個 worker 在 socket_dir 下綁定 <pid>.sock）。多實例部署可啟用 Firestore
+    後備通道：事件同時寫入 cache_invalidations 集合，其他實例輪詢讀取；沒有新事件時輪詢間隔
+    逐步加倍到 max_poll_interval，收到事件後恢復為 poll_interval。
+    訂閱者必須是冪等的：同一事件可能從兩個通道各收到一次。
+
+    Firestore 寫入經有界的 outbox 由後台線程完成；Firestore 慢或不可用導致 outbox 已滿時，
+    新事件只在本機廣播，不再排隊（計入 dropped）。
+    """
+
+    def __init__(self, socket_dir: str, poll_interval: int = 5, firestore_enabled: bool = False,
+                 collection_name: str = 'cache_invalidations', retention: int = 600,
+                 outbox_size: int = 1000, max_poll_interval: int = 60):
+        self.socket_dir = socket_dir
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(poll_interval, max_poll_interval)
+        self._current_poll_interval = poll_interval
+        self.firestore_enabled = firestore_enabled
+        self.collection_name = collection_name
+        self.retention = retention
+        self.outbox_size = outbox_size
+        self.db = None
+
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self._handlers = {}  # 事件類型 -> [handler]
+        self._sock = None
+        self._sock_path = None
+        self._pid = None
+        self._firestore_pid = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._outbox = queue.Queue(maxsize=outbox_size)
+        self._seen_ids = deque(maxlen=2000)
+        self._seen_set = set()
+        self._last_seen = None
+
+        # 指標
+        self.published = 0
+        self.received_local = 0
+        self.received_remote = 0
+        self.peer_send_failures = 0
+        self.handler_errors = 0
+        self.dropped = 0
+
+        register_shutdown_hook(self.close, name='invalidation-bus')
+
+    def subscribe(self, event_type: str, handler: Callable[[str], None]):
+        """訂閱事件，handler(key) 在發布者進程內同步執行，在其他 worker 的接收線程中執行"""
+        self._handlers.setdefault(event_type, []).append(handler)
+
+    def _dispatch(self, event_type: str, key: str):
+        for handler in self._handlers.get(event_type, ()):
+            try:
+                handler(key)
+            except Exception as e:
+                self.handler_errors += 1
+                logger.warning(f"緩存失效處理失敗 {event_type}: {e}")
+
+    def _spawn(self, target, name, *args):
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def start(self):
+        """綁定本 worker 的 socket 並啟動接收線程（fork 後的子進程會重新綁定並重啟後台線程）"""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.origin = f"{socket.gethostname()}:{self._pid}:{secrets.token_hex(4)}"
+            # 從父進程繼承的線程在子進程中不存在
+            self._threads = []
+            self._stop.clear()
+            self._start_firestore()
+
+            try:
+                os.makedirs(self.socket_dir, exist_ok=True)
+                path = os.path.join(self.socket_dir, f"{self._pid}.sock")
+                if os.path.exists(path):
+                    os.unlink(path)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.bind(path)
+                sock.settimeout(1.0)
+                self._sock = sock
+                self._sock_path = path
+            except Exception as e:
+                logger.warning(f"⚠️ 無法綁定緩存失效 socket，只使用 Firestore 通道: {e}")
+                self._sock = None
+                return
+
+            self._spawn(self._receive_loop, 'invalidation-bus-recv', self._sock)
+            logger.info(f"📡 緩存失效廣播已啟動: {self._sock_path}")
+
+    def set_db(self, db):
+        """設置 Firestore 數據庫實例並啟動跨實例的發布與輪詢線程"""
+        self.db = db
+        self.start()
+        with self._start_lock:
+            self._start_firestore()
+
+    def _start_firestore(self):
+        """每個進程啟動一次發布與輪詢線程，fork 後丟棄從父進程繼承的 outbox（調用方需持有 _start_lock）"""
+        if not self.firestore_enabled or self.db is None or self._firestore_pid == os.getpid():
+            return
+        if self._firestore_pid is not None:
+            self._outbox = queue.Queue(maxsize=self.outbox_size)
+        self._firestore_pid = os.getpid()
+        self._last_seen = datetime.now(timezone.utc)
+        self._spawn(self._publish_loop, 'invalidation-bus-publish')
+        self._spawn(self._poll_loop, 'invalidation-bus-poll')
+
+    def publish(self, event_type: str, key: str):
+        """廣播緩存失效事件"""
+        if not key:
+            return
+        self.published += 1
+        self._dispatch(event_type, key)
+
+        if self._pid != os.getpid():
+            self.start()
+        self._send_to_peers(event_type, key)
+
+        if self.firestore_enabled and self.db is not None:
+            try:
+                self._outbox.put_nowait((event_type, key))
+            except queue.Full:
+                self.dropped += 1
+
+    def _send_to_peers(self, event_type: str, key: str):
+        """發送給同一主機上的其他 worker，並清理已退出 worker 留下的 socket 文件"""
+        if self._sock is None:
+            return
+        payload = json.dumps({'t': event_type, 'k': key, 'o': self.origin}).encode('utf-8')
+        if len(payload) > MAX_DATAGRAM_SIZE:
+            return
+
+        for path in glob.glob(os.path.join(self.socket_dir, '*.sock')):
+            if path == self._sock_path:
+                continue
+            try:
+                self._sock.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except Exception as e:
+                self.peer_send_failures += 1
+                logger.debug(f"發送緩存失效事件失敗 {path}: {e}")
+
+    def _receive_loop(self, sock):
+        while not self._stop.is_set():
+            try:
+                data = sock.recv(MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            try:
+                message = json.loads(data)
+                if message.get('o') == self.origin:
+                    continue
+                self.received_local += 1
+                self._dispatch(message['t'], message['k'])
+            except Exception as e:
+                logger.debug(f"無效的緩存失效消息: {e}")
+
+    def _publish_loop(self):
+        """後台寫入 Firestore，避免請求線程等待網絡往返"""
+        while not self._stop.is_set():
+            try:
+                event_type, key = self._outbox.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            try:
+                self.db.collection(self.collection_name).add(self._event_doc(event_type, key))
+            except Exception as e:
+                logger.warning(f"寫入緩存失效事件失敗: {e}")
+
+    def _event_doc(self, event_type: str, key: str) -> Dict:
+        now = datetime.now(timezone.utc)
+        return {
+            'type': event_type,
+            'key': key,
+            'origin': self.origin,
+            'created_at': now,
+            'expires_at': now + timedelta(seconds=self.retention)
+        }
+
+    def _flush_outbox(self) -> int:
+        """批量寫入 outbox 中剩餘的事件，寫入失敗的事件丟棄（計入 dropped），返回寫入數"""
+        events = []
+        while True:
+            try:
+                events.append(self._outbox.get_nowait())
+            except queue.Empty:
+                break
+        if not events:
+            return 0
+
+        written = 0
+        collection = self.db.collection(self.collection_name)
+        for i in range(0, len(events), MAX_BATCH_SIZE):
+            chunk = events[i:i + MAX_BATCH_SIZE]
+            try:
+                batch = self.db.batch()
+                for event_type, key in chunk:
+                    batch.set(collection.document(), self._event_doc(event_type, key))
+                batch.commit()
+                written += len(chunk)
+            except Exception as e:
+                self.dropped += len(chunk)
+                logger.warning(f"寫入剩餘緩存失效事件失敗，丟棄 {len(chunk)} 個: {e}")
+        return written
+
+    def _poll_loop(self):
+        while not self._stop.wait(self._current_poll_interval):
+            try:
+                received = self.poll()
+            except Exception as e:
+                logger.warning(f"輪詢緩存失效事件失敗: {e}")
+                received = 0
+            # 空閒時退避，減少計費讀取
+            if received:
+                self._current_poll_interval = self.poll_interval
+            else:
+                self._current_poll_interval = min(self._current_poll_interval * 2, self.max_poll_interval)
+
+    def poll(self) -> int:
+        """讀取其他實例發布的事件；查詢窗口向前重疊幾秒以容忍時鐘偏差，按文檔 ID 去重"""
+        if self.db is None:
+            return 0
+
+        since = self._last_seen - timedelta(seconds=max(5, self._current_poll_interval))
+        docs = self.db.collection(self.collection_name)\
+                      .where('created_at', '>', since)\
+                      .order_by('created_at')\
+                      .limit(500)\
+                      .stream()
+
+        applied = 0
+        for doc in docs:
+            data = doc.to_dict()
+            created_at = data.get('created_at')
+            if created_at and created_at > self._last_seen:
+                self._last_seen = created_at
+            if doc.id in self._seen_set:
+                continue
+            if len(self._seen_ids) == self._seen_ids.maxlen:
+                self._seen_set.discard(self._seen_ids[0])
+            self._seen_ids.append(doc.id)
+            self._seen_set.add(doc.id)
+
+            if data.get('origin') == self.origin:
+                continue
+            self.received_remote += 1
+            self._dispatch(data.get('type'), data.get('key'))
+            applied += 1
+        return applied
+
+    def peers(self) -> List[str]:
+        """同一主機上其他 worker 的 socket"""
+        return [path for path in glob.glob(os.path.join(self.socket_dir, '*.sock')) if path != self._sock_path]
+
+    def close(self):
+        """停止後台線程，寫入 outbox 中剩餘的事件，並關閉、刪除本 worker 的 socket"""
+        self._stop.set()
+        if self._pid == os.getpid():
+            for thread in self._threads:
+                if thread is not threading.current_thread():
+                    thread.join(timeout=5)
+            self._threads = []
+        if self._firestore_pid == os.getpid():
+            self._flush_outbox()
+
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+        if self._sock_path and self._pid == os.getpid():
+            try:
+                os.unlink(self._sock_path)
+            except OSError:
+                pass
+
+    def get_stats(self) -> Dict:
+        """獲取廣播統計"""
+        return {
+            'origin': self.origin,
+            'socket': self._sock_path if self._sock is not None else None,
+            'local_peers': len(self.peers()) if self._sock is not None else 0,
+            'firestore_enabled': self.firestore_enabled,
+            'poll_interval': self._current_poll_interval if self.firestore_enabled else None,
+            'published': self.published,
+            'received_local': self.received_local,
+            'received_remote': self.received_remote,
+            'peer_send_failures': self.peer_send_failures,
+            'handler_errors': self.handler_errors,
+            'outbox_depth': self._outbox.qsize(),
+            'outbox_size': self.outbox_size,
+            'dropped': self.dropped
+        }
+
+
+# 全局緩存失效廣播實例
+invalidation_bus = InvalidationBus(
+    socket_dir=os.environ.get('INVALIDATION_BUS_DIR', '/tmp/scrilab_invalidation'),
+    poll_interval=int(os.environ.get('INVALIDATION_BUS_POLL_INTERVAL', 5)),
+    max_poll_interval=int(os.environ.get('INVALIDATION_BUS_MAX_POLL_INTERVAL', 60)),
+    # 只在多實例部署時需要，單實例內的 worker 由 Unix socket 通道覆蓋
+    firestore_enabled=os.environ.get('INVALIDATION_BUS_FIRESTORE', 'false').lower() == 'true',
+    outbox_size=int(os.environ.get('INVALIDATION_BUS_OUTBOX_SIZE', 1000))
+)
+
+
+def init_invalidation_bus(db):
+    """初始化緩存失效廣播"""
+    invalidation_bus.set_db(db)
+    return invalidation_bus
@@ -0,0 +1,284 @@
+"""
+job_executor.py - 有界後台任務執行器（具名隊列、背壓與丟棄策略、隊列深度指標、關閉時排空）
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+from core.shutdown import register_shutdown_hook
+
+logger = logging.getLogger(__name__)
+
+# 隊列已滿時的處理策略
+POLICY_DROP_NEW = 'drop_new'  # 丟棄新任務
+POLICY_DROP_OLDEST = 'drop_oldest'  # 丟棄隊列中最舊的任務
+POLICY_BLOCK = 'block'  # 調用方最多等待 block_timeout 秒，仍然滿則丟棄新任務
+POLICY_CALLER_RUNS = 'caller_runs'  # 在調用方線程中直接執行（把壓力推回請求本身）
+POLICIES = (POLICY_DROP_NEW, POLICY_DROP_OLDEST, POLICY_BLOCK, POLICY_CALLER_RUNS)
+
+# 內置隊列
+QUEUE_SESSIONS = 'sessions'  # 強制登入時終止舊會話
+QUEUE_WEBHOOKS = 'webhooks'  # Gumroad webhook 處理
+QUEUE_MAINTENANCE = 'maintenance'  # 啟動後的一次性維護任務
+QUEUE_CACHE_REFRESH = 'cache_refresh'  # 緩存過期後的後台刷新
+
+# 名稱 -> (worker 數, 最大長度, 策略)
+DEFAULT_QUEUES = {
+    QUEUE_SESSIONS: (2, 500, POLICY_CALLER_RUNS),
+    QUEUE_WEBHOOKS: (2, 100, POLICY_BLOCK),
+    QUEUE_MAINTENANCE: (1, 10, POLICY_DROP_NEW),
+    QUEUE_CACHE_REFRESH: (2, 200, POLICY_DROP_NEW),
+}
+
+# 關閉時等待隊列排空的最長秒數（所有隊列共用）
+DRAIN_TIMEOUT = float(os.environ.get('JOB_DRAIN_TIMEOUT', 5))
+
+
+class JobQueue:
+    """一個具名的有界任務隊列及其固定數量的 worker 線程
+
+    worker 線程在本進程第一次提交任務時才啟動（gunicorn fork 之後）。
+    提交返回 Future，任務被丟棄時返回 None。
+    """
+
+    def __init__(self, name: str, workers: int = 1, max_size: int = 1000,
+                 policy: str = POLICY_DROP_NEW, block_timeout: float = 5.0):
+        if policy not in POLICIES:
+            raise ValueError(f"未知的隊列策略: {policy}")
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_size = max(1, max_size)
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        self._jobs = deque()  # (future, fn, args, kwargs, 入隊時間)
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._active = 0
+        self._closed = False
+        self._pid = None
+
+        # 指標
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.ran_in_caller = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+
+    def _ensure_workers(self):
+        """本進程尚未啟動 worker 時啟動（調用方需持有鎖）"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        # fork 前入隊的任務屬於父進程
+        self._jobs.clear()
+        self._active = 0
+        for index in range(self.workers):
+            threading.Thread(target=self._run, name=f"job-{self.name}-{index}", daemon=True).start()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Optional[Future]:
+        """提交任務，返回 Future；隊列已滿且策略為丟棄時返回 None"""
+        future = Future()
+        with self._lock:
+            self.submitted += 1
+            if self._closed:
+                # 排空開始後提交的任務直接在調用方執行，不再丟失
+                self.ran_in_caller += 1
+                run_inline = True
+            else:
+                self._ensure_workers()
+                run_inline = False
+                if len(self._jobs) >= self.max_size:
+                    run_inline = self._on_full()
+                    if run_inline is None:
+                        return None
+
+            if not run_inline:
+                self._jobs.append((future, fn, args, kwargs, time.monotonic()))
+                depth = len(self._jobs)
+                if depth > self.max_depth:
+                    self.max_depth = depth
+                self._not_empty.notify()
+                return future
+
+        self._execute(future, fn, args, kwargs)
+        return future
+
+    def _on_full(self) -> Optional[bool]:
+        """按策略處理已滿的隊列（調用方需持有鎖）：返回 True 表示在調用方執行，False 表示可入隊，None 表示丟棄"""
+        if self.policy == POLICY_CALLER_RUNS:
+            self.ran_in_caller += 1
+            return True
+        if self.policy == POLICY_DROP_OLDEST:
+            oldest = self._jobs.popleft()
+            oldest[0].cancel()
+            self._record_drop()
+            return False
+        if self.policy == POLICY_BLOCK:
+            deadline = time.monotonic() + self.block_timeout
+            while len(self._jobs) >= self.max_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._not_full.wait(remaining)
+            if len(self._jobs) < self.max_size and not self._closed:
+                return False
+        self._record_drop()
+        return None
+
+    def _record_drop(self):
+        """記錄一次丟棄（調用方需持有鎖），日誌按次數抽樣"""
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 100 == 0:
+            logger.warning(f"⚠️ 任務隊列 {self.name} 已滿（{self.max_size}），累計丟棄 {self.dropped} 個任務")
+
+    def _execute(self, future: Future, fn: Callable, args, kwargs) -> bool:
+        if not future.set_running_or_notify_cancel():
+            return True
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            logger.error(f"後台任務失敗 ({self.name}): {str(e)}")
+            future.set_exception(e)
+            ok = False
+        else:
+            future.set_result(result)
+            ok = True
+        with self._lock:
+            self.total_run += time.perf_counter() - start
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+        return ok
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._jobs and not self._closed:
+                    self._not_empty.wait()
+                if not self._jobs:
+                    return
+                future, fn, args, kwargs, enqueued_at = self._jobs.popleft()
+                self._active += 1
+                waited = time.monotonic() - enqueued_at
+                self.total_wait += waited
+                if waited > self.max_wait:
+                    self.max_wait = waited
+                self._not_full.notify()
+
+            self._execute(future, fn, args, kwargs)
+
+            with self._lock:
+                self._active -= 1
+                if not self._jobs and not self._active:
+                    self._idle.notify_all()
+
+    def drain(self, timeout: float) -> int:
+        """停止接收新任務並等待隊列中的任務完成，返回超時後仍未完成的任務數"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            if self._pid != os.getpid():
+                return 0
+            while self._jobs or self._active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+            return len(self._jobs) + self._active
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def get_stats(self) -> Dict:
+        """獲取隊列統計（本 worker）"""
+        with self._lock:
+            started = self.completed + self.failed + self._active
+            return {
+                'policy': self.policy,
+                'workers': self.workers,
+                'max_size': self.max_size,
+                'depth': len(self._jobs),
+                'max_depth': self.max_depth,
+                'active': self._active,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'ran_in_caller': self.ran_in_caller,
+                'avg_wait_ms': round(self.total_wait / started * 1000, 3) if started else 0,
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+                'avg_run_ms': round(self.total_run / (self.completed + self.failed) * 1000, 3)
+                if self.completed + self.failed else 0
+            }
+
+
+class JobExecutor:
+    """具名任務隊列的集合
+
+    每類後台工作使用獨立的隊列與固定數量的 worker，一類任務積壓不會拖慢其他任務，
+    請求高峰時線程數保持不變。進程關閉時先於延遲寫入器排空所有隊列，任務產生的寫入能被最後一次刷新帶走。
+    """
+
+    def __init__(self, drain_timeout: float = DRAIN_TIMEOUT):
+        self.drain_timeout = drain_timeout
+        self._queues = {}
+        self._lock = threading.Lock()
+        register_shutdown_hook(self.shutdown, name='job-executor', first=True)
+
+    def register_queue(self, name: str, workers: int = 1, max_size: int = 1000,
+                       policy: str = POLICY_DROP_NEW, block_timeout: float = 5.0) -> JobQueue:
+        """註冊隊列，同名隊列已存在時返回已有隊列"""
+        with self._lock:
+            queue = self._queues.get(name)
+            if queue is None:
+                queue = self._queues[name] = JobQueue(name, workers, max_size, policy, block_timeout)
+            return queue
+
+    def queue(self, name: str) -> JobQueue:
+        return self._queues[name]
+
+    def submit(self, queue_name: str, fn: Callable, *args, **kwargs) -> Optional[Future]:
+        """提交任務到指定隊列，任務被丟棄時返回 None"""
+        return self._queues[queue_name].submit(fn, *args, **kwargs)
+
+    def shutdown(self, timeout: Optional[float] = None):
+        """排空所有隊列（共用一個超時）"""
+        deadline = time.monotonic() + (self.drain_timeout if timeout is None else timeout)
+        with self._lock:
+            queues = list(self._queues.values())
+        for queue in queues:
+            remaining = queue.drain(max(deadline - time.monotonic(), 0))
+            if remaining:
+                logger.warning(f"⚠️ 任務隊列 {queue.name} 排空超時，{remaining} 個任務未完成")
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            queues = list(self._queues.values())
+        return {queue.name: queue.get_stats() for queue in queues}
+
+
+def _queue_setting(name: str, setting: str, default: int) -> int:
+    """隊列配置的環境變量覆蓋，例如 JOB_QUEUE_SESSIONS_SIZE / JOB_QUEUE_SESSIONS_WORKERS"""
+    return int(os.environ.get(f"JOB_QUEUE_{name.upper()}_{setting}", default))
+
+
+# 全局任務執行器實例
+job_executor = JobExecutor()
+for _name, (_workers, _max_size, _policy) in DEFAULT_QUEUES.items():
+    job_executor.register_queue(_name, _queue_setting(_name, 'WORKERS', _workers),
+                                _queue_setting(_name, 'SIZE', _max_size), _policy)
@@ -0,0 +1,282 @@
+"""
+latency_histogram.py - 固定桶對數直方圖的延遲指標（按端點與狀態碼類別，按時間窗口輪轉，可跨 worker 合併）
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 每個 2 的冪區間分為 16 個子桶，相對誤差約 6%；以微秒計，最大約 4 分鐘
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAGNITUDES = 25
+BUCKET_COUNT = SUB_BUCKETS * MAGNITUDES
+
+
+def bucket_index(micros: int) -> int:
+    """微秒值所在的桶"""
+    if micros < SUB_BUCKETS:
+        return max(micros, 0)
+    shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+    index = (shift + 1) * SUB_BUCKETS + (micros >> shift) - SUB_BUCKETS
+    return min(index, BUCKET_COUNT - 1)
+
+
+def bucket_upper_bound(index: int) -> int:
+    """桶的上界（微秒，不含）"""
+    magnitude, offset = divmod(index, SUB_BUCKETS)
+    if magnitude == 0:
+        return offset + 1
+    return (SUB_BUCKETS + offset + 1) << (magnitude - 1)
+
+
+def status_class(status_code: Optional[int]) -> str:
+    """狀態碼類別：2xx / 3xx / 4xx / 5xx"""
+    if not status_code:
+        return '5xx'
+    return f"{status_code // 100}xx"
+
+
+class LatencyHistogram:
+    """單個延遲直方圖：計數存放在定長 array 中，記錄為 O(1)，同一桶佈局的直方圖可直接相加合併"""
+
+    __slots__ = ('counts', 'count', 'total_micros', 'max_micros')
+
+    def __init__(self):
+        self.counts = array('Q', bytes(8 * BUCKET_COUNT))
+        self.count = 0
+        self.total_micros = 0
+        self.max_micros = 0
+
+    def record(self, seconds: float):
+        micros = int(seconds * 1_000_000)
+        self.counts[bucket_index(micros)] += 1
+        self.count += 1
+        self.total_micros += micros
+        if micros > self.max_micros:
+            self.max_micros = micros
+
+    def merge(self, other: 'LatencyHistogram'):
+        counts = self.counts
+        for index, value in enumerate(other.counts):
+            if value:
+                counts[index] += value
+        self.count += other.count
+        self.total_micros += other.total_micros
+        self.max_micros = max(self.max_micros, other.max_micros)
+
+    def percentile(self, q: float) -> float:
+        """第 q 百分位（毫秒，取桶上界，不超過最大值）"""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(self.count * q / 100 + 0.5))
+        seen = 0
+        for index, value in enumerate(self.counts):
+            seen += value
+            if seen >= rank:
+                return min(bucket_upper_bound(index), self.max_micros) / 1000
+        return self.max_micros / 1000
+
+    def summary(self) -> Dict:
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total_micros / self.count / 1000, 3) if self.count else 0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'max_ms': self.max_micros / 1000
+        }
+
+    def to_dict(self) -> Dict:
+        """稀疏序列化（只保存非零桶）"""
+        return {
+            'buckets': [[index, value] for index, value in enumerate(self.counts) if value],
+            'count': self.count,
+            'total_micros': self.total_micros,
+            'max_micros': self.max_micros
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'LatencyHistogram':
+        histogram = cls()
+        for index, value in data.get('buckets', ()):
+            if 0 <= index < BUCKET_COUNT:
+                histogram.counts[index] += value
+        histogram.count = data.get('count', 0)
+        histogram.total_micros = data.get('total_micros', 0)
+        histogram.max_micros = data.get('max_micros', 0)
+        return histogram
+
+
+class EndpointLatencyMetrics:
+    """按 (端點, 狀態碼類別) 記錄延遲直方圖
+
+    每個鍵保留當前窗口與上一個窗口，統計覆蓋最近 window 到 2 × window 秒；超過兩個窗口沒有
+    請求的鍵自動歸零。後台線程定期把本 worker 的窗口直方圖寫入 export_dir/<pid>.json，
+    任何 worker 都可以讀取並合併所有存活 worker 的數據。
+    """
+
+    def __init__(self, window: int = 60, export_dir: Optional[str] = None, export_interval: int = 10):
+        self.window = window
+        self.export_dir = export_dir
+        self.export_interval = export_interval
+
+        self._windows = {}  # (端點, 類別) -> [窗口開始時間, 上一窗口, 當前窗口]
+        self._totals = {}  # (端點, 類別) -> 累計請求數
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = threading.Event()
+        self.export_failures = 0
+
+    def record(self, endpoint: str, status_code: Optional[int], seconds: float, now: Optional[float] = None):
+        """記錄一次請求"""
+        now = time.time() if now is None else now
+        key = (endpoint, status_class(status_code))
+        if self.export_dir and self._pid != os.getpid():
+            self._start_export()
+
+        with self._lock:
+            slot = self._windows.get(key)
+            if slot is None:
+                slot = self._windows[key] = [now - now % self.window, LatencyHistogram(), LatencyHistogram()]
+            self._rotate(slot, now)
+            slot[2].record(seconds)
+            self._totals[key] = self._totals.get(key, 0) + 1
+
+    def _rotate(self, slot, now: float):
+        """按需輪轉窗口（調用方需持有鎖）"""
+        elapsed = now - slot[0]
+        if elapsed < self.window:
+            return
+        if elapsed < 2 * self.window:
+            slot[1], slot[2] = slot[2], LatencyHistogram()
+        else:
+            slot[1], slot[2] = LatencyHistogram(), LatencyHistogram()
+        slot[0] = now - now % self.window
+
+    def snapshot(self, now: Optional[float] = None) -> Dict[Tuple[str, str], LatencyHistogram]:
+        """最近窗口的直方圖（上一窗口 + 當前窗口）"""
+        now = time.time() if now is None else now
+        result = {}
+        with self._lock:
+            for key, slot in self._windows.items():
+                self._rotate(slot, now)
+                histogram = LatencyHistogram()
+                histogram.merge(slot[1])
+                histogram.merge(slot[2])
+                if histogram.count:
+                    result[key] = histogram
+        return result
+
+    @staticmethod
+    def summarize(histograms: Dict[Tuple[str, str], LatencyHistogram]) -> Dict:
+        """端點 -> {類別: 摘要, 'all': 摘要}"""
+        by_endpoint = {}
+        for (endpoint, klass), histogram in sorted(histograms.items()):
+            by_endpoint.setdefault(endpoint, {})[klass] = histogram
+        result = {}
+        for endpoint, classes in by_endpoint.items():
+            combined = LatencyHistogram()
+            for histogram in classes.values():
+                combined.merge(histogram)
+            result[endpoint] = {klass: histogram.summary() for klass, histogram in classes.items()}
+            result[endpoint]['all'] = combined.summary()
+        return result
+
+    def get_stats(self) -> Dict:
+        """本 worker 最近窗口的延遲分佈與累計請求數"""
+        with self._lock:
+            totals = {f"{endpoint}|{klass}": count for (endpoint, klass), count in self._totals.items()}
+        return {
+            'window_seconds': self.window,
+            'endpoints': self.summarize(self.snapshot()),
+            'total_requests': totals
+        }
+
+    # === 跨 worker 合併 ===
+
+    def _start_export(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # fork 前記錄的數據屬於父進程
+            self._windows.clear()
+            self._totals.clear()
+
+        def run():
+            while not self._stop.wait(self.export_interval):
+                self.export()
+
+        threading.Thread(target=run, name='latency-export', daemon=True).start()
+
+    def export(self) -> bool:
+        """把本 worker 最近窗口的直方圖寫入共享目錄（先寫臨時文件再替換）"""
+        if not self.export_dir:
+            return False
+        payload = {
+            'pid': os.getpid(),
+            'exported_at': time.time(),
+            'histograms': [[endpoint, klass, histogram.to_dict()]
+                           for (endpoint, klass), histogram in self.snapshot().items()]
+        }
+        path = os.path.join(self.export_dir, f"{os.getpid()}.json")
+        try:
+            os.makedirs(self.export_dir, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(payload, f, separators=(',', ':'))
+            os.replace(path + '.tmp', path)
+            return True
+        except OSError as e:
+            self.export_failures += 1
+            logger.debug(f"寫入延遲指標失敗: {e}")
+            return False
+
+    def _peer_files(self) -> Iterable[str]:
+        own = os.path.join(self.export_dir, f"{os.getpid()}.json")
+        for path in glob.glob(os.path.join(self.export_dir, '*.json')):
+            if path != own:
+                yield path
+
+    def get_merged_stats(self) -> Dict:
+        """合併所有存活 worker 的最近窗口直方圖（本 worker 使用內存中的最新數據）"""
+        merged = self.snapshot()
+        workers = 1
+        stale_after = max(3 * self.export_interval, self.window)
+        for path in (self._peer_files() if self.export_dir else ()):
+            try:
+                with open(path) as f:
+                    payload = json.load(f)
+                pid = payload['pid']
+                os.kill(pid, 0)
+            except (OSError, ValueError, KeyError):
+                # 已退出的 worker 留下的文件
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            if time.time() - payload.get('exported_at', 0) > stale_after:
+                continue
+
+            workers += 1
+            for endpoint, klass, data in payload.get('histograms', ()):
+                histogram = merged.setdefault((endpoint, klass), LatencyHistogram())
+                histogram.merge(LatencyHistogram.from_dict(data))
+
+        return {
+            'window_seconds': self.window,
+            'workers': workers,
+            'endpoints': self.summarize(merged)
+        }
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+            self._totals.clear()
@@ -0,0 +1,217 @@
+"""
+license_verifier.py - 序號驗證服務（登入、會話驗證、下載/手冊頁面與 Discord 驗證共用）
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Sequence
+
+from core.user_cache import user_cache
+from core.user_projection import ACCESS_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# 驗證結果狀態
+STATUS_VALID = 'valid'
+STATUS_NOT_FOUND = 'not_found'
+STATUS_INACTIVE = 'inactive'
+STATUS_EXPIRED = 'expired'
+STATUS_UNAVAILABLE = 'unavailable'
+STATUS_ERROR = 'error'
+
+# 各狀態的默認提示（下載/手冊頁面與 Discord 使用）
+MESSAGES = {
+    STATUS_VALID: "驗證成功",
+    STATUS_NOT_FOUND: "序號無效",
+    STATUS_INACTIVE: "帳號已被停用",
+    STATUS_EXPIRED: "帳號已過期",
+    STATUS_UNAVAILABLE: "認證服務不可用",
+    STATUS_ERROR: "驗證服務錯誤"
+}
+
+
+@lru_cache(maxsize=10000)
+def _parse_expiry_string(value: str) -> Optional[float]:
+    """ISO 時間字符串轉 epoch 秒；不帶時區的按服務器本地時間解釋（與 datetime.now().isoformat() 寫入一致）"""
+    try:
+        if value.endswith('Z'):
+            value = value[:-1] + '+00:00'
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        logger.warning(f"無法解析到期時間 '{value}'")
+        return None
+
+
+def expires_epoch(value) -> Optional[float]:
+    """到期時間（ISO 字符串 / datetime / Firestore Timestamp）轉 epoch 秒，無期限或無法解析返回 None"""
+    if not value:
+        return None
+    if isinstance(value, str):
+        return _parse_expiry_string(value)
+    if hasattr(value, 'timestamp'):
+        return value.timestamp()
+    return None
+
+
+def account_expires_in(user_data: Dict, now: Optional[float] = None) -> Optional[float]:
+    """帳號剩餘有效秒數，無期限返回 None"""
+    epoch = expires_epoch(user_data.get('expires_at'))
+    if epoch is None:
+        return None
+    return epoch - (time.time() if now is None else now)
+
+
+class LicenseResult:
+    """一次序號驗證的結果"""
+
+    __slots__ = ('status', 'user_data', 'expires_epoch')
+
+    def __init__(self, status: str, user_data: Optional[Dict] = None, expires_epoch: Optional[float] = None):
+        self.status = status
+        self.user_data = user_data
+        self.expires_epoch = expires_epoch
+
+    @property
+    def valid(self) -> bool:
+        return self.status == STATUS_VALID
+
+    @property
+    def message(self) -> str:
+        return MESSAGES[self.status]
+
+    def expires_in(self, now: Optional[float] = None) -> Optional[float]:
+        """剩餘有效秒數，無期限返回 None"""
+        if self.expires_epoch is None:
+            return None
+        return self.expires_epoch - (time.time() if now is None else now)
+
+
+class LicenseVerifier:
+    """序號驗證服務
+
+    所有驗證入口共用同一條查詢路徑：經 user_cache 讀穿緩存讀取 authorized_users，
+    批量驗證時未命中的用戶在一次 get_all 中讀取；到期時間統一轉為 epoch 秒比較
+    （解析結果按原始值緩存），不再混用有無時區的 datetime。
+    指標按調用來源（login / validate / download / manual / discord ...）與結果狀態分別計數。
+    """
+
+    def __init__(self, cache=user_cache):
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: defaultdict(int))  # 來源 -> 狀態 -> 次數
+        self._lookup_time = defaultdict(float)  # 來源 -> 查詢總耗時
+
+    @staticmethod
+    def hash_uuid(uuid_string: str) -> str:
+        return hashlib.sha256(uuid_string.encode()).hexdigest()
+
+    def _record(self, source: str, status: str, duration: float = 0.0, count: int = 1):
+        with self._lock:
+            self._counts[source][status] += count
+            self._lookup_time[source] += duration
+
+    def evaluate(self, user_data: Optional[Dict], now: Optional[float] = None) -> LicenseResult:
+        """根據已讀取的用戶欄位判斷序號是否可用（不做 I/O，不計入指標）"""
+        if user_data is None:
+            return LicenseResult(STATUS_NOT_FOUND)
+        if not user_data.get('active', False):
+            return LicenseResult(STATUS_INACTIVE, user_data)
+
+        epoch = expires_epoch(user_data.get('expires_at'))
+        if epoch is not None and (time.time() if now is None else now) > epoch:
+            return LicenseResult(STATUS_EXPIRED, user_data, epoch)
+        return LicenseResult(STATUS_VALID, user_data, epoch)
+
+    def check(self, user_data: Optional[Dict], source: str = 'unknown') -> LicenseResult:
+        """判斷已讀取的用戶欄位（例如會話驗證已一併讀取用戶文檔），計入指標"""
+        result = self.evaluate(user_data)
+        self._record(source, result.status)
+        return result
+
+    def verify_hash(self, db, uuid_hash: str, fields: Optional[Sequence[str]] = ACCESS_FIELDS,
+                    source: str = 'unknown') -> LicenseResult:
+        """按 uuid hash 驗證，fields 為需要返回的用戶欄位（需包含 ACCESS_FIELDS，None 表示完整文檔）"""
+        if db is None:
+            self._record(source, STATUS_UNAVAILABLE)
+            return LicenseResult(STATUS_UNAVAILABLE)
+
+        start = time.perf_counter()
+        try:
+            user_data = self.cache.get_user(db, uuid_hash, fields)
+        except Exception as e:
+            logger.error(f"序號驗證查詢失敗 ({source}): {str(e)}")
+            self._record(source, STATUS_ERROR, time.perf_counter() - start)
+            return LicenseResult(STATUS_ERROR)
+
+        result = self.evaluate(user_data)
+        self._record(source, result.status, time.perf_counter() - start)
+        return result
+
+    def verify(self, db, uuid_string: str, fields: Optional[Sequence[str]] = ACCESS_FIELDS,
+               source: str = 'unknown') -> LicenseResult:
+        """驗證原始序號"""
+        return self.verify_hash(db, self.hash_uuid(uuid_string), fields, source)
+
+    def verify_many(self, db, uuid_strings: Iterable[str], fields: Optional[Sequence[str]] = ACCESS_FIELDS,
+                    source: str = 'unknown') -> Dict[str, LicenseResult]:
+        """批量驗證原始序號，緩存未命中的用戶在一次 get_all 中讀取，返回 序號 -> 結果"""
+        uuid_strings = list(dict.fromkeys(uuid_strings))
+        if db is None:
+            self._record(source, STATUS_UNAVAILABLE, count=len(uuid_strings))
+            return {uuid_string: LicenseResult(STATUS_UNAVAILABLE) for uuid_string in uuid_strings}
+
+        hashes = {uuid_string: self.hash_uuid(uuid_string) for uuid_string in uuid_strings}
+        start = time.perf_counter()
+        try:
+            users = self.cache.get_users(db, hashes.values(), fields)
+        except Exception as e:
+            logger.error(f"序號批量驗證查詢失敗 ({source}): {str(e)}")
+            self._record(source, STATUS_ERROR, time.perf_counter() - start, len(uuid_strings))
+            return {uuid_string: LicenseResult(STATUS_ERROR) for uuid_string in uuid_strings}
+
+        duration = time.perf_counter() - start
+        now = time.time()
+        results = {}
+        for uuid_string, uuid_hash in hashes.items():
+            results[uuid_string] = result = self.evaluate(users.get(uuid_hash), now)
+            self._record(source, result.status, duration / len(hashes))
+        return results
+
+    async def verify_async(self, db, uuid_string: str, fields: Optional[Sequence[str]] = ACCESS_FIELDS,
+                           source: str = 'unknown') -> LicenseResult:
+        """異步入口：在線程池中執行查詢，不阻塞事件循環"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.verify, db, uuid_string, fields, source)
+
+    async def verify_many_async(self, db, uuid_strings: Iterable[str],
+                                fields: Optional[Sequence[str]] = ACCESS_FIELDS,
+                                source: str = 'unknown') -> Dict[str, LicenseResult]:
+        """批量驗證的異步入口"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.verify_many, db, list(uuid_strings), fields, source)
+
+    def get_stats(self) -> Dict:
+        """獲取驗證統計（本 worker）"""
+        with self._lock:
+            sources = {}
+            for source, counts in self._counts.items():
+                total = sum(counts.values())
+                sources[source] = {
+                    'total': total,
+                    'by_status': dict(counts),
+                    'avg_lookup_ms': round(self._lookup_time[source] / total * 1000, 3) if total else 0
+                }
+        return {
+            'sources': sources,
+            'expiry_parse_cache': _parse_expiry_string.cache_info()._asdict(),
+            'user_cache': self.cache.get_stats()
+        }
+
+
+# 全局序號驗證服務實例
+license_verifier = LicenseVerifier()
@@ -0,0 +1,224 @@
+"""
+login_records.py - 緩衝的登入記錄（login_count / last_login / last_login_ip 按用戶合併後批量寫入）
+"""
+import logging
+import os
+import random
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+
+from firebase_admin import firestore
+
+from core.shutdown import register_shutdown_hook
+from core.user_projection import USERS_COLLECTION
+from core.write_behind import MAX_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+SHARDS_COLLECTION = 'login_counter_shards'
+
+
+def shard_doc_id(uuid_hash: str, shard: int) -> str:
+    return f"{uuid_hash}_{shard}"
+
+
+class LoginRecordBuffer:
+    """登入記錄緩衝
+
+    每次登入只在本地累加 uuid_hash 的登入次數並記下最後登入時間與 IP，不做 I/O。
+    每個刷新間隔按用戶合併成一次寫入，以 WriteBatch 分塊提交：頻繁重連的用戶在一個間隔內
+    只寫一次，不再對同一用戶文檔逐次 Increment。
+
+    shards 為 0 時直接更新 authorized_users 文檔；大於 0 時寫入 login_counter_shards/{uuid_hash}_{n}
+    中隨機一個分片，用戶文檔完全不被登入寫入佔用，讀取時需合計分片（見 overlay）。
+    """
+
+    def __init__(self, flush_interval: int = 30, shards: int = 0):
+        self.db = None
+        self.flush_interval = flush_interval
+        self.shards = max(0, shards)
+
+        self._pending = {}  # uuid_hash -> [次數, 最後登入時間, 最後登入 IP]
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.recorded = 0
+        self.flush_count = 0
+        self.docs_written = 0
+        self.failed = 0
+
+        register_shutdown_hook(self.stop, name='login-records')
+
+    def set_db(self, db):
+        """設置 Firestore 數據庫實例並啟動刷新線程"""
+        self.db = db
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(self.flush_interval):
+                self.flush()
+
+        self._thread = threading.Thread(target=run, name='login-records', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止刷新線程並寫入剩餘數據"""
+        self._stop.set()
+        self.flush()
+
+    def record(self, uuid_hash: str, client_ip: str, when: Optional[datetime] = None):
+        """記錄一次成功登入"""
+        when = when or datetime.now()
+        with self.lock:
+            entry = self._pending.get(uuid_hash)
+            if entry is None:
+                self._pending[uuid_hash] = [1, when, client_ip]
+            else:
+                entry[0] += 1
+                if when >= entry[1]:
+                    entry[1], entry[2] = when, client_ip
+            self.recorded += 1
+
+    def discard(self, uuid_hash: str, db=None):
+        """用戶已被刪除：丟棄尚未寫入的記錄，分片模式下同時刪除分片文檔"""
+        with self.lock:
+            self._pending.pop(uuid_hash, None)
+        db = db or self.db
+        if self.shards and db is not None:
+            batch = db.batch()
+            for shard in range(self.shards):
+                batch.delete(db.collection(SHARDS_COLLECTION).document(shard_doc_id(uuid_hash, shard)))
+            batch.commit()
+
+    def flush(self) -> int:
+        """寫入所有待寫入記錄，返回成功寫入的文檔數"""
+        if self.db is None:
+            return 0
+
+        with self._flush_lock:
+            with self.lock:
+                pending = self._pending
+                self._pending = {}
+
+            if not pending:
+                return 0
+
+            items = list(pending.items())
+            written = 0
+            for i in range(0, len(items), MAX_BATCH_SIZE):
+                written += self._commit_chunk(items[i:i + MAX_BATCH_SIZE])
+
+            self.flush_count += 1
+            self.docs_written += written
+            return written
+
+    def _commit_chunk(self, chunk) -> int:
+        try:
+            batch = self.db.batch()
+            for uuid_hash, entry in chunk:
+                self._write(batch, uuid_hash, entry)
+            batch.commit()
+            return len(chunk)
+        except Exception as e:
+            # 用戶文檔已被刪除時整個批次都會失敗，改為逐個寫入並跳過不存在的用戶
+            logger.debug(f"批量寫入登入記錄失敗，改為逐個寫入: {e}")
+
+        written = 0
+        for uuid_hash, entry in chunk:
+            try:
+                self._write(None, uuid_hash, entry)
+                written += 1
+            except Exception as e:
+                self.failed += 1
+                logger.debug(f"寫入 {uuid_hash[:8]}... 的登入記錄失敗: {e}")
+        return written
+
+    def _write(self, batch, uuid_hash: str, entry):
+        """寫入一個用戶的記錄（batch 為 None 時直接寫入）"""
+        count, last_login, last_login_ip = entry
+        fields = {
+            'login_count': firestore.Increment(count),
+            'last_login': last_login,
+            'last_login_ip': last_login_ip
+        }
+        if self.shards:
+            fields['uuid_hash'] = uuid_hash
+            ref = self.db.collection(SHARDS_COLLECTION).document(shard_doc_id(uuid_hash, random.randrange(self.shards)))
+            if batch is None:
+                ref.set(fields, merge=True)
+            else:
+                batch.set(ref, fields, merge=True)
+        else:
+            ref = self.db.collection(USERS_COLLECTION).document(uuid_hash)
+            if batch is None:
+                ref.update(fields)
+            else:
+                batch.update(ref, fields)
+
+    def overlay(self, users: Dict[str, Dict], db=None) -> Dict[str, Dict]:
+        """把分片合計與本地尚未寫入的記錄合併到 uuid_hash -> 用戶數據中（就地修改並返回）
+
+        分片模式下每個用戶需要讀取 shards 個分片文檔（在一次 get_all 中讀取）。
+        其他 worker 尚未寫入的記錄最多延遲一個刷新間隔。
+        """
+        db = db or self.db
+        if self.shards and db is not None and users:
+            refs = [db.collection(SHARDS_COLLECTION).document(shard_doc_id(uuid_hash, shard))
+                    for uuid_hash in users for shard in range(self.shards)]
+            for doc in db.get_all(refs):
+                if doc.exists:
+                    data = doc.to_dict()
+                    user_data = users.get(data.get('uuid_hash'))
+                    if user_data is not None:
+                        self._apply(user_data, data.get('login_count', 0),
+                                    data.get('last_login'), data.get('last_login_ip'))
+
+        with self.lock:
+            local = {uuid_hash: tuple(self._pending[uuid_hash]) for uuid_hash in users if uuid_hash in self._pending}
+        for uuid_hash, (count, last_login, last_login_ip) in local.items():
+            self._apply(users[uuid_hash], count, last_login, last_login_ip)
+        return users
+
+    @staticmethod
+    def _apply(user_data: Dict, count: int, last_login, last_login_ip):
+        user_data['login_count'] = (user_data.get('login_count') or 0) + (count or 0)
+        current = user_data.get('last_login')
+        if last_login is not None and (current is None or _comparable(last_login) >= _comparable(current)):
+            user_data['last_login'] = last_login
+            user_data['last_login_ip'] = last_login_ip
+
+    def get_stats(self) -> Dict:
+        """獲取緩衝統計"""
+        with self.lock:
+            pending_users = len(self._pending)
+            pending_logins = sum(entry[0] for entry in self._pending.values())
+        return {
+            'flush_interval': self.flush_interval,
+            'shards': self.shards,
+            'recorded': self.recorded,
+            'pending_users': pending_users,
+            'pending_logins': pending_logins,
+            'flush_count': self.flush_count,
+            'docs_written': self.docs_written,
+            'failed': self.failed
+        }
+
+
+def _comparable(value) -> float:
+    """last_login 可能是本地時間 datetime 或 Firestore 返回的帶時區時間，統一轉為 epoch 秒比較"""
+    if hasattr(value, 'timestamp'):
+        return value.timestamp()
+    return 0.0
+
+
+# 全局登入記錄緩衝實例
+login_records = LoginRecordBuffer(
+    flush_interval=int(os.environ.get('LOGIN_RECORDS_FLUSH_INTERVAL', 30)),
+    shards=int(os.environ.get('LOGIN_COUNTER_SHARDS', 0))
+)
@@ -0,0 +1,191 @@
+"""
+memory_monitor.py - 後台記憶體壓力採樣（優先讀取容器 cgroup 限額，請求處理只讀取最新結果）
+"""
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 嘗試導入 psutil，如果沒有則只使用 cgroup 數據
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+# 壓力等級
+LEVEL_NORMAL = 0
+LEVEL_ELEVATED = 1  # >= 80%：心跳開始退避
+LEVEL_HIGH = 2  # >= 85%：速率限制拒絕新請求，健康檢查報告 degraded
+LEVEL_CRITICAL = 3  # >= 90%：驗證端點直接返回 503
+LEVEL_NAMES = {LEVEL_NORMAL: 'normal', LEVEL_ELEVATED: 'elevated', LEVEL_HIGH: 'high', LEVEL_CRITICAL: 'critical'}
+LEVEL_THRESHOLDS = ((90, LEVEL_CRITICAL), (85, LEVEL_HIGH), (80, LEVEL_ELEVATED))
+
+
+def pressure_level(percent: Optional[float]) -> int:
+    """記憶體使用百分比對應的壓力等級"""
+    if percent is None:
+        return LEVEL_NORMAL
+    for threshold, level in LEVEL_THRESHOLDS:
+        if percent >= threshold:
+            return level
+    return LEVEL_NORMAL
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    if not value or value == 'max':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _read_stat(path: str, field: str) -> int:
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, value = line.partition(' ')
+                if name == field:
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+class MemoryPressureSampler:
+    """記憶體壓力採樣器
+
+    後台線程每 interval 秒採樣一次：優先讀取 cgroup v2 的 memory.current / memory.max
+    （扣除可回收的 inactive_file，與容器 OOM 判斷一致），其次 cgroup v1，沒有限額時退回 psutil
+    的整機數據。結果作為一個不可變元組整體替換，請求線程讀取時不需要加鎖，也不做任何系統調用。
+    """
+
+    def __init__(self, interval: float = 5, cgroup_root: str = '/sys/fs/cgroup'):
+        self.interval = interval
+        self.cgroup_root = cgroup_root
+
+        # (百分比, 已用字節, 限額字節, 來源, 等級, 採樣時間)
+        self._snapshot = (None, None, None, None, LEVEL_NORMAL, 0.0)
+        self._pid = None
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self.samples = 0
+        self.errors = 0
+
+        # fork 後的子進程沒有採樣線程，在首次讀取時重新啟動（讀取時不再調用 getpid）
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._started = False
+
+    def _read_cgroup_v2(self) -> Optional[Tuple[int, int]]:
+        limit = _read_int(os.path.join(self.cgroup_root, 'memory.max'))
+        current = _read_int(os.path.join(self.cgroup_root, 'memory.current'))
+        if not limit or current is None:
+            return None
+        inactive = _read_stat(os.path.join(self.cgroup_root, 'memory.stat'), 'inactive_file')
+        return max(0, current - inactive), limit
+
+    def _read_cgroup_v1(self) -> Optional[Tuple[int, int]]:
+        base = os.path.join(self.cgroup_root, 'memory')
+        limit = _read_int(os.path.join(base, 'memory.limit_in_bytes'))
+        usage = _read_int(os.path.join(base, 'memory.usage_in_bytes'))
+        # 未設限額時 v1 返回一個接近 2^63 的值
+        if not limit or usage is None or limit >= 1 << 60:
+            return None
+        inactive = _read_stat(os.path.join(base, 'memory.stat'), 'total_inactive_file')
+        return max(0, usage - inactive), limit
+
+    def sample(self) -> Dict:
+        """立即採樣一次並更新快照"""
+        used = limit = percent = source = None
+        try:
+            for source, reader in (('cgroup_v2', self._read_cgroup_v2), ('cgroup_v1', self._read_cgroup_v1)):
+                result = reader()
+                if result:
+                    used, limit = result
+                    percent = round(used / limit * 100, 1)
+                    break
+            else:
+                source = None
+                if PSUTIL_AVAILABLE:
+                    memory = psutil.virtual_memory()
+                    used, limit, percent, source = memory.total - memory.available, memory.total, memory.percent, 'psutil'
+        except Exception as e:
+            self.errors += 1
+            logger.debug(f"記憶體採樣失敗: {e}")
+
+        self._snapshot = (percent, used, limit, source, pressure_level(percent), time.time())
+        self.samples += 1
+        return self.get_stats()
+
+    def start(self):
+        """啟動採樣線程（每個進程一個，fork 後的子進程在首次讀取時自動啟動）"""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                self._started = True
+                return
+            self._pid = os.getpid()
+            self._started = True
+            self._stop.clear()
+            self.sample()
+
+            def run():
+                while not self._stop.wait(self.interval):
+                    self.sample()
+
+            threading.Thread(target=run, name='memory-monitor', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _current(self):
+        if not self._started:
+            self.start()
+        return self._snapshot
+
+    @property
+    def percent(self) -> Optional[float]:
+        """最近一次採樣的記憶體使用百分比，無法獲取時為 None"""
+        if not self._started:
+            self.start()
+        return self._snapshot[0]
+
+    @property
+    def level(self) -> int:
+        """最近一次採樣的壓力等級"""
+        return self._current()[4]
+
+    def get_stats(self) -> Dict:
+        """獲取記憶體壓力指標"""
+        percent, used, limit, source, level, sampled_at = self._current()
+        return {
+            'percent': percent,
+            'used_bytes': used,
+            'limit_bytes': limit,
+            'source': source,
+            'level': level,
+            'level_name': LEVEL_NAMES[level],
+            'interval': self.interval,
+            'samples': self.samples,
+            'age_seconds': round(time.time() - sampled_at, 1) if sampled_at else None
+        }
+
+
+# 全局記憶體壓力採樣器實例
+memory_monitor = MemoryPressureSampler(
+    interval=float(os.environ.get('MEMORY_SAMPLE_INTERVAL', 5)),
+    cgroup_root=os.environ.get('CGROUP_ROOT', '/sys/fs/cgroup')
+)
@@ -0,0 +1,409 @@
+"""
+rate_limit_backends.py - 速率限制狀態的存儲後端（進程內、本機共享記憶體、Redis）
+"""
+from abc import ABC, abstractmethod
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 嘗試導入 fcntl（僅 POSIX 可用），沒有則無法使用共享記憶體後端
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+# 嘗試導入 redis，如果沒有則不支持跨主機後端
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# take() 的結果代碼
+RESULT_OK = 0
+RESULT_LIMITED = 1  # 令牌不足
+RESULT_BLOCKED = 2  # 仍在封鎖期內
+RESULT_NEW_BLOCK = 3  # 本次超限觸發封鎖
+
+
+def apply_bucket(tokens: float, updated_at: float, blocked_until: float, capacity: float, refill_rate: float,
+                 block_duration: float, cost: int, now: float) -> Tuple[float, float, float, int, float]:
+    """令牌桶狀態轉移，返回 (tokens, updated_at, blocked_until, 結果代碼, 建議重試秒數)
+
+    cost=0 只檢查不消耗（也不會觸發封鎖）。
+    """
+    if blocked_until > now:
+        return tokens, updated_at, blocked_until, RESULT_BLOCKED, blocked_until - now
+
+    tokens = min(capacity, tokens + max(0.0, now - updated_at) * refill_rate)
+    if tokens < max(cost, 1):
+        retry_after = (max(cost, 1) - tokens) / refill_rate
+        if cost and block_duration:
+            return tokens, now, now + block_duration, RESULT_NEW_BLOCK, block_duration
+        return tokens, now, blocked_until, RESULT_LIMITED, retry_after
+    return tokens - cost, now, blocked_until, RESULT_OK, 0.0
+
+
+class RateLimitBackend(ABC):
+    """速率限制狀態後端接口：按鍵原子地執行令牌桶狀態轉移"""
+
+    name = 'base'
+
+    @abstractmethod
+    def take(self, key: str, capacity: float, refill_rate: float, block_duration: float,
+             cost: int, now: float) -> Tuple[int, float]:
+        """返回 (結果代碼, 建議重試秒數)"""
+        ...
+
+    @abstractmethod
+    def reset(self, key: str):
+        """清除一個鍵的狀態（例如驗證成功後清除失敗記錄）"""
+        ...
+
+    def blocked_count(self, now: float) -> int:
+        return 0
+
+    def __len__(self):
+        return 0
+
+    def get_stats(self) -> Dict:
+        return {'backend': self.name}
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """進程內後端：LRU 排序的字典，超過 max_keys 淘汰最久未用的鍵（單 worker 或測試用）"""
+
+    name = 'memory'
+
+    def __init__(self, max_keys: int = 50000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # 鍵 -> [tokens, updated_at, blocked_until]
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def take(self, key, capacity, refill_rate, block_duration, cost, now):
+        with self.lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [float(capacity), now, 0.0]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._buckets.move_to_end(key)
+
+            # 常見情況（未封鎖且令牌充足）內聯處理，其餘交給 apply_bucket
+            if bucket[2] <= now:
+                elapsed = now - bucket[1]
+                tokens = bucket[0] + elapsed * refill_rate if elapsed > 0 else bucket[0]
+                if tokens > capacity:
+                    tokens = capacity
+                if cost and tokens >= cost:
+                    bucket[0] = tokens - cost
+                    bucket[1] = now
+                    return RESULT_OK, 0.0
+
+            bucket[0], bucket[1], bucket[2], code, retry_after = apply_bucket(
+                bucket[0], bucket[1], bucket[2], capacity, refill_rate, block_duration, cost, now)
+            return code, retry_after
+
+    def reset(self, key):
+        with self.lock:
+            self._buckets.pop(key, None)
+
+    def pop(self, key) -> Optional[Tuple[float, float, float]]:
+        """取出並刪除一個鍵的 (tokens, updated_at, blocked_until)，不存在返回 None"""
+        with self.lock:
+            bucket = self._buckets.pop(key, None)
+        return tuple(bucket) if bucket is not None else None
+
+    def blocked_count(self, now):
+        with self.lock:
+            return sum(1 for bucket in self._buckets.values() if bucket[2] > now)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def get_stats(self):
+        return {
+            'backend': self.name,
+            'max_keys': self.max_keys,
+            'evictions': self.evictions
+        }
+
+
+class SharedMemoryRateLimitBackend(RateLimitBackend):
+    """本機共享記憶體後端：同一主機上所有 worker 映射同一個文件
+
+    文件是固定大小的哈希表，分為 stripes 段，每段有自己的鎖（進程內 threading.Lock +
+    跨進程 fcntl 字節範圍鎖），不同段的操作互不阻塞。鍵只會落在所屬段的 PROBE_WINDOW 個
+    連續槽位內；窗口已滿時覆蓋其中最久未更新且未被封鎖的槽位，相當於近似 LRU 淘汰閒置鍵。
+    窗口內全部處於封鎖狀態時不覆蓋任何槽位，新鍵改由本進程的溢出桶計數（只在本 worker 內生效）。
+    """
+
+    name = 'shared_memory'
+
+    MAGIC = b'SRLT0001'
+    HEADER = struct.Struct('<8sII')  # magic, slots, stripes
+    HEADER_SIZE = 64
+    SLOT = struct.Struct('<Qddd')  # key_hash, tokens, updated_at, blocked_until
+    PROBE_WINDOW = 16
+    # 只讀取窗口內各槽位的 key_hash，跳過桶狀態
+    WINDOW_HASHES = struct.Struct('<' + 'Q24x' * (PROBE_WINDOW - 1) + 'Q')
+    STATE = struct.Struct('<ddd')
+    OCCUPANCY_TTL = 30
+
+    def __init__(self, path: str, slots: int = 65536, stripes: int = 64):
+        if not FCNTL_AVAILABLE:
+            raise RuntimeError("共享記憶體後端需要 fcntl（僅支持 POSIX 系統）")
+
+        self.path = path
+        self._geometry(slots, stripes)
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._init_file()
+
+        self._locks = [threading.Lock() for _ in range(self.stripes)]
+        self._occupancy_cache = None
+        self._overflow = MemoryRateLimitBackend(max_keys=max(1024, self.slots // 16))
+        self.evictions = 0
+        self.overflows = 0
+        self._map = mmap.mmap(self._fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def _geometry(self, slots: int, stripes: int):
+        self.stripes = max(1, stripes)
+        self.slots_per_stripe = max(self.PROBE_WINDOW, slots // self.stripes)
+        self.slots = self.slots_per_stripe * self.stripes
+        self.size = self.HEADER_SIZE + self.slots * self.SLOT.size
+
+    def _init_file(self):
+        """在整個文件的排他鎖下創建表；文件已存在且有效時沿用其尺寸，保證所有 worker 看到同一張表"""
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self._fd, self.HEADER.size, 0).ljust(self.HEADER.size, b'\0')
+            magic, slots, stripes = self.HEADER.unpack(header)
+            if magic == self.MAGIC and slots and stripes and slots % stripes == 0:
+                requested = self.slots
+                self._geometry(slots, stripes)
+                if os.fstat(self._fd).st_size == self.size:
+                    if requested != self.slots:
+                        logger.info(f"沿用現有共享速率限制表尺寸 {self.slots} 槽位（刪除 {self.path} 後可按新配置重建）")
+                    return
+
+            os.ftruncate(self._fd, 0)
+            os.ftruncate(self._fd, self.size)
+            os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, self.slots, self.stripes), 0)
+            logger.info(f"🧮 已初始化共享速率限制表: {self.path} ({self.slots} 槽位)")
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def _hash(key: str) -> int:
+        # 0 表示空槽位；所有 worker 必須得到相同的值，不能使用內建 hash()
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') | 1
+
+    def _offset(self, index: int) -> int:
+        return self.HEADER_SIZE + index * self.SLOT.size
+
+    def _acquire(self, stripe: int):
+        self._locks[stripe].acquire()
+        try:
+            # 文件末尾之後的第 stripe 個字節作為該段的跨進程鎖（建議鎖，不覆蓋數據）
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self.size + stripe)
+        except Exception:
+            self._locks[stripe].release()
+            raise
+
+    def _release(self, stripe: int):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self.size + stripe)
+        finally:
+            self._locks[stripe].release()
+
+    def _window(self, key_hash: int) -> Tuple[int, int]:
+        """返回 (段, 窗口第一個槽位)；窗口不跨段也不迴繞，可一次讀取"""
+        # 最低位被置 1 用於區分空槽位，段與起始槽位取自更高的位
+        stripe = (key_hash >> 8) % self.stripes
+        start = (key_hash >> 32) % (self.slots_per_stripe - self.PROBE_WINDOW + 1)
+        return stripe, stripe * self.slots_per_stripe + start
+
+    def _find(self, key_hash: int, first: int, claim: bool, now: float = 0.0):
+        """在窗口內查找鍵，返回 (槽位, 現有數據或 None)；claim 時找不到則分配槽位
+
+        窗口已滿且全部處於封鎖狀態時返回 (None, None)，不覆蓋任何槽位。
+        """
+        offset = self._offset(first)
+        hashes = self.WINDOW_HASHES.unpack_from(self._map, offset)
+        if key_hash in hashes:
+            i = hashes.index(key_hash)
+            return first + i, self.STATE.unpack_from(self._map, offset + i * self.SLOT.size + 8)
+
+        if not claim:
+            return None, None
+        if 0 in hashes:
+            return first + hashes.index(0), None
+
+        # 窗口已滿：覆蓋未被封鎖的槽位中最久未更新的一個
+        candidates = []
+        for i in range(self.PROBE_WINDOW):
+            _, updated_at, blocked_until = self.STATE.unpack_from(self._map, offset + i * self.SLOT.size + 8)
+            if blocked_until <= now:
+                candidates.append((updated_at, i))
+        if not candidates:
+            return None, None
+        self.evictions += 1
+        return first + min(candidates)[1], None
+
+    def take(self, key, capacity, refill_rate, block_duration, cost, now):
+        key_hash = self._hash(key)
+        stripe, first = self._window(key_hash)
+        self._acquire(stripe)
+        try:
+            index, state = self._find(key_hash, first, claim=True, now=now)
+            if index is None:
+                self.overflows += 1
+                return self._overflow.take(key, capacity, refill_rate, block_duration, cost, now)
+            if state is None:
+                # 曾因窗口已滿而在溢出桶中計數的鍵，取得槽位後沿用溢出桶的狀態
+                state = self._overflow.pop(key)
+            tokens, updated_at, blocked_until = state if state else (float(capacity), now, 0.0)
+            tokens, updated_at, blocked_until, code, retry_after = apply_bucket(
+                tokens, updated_at, blocked_until, capacity, refill_rate, block_duration, cost, now)
+            self.SLOT.pack_into(self._map, self._offset(index), key_hash, tokens, updated_at, blocked_until)
+            return code, retry_after
+        finally:
+            self._release(stripe)
+
+    def reset(self, key):
+        key_hash = self._hash(key)
+        stripe, first = self._window(key_hash)
+        self._acquire(stripe)
+        try:
+            index, _ = self._find(key_hash, first, claim=False)
+            if index is not None:
+                self.SLOT.pack_into(self._map, self._offset(index), 0, 0.0, 0.0, 0.0)
+        finally:
+            self._release(stripe)
+        self._overflow.reset(key)
+
+    def _occupancy(self, now: float) -> Tuple[int, int]:
+        """(已用槽位, 封鎖中槽位)，全表掃描，結果緩存 OCCUPANCY_TTL 秒（健康檢查會頻繁調用）"""
+        if self._occupancy_cache is None or now - self._occupancy_cache[0] > self.OCCUPANCY_TTL:
+            used = blocked = 0
+            for index in range(self.slots):
+                slot_hash, _, _, blocked_until = self.SLOT.unpack_from(self._map, self._offset(index))
+                if slot_hash:
+                    used += 1
+                    if blocked_until > now:
+                        blocked += 1
+            self._occupancy_cache = (now, used, blocked)
+        return self._occupancy_cache[1], self._occupancy_cache[2]
+
+    def blocked_count(self, now):
+        return self._occupancy(now)[1]
+
+    def __len__(self):
+        return self._occupancy(time.time())[0]
+
+    def get_stats(self):
+        return {
+            'backend': self.name,
+            'path': self.path,
+            'slots': self.slots,
+            'stripes': self.stripes,
+            'evictions': self.evictions,
+            'overflows': self.overflows,
+            'overflow_keys': len(self._overflow)
+        }
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """跨主機後端：令牌桶狀態存放在 Redis hash 中，由 Lua 腳本原子地執行狀態轉移"""
+
+    name = 'redis'
+
+    SCRIPT = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 't') or ARGV[1])
+local updated_at = tonumber(redis.call('HGET', KEYS[1], 'u') or ARGV[6])
+local blocked_until = tonumber(redis.call('HGET', KEYS[1], 'b') or '0')
+local capacity, refill_rate, block_duration = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local cost, now, ttl = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[7])
+if blocked_until > now then
+    return {2, tostring(blocked_until - now)}
+end
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * refill_rate)
+local need = math.max(cost, 1)
+local code, retry_after = 0, 0
+if tokens < need then
+    if cost > 0 and block_duration > 0 then
+        blocked_until = now + block_duration
+        code, retry_after = 3, block_duration
+    else
+        code, retry_after = 1, (need - tokens) / refill_rate
+    end
+else
+    tokens = tokens - cost
+end
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now), 'b', tostring(blocked_until))
+redis.call('EXPIRE', KEYS[1], ttl)
+return {code, tostring(retry_after)}
+"""
+
+    def __init__(self, url: str, prefix: str = 'ratelimit:'):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("redis 模組不可用")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, capacity, refill_rate, block_duration, cost, now):
+        # 鍵在補滿且解除封鎖後過期
+        ttl = int(max(capacity / refill_rate, block_duration)) + 60
+        code, retry_after = self._script(keys=[self.prefix + key],
+                                         args=[capacity, refill_rate, block_duration, cost, now, now, ttl])
+        return int(code), float(retry_after)
+
+    def reset(self, key):
+        self.client.delete(self.prefix + key)
+
+    def get_stats(self):
+        return {'backend': self.name, 'prefix': self.prefix}
+
+
+def _default_shm_path() -> str:
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'scrilab_rate_limit')
+
+
+def create_rate_limit_backend(backend_type: str = None) -> RateLimitBackend:
+    """根據 RATE_LIMIT_BACKEND 環境變量創建後端（shared_memory / memory / redis），失敗時退回進程內後端"""
+    backend_type = (backend_type or os.environ.get('RATE_LIMIT_BACKEND', 'shared_memory')).lower()
+    max_keys = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 50000))
+
+    try:
+        if backend_type == 'redis':
+            return RedisRateLimitBackend(os.environ.get('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0'))
+        if backend_type == 'shared_memory':
+            return SharedMemoryRateLimitBackend(
+                os.environ.get('RATE_LIMIT_SHM_PATH', _default_shm_path()),
+                slots=max_keys,
+                stripes=int(os.environ.get('RATE_LIMIT_SHM_STRIPES', 64))
+            )
+    except Exception as e:
+        logger.warning(f"⚠️ 無法使用 {backend_type} 速率限制後端，改用進程內後端: {e}")
+
+    return MemoryRateLimitBackend(max_keys=max_keys)
@@ -0,0 +1,119 @@
+"""
+rate_limiter.py - 按路由的令牌桶速率限制（(路由, IP) 為鍵，O(1) 檢查，狀態在 worker 間共享）
+"""
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from core.memory_monitor import memory_monitor
+from core.rate_limit_backends import (
+    RateLimitBackend, MemoryRateLimitBackend, create_rate_limit_backend,
+    RESULT_OK, RESULT_BLOCKED, RESULT_NEW_BLOCK
+)
+
+logger = logging.getLogger(__name__)
+
+# 記憶體過高時拒絕請求，建議的重試秒數
+MEMORY_RETRY_AFTER = 5
+
+
+class RateLimitPolicy:
+    """一個路由的限流策略：time_window 秒內最多 max_requests 次，可突發到 max_requests"""
+
+    __slots__ = ('max_requests', 'time_window', 'refill_rate', 'block_duration')
+
+    def __init__(self, max_requests: int, time_window: float, block_duration: float = 0):
+        self.max_requests = max_requests
+        self.time_window = time_window
+        self.refill_rate = max_requests / time_window
+        self.block_duration = block_duration
+
+
+class TokenBucketRateLimiter:
+    """令牌桶速率限制器
+
+    每個 (路由, 鍵) 一個桶，桶狀態（剩餘令牌、上次補充時間、封鎖到期時間）存放在可插拔的後端中：
+    默認為本機共享記憶體，同一主機上的所有 worker 共用同一份計數與封鎖；也可使用進程內或 Redis 後端。
+    檢查時按經過時間補充令牌，不保存請求時間戳列表，單次檢查為 O(1)。
+    """
+
+    def __init__(self, backend: Optional[RateLimitBackend] = None, memory_threshold: Optional[float] = 85):
+        self.backend = backend if backend is not None else MemoryRateLimitBackend()
+        self.memory_threshold = memory_threshold
+
+        self.allowed = 0
+        self.rejected = 0
+        self.blocks = 0
+
+    def _check_memory(self) -> bool:
+        """系統記憶體是否低於閾值（讀取後台採樣結果，不做系統調用）"""
+        if self.memory_threshold is None:
+            return True
+        percent = memory_monitor.percent
+        return percent is None or percent < self.memory_threshold
+
+    def check(self, route: str, client_ip: str, policy: RateLimitPolicy,
+              now: Optional[float] = None) -> Tuple[bool, str, int]:
+        """檢查並消耗一個令牌，返回 (是否允許, 消息, 建議重試秒數)"""
+        # 熱路徑：記憶體檢查內聯，只讀取採樣結果
+        if self.memory_threshold is not None:
+            percent = memory_monitor.percent
+            if percent is not None and percent >= self.memory_threshold:
+                self.rejected += 1
+                return False, "系統記憶體使用率過高，請稍後再試", MEMORY_RETRY_AFTER
+
+        code, retry_after = self.backend.take(route + '|' + client_ip, policy.max_requests, policy.refill_rate,
+                                              policy.block_duration, 1, time.time() if now is None else now)
+        if code == RESULT_OK:
+            self.allowed += 1
+            return True, "OK", 0
+
+        self.rejected += 1
+        if code == RESULT_NEW_BLOCK:
+            self.blocks += 1
+            logger.warning(f"IP {client_ip} 已被封鎖（{route}），原因：超過速率限制")
+            return False, f"請求過於頻繁，IP已被暫時封鎖{int(policy.block_duration / 60)}分鐘", \
+                int(policy.block_duration)
+        if code == RESULT_BLOCKED:
+            return False, f"IP已被暫時封鎖，請在{int(retry_after / 60)}分鐘後再試", int(retry_after) + 1
+        return False, "請求過於頻繁，請稍後再試", int(retry_after) + 1
+
+    def peek(self, route: str, key: str, policy: RateLimitPolicy, now: Optional[float] = None) -> bool:
+        """是否還有可用令牌（不消耗）"""
+        now = time.time() if now is None else now
+        code, _ = self.backend.take(f"{route}|{key}", policy.max_requests, policy.refill_rate,
+                                    policy.block_duration, 0, now)
+        return code == RESULT_OK
+
+    def consume(self, route: str, key: str, policy: RateLimitPolicy, now: Optional[float] = None) -> bool:
+        """消耗一個令牌（用於記錄驗證失敗等事件，不做記憶體檢查），返回是否消耗成功"""
+        now = time.time() if now is None else now
+        code, _ = self.backend.take(f"{route}|{key}", policy.max_requests, policy.refill_rate,
+                                    policy.block_duration, 1, now)
+        return code == RESULT_OK
+
+    def reset(self, route: str, key: str):
+        """清除一個鍵的計數與封鎖"""
+        self.backend.reset(f"{route}|{key}")
+
+    def blocked_count(self, now: Optional[float] = None) -> int:
+        """當前處於封鎖狀態的鍵數"""
+        return self.backend.blocked_count(time.time() if now is None else now)
+
+    def __len__(self):
+        return len(self.backend)
+
+    def get_stats(self) -> Dict:
+        """獲取限流統計（allowed/rejected/blocks 為本 worker 的計數）"""
+        return {
+            'active_keys': len(self.backend),
+            'blocked_keys': self.blocked_count(),
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'blocks': self.blocks,
+            **self.backend.get_stats()
+        }
+
+
+# 全局速率限制器實例
+rate_limiter = TokenBucketRateLimiter(create_rate_limit_backend())
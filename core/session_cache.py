@@ -0,0 +1,197 @@
+"""
+session_cache.py - 進程內 Session 緩存（有界 LRU + TTL）
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _user_key(record: Dict) -> Optional[str]:
+    """session 記錄所屬用戶的 uuid hash"""
+    if record.get('uuid_hash'):
+        return record['uuid_hash']
+    if record.get('uuid'):
+        return hashlib.sha256(record['uuid'].encode()).hexdigest()
+    return None
+
+
+class SessionCache:
+    """有界的進程內 Session 緩存
+
+    token -> 已解析的 session 記錄。條目在緩存 TTL 到期或 session 本身過期後失效，
+    超過容量時按最近最少使用順序淘汰。
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: int = 30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # token -> (cached_at, record)
+        self._user_tokens = {}  # uuid_hash -> set(token)，用於按用戶批量失效
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token: str) -> Optional[Dict]:
+        """獲取緩存的 session 記錄，不存在或已失效時返回 None"""
+        now = time.time()
+
+        with self.lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            cached_at, record = entry
+            if now - cached_at > self.ttl:
+                self._remove(token)
+                self.misses += 1
+                return None
+
+            expires_epoch = record.get('_expires_epoch')
+            if expires_epoch is not None and now > expires_epoch:
+                self._remove(token)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return record
+
+    def set(self, token: str, record: Dict):
+        """寫入 session 記錄"""
+        with self.lock:
+            if token in self._entries:
+                self._remove(token)
+
+            self._entries[token] = (time.time(), record)
+            user_key = _user_key(record)
+            if user_key:
+                self._user_tokens.setdefault(user_key, set()).add(token)
+
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def pop(self, token: str) -> Optional[Dict]:
+        """移除單個 session"""
+        with self.lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            self._remove(token)
+            return entry[1]
+
+    def pop_user(self, uuid: str) -> int:
+        """移除某個用戶的所有 session"""
+        return self.pop_user_hash(hashlib.sha256(uuid.encode()).hexdigest())
+
+    def pop_user_hash(self, uuid_hash: str) -> int:
+        """按 uuid hash 移除某個用戶的所有 session"""
+        with self.lock:
+            tokens = list(self._user_tokens.get(uuid_hash, ()))
+            for token in tokens:
+                self._remove(token)
+            return len(tokens)
+
+    def clear(self):
+        """清空緩存"""
+        with self.lock:
+            self._entries.clear()
+            self._user_tokens.clear()
+
+    def _remove(self, token: str):
+        """移除條目並維護用戶索引（調用方需持有鎖）"""
+        _, record = self._entries.pop(token)
+        user_key = _user_key(record)
+        if user_key and user_key in self._user_tokens:
+            self._user_tokens[user_key].discard(token)
+            if not self._user_tokens[user_key]:
+                del self._user_tokens[user_key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self) -> Dict:
+        """獲取緩存統計"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / total * 100) if total > 0 else 0
+            }
+
+
+class NegativeCache:
+    """近期被拒絕令牌的有界緩存（LRU + TTL）
+
+    只記錄令牌是否被拒絕，命中時直接判定無效而不查詢存儲。令牌被創建時需調用 discard 失效。
+    """
+
+    def __init__(self, max_size: int = 50000, ttl: int = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # token -> rejected_at
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.additions = 0
+        self.evictions = 0
+
+    def contains(self, token: str) -> bool:
+        """令牌是否在近期被拒絕過"""
+        with self.lock:
+            rejected_at = self._entries.get(token)
+            if rejected_at is None:
+                return False
+            if time.time() - rejected_at > self.ttl:
+                del self._entries[token]
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, token: str):
+        """記錄被拒絕的令牌"""
+        with self.lock:
+            self._entries[token] = time.time()
+            self._entries.move_to_end(token)
+            self.additions += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, token: str):
+        """令牌已創建，移除其拒絕記錄"""
+        with self.lock:
+            self._entries.pop(token, None)
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self) -> Dict:
+        """獲取緩存統計"""
+        with self.lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'additions': self.additions,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,268 @@
+"""
+session_counters.py - 增量維護的 session 統計計數器（分片計數文檔 + 進程內鏡像）
+"""
+import logging
+import os
+import random
+import secrets
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from core.shutdown import register_shutdown_hook
+
+logger = logging.getLogger(__name__)
+
+TOTAL_FIELD = 'total'
+# 按過期分鐘分桶的欄位前綴：exp_<epoch 分鐘>
+BUCKET_PREFIX = 'exp_'
+# 已過期超過此分鐘數的桶在刷新時從分片中刪除
+BUCKET_RETENTION_MINUTES = 60
+
+
+def _bucket_field(expires_at) -> Optional[str]:
+    """返回過期時間所在的分桶欄位名"""
+    if expires_at is None:
+        return None
+    if isinstance(expires_at, datetime):
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        epoch = expires_at.timestamp()
+    elif hasattr(expires_at, 'timestamp'):
+        epoch = expires_at.timestamp()
+    else:
+        epoch = float(expires_at)
+    return f"{BUCKET_PREFIX}{int(epoch // 60)}"
+
+
+def _bucket_minute(field: str) -> int:
+    return int(field[len(BUCKET_PREFIX):])
+
+
+class SessionCounters:
+    """Session 統計計數器
+
+    total 為 session 記錄總數；active 為過期分桶中尚未過期的部分之和，expired = total - active。
+    創建、延長、撤銷、過期刪除時在本地累積增量，定時寫入隨機一個分片（避免單文檔寫入熱點），
+    寫入後重新讀取所有分片作為鏡像。沒有本地增量時按 refresh_interval 讀取分片以看到其他 worker
+    的寫入，分片未變化時間隔逐步加倍到 max_refresh_interval。統計查詢只讀鏡像，不做任何 I/O。
+
+    分片中尚無任何數據時（首次部署）由刷新線程全量掃描一次重建計數，不阻塞啟動。多個 worker 之間
+    通過存儲中的租約保證只有一個 worker 重建，其餘 worker 等到分片出現後再載入；載入前不寫入增量，
+    避免被重建時的重置覆蓋。
+    """
+
+    def __init__(self, shards: int = 4, flush_interval: int = 10, refresh_interval: int = 60,
+                 max_refresh_interval: int = 600, lease_ttl: int = 600):
+        self.store = None
+        self.shards = max(1, shards)
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.max_refresh_interval = max(refresh_interval, max_refresh_interval)
+        self._current_refresh_interval = refresh_interval
+        self.lease_ttl = lease_ttl
+        self.owner = None
+        self._loaded = False
+
+        self._snapshot = {}  # 所有分片合計（上次刷新時）
+        self._pending = {}  # 尚未寫入的本地增量
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.last_refresh = 0
+        self.flush_count = 0
+        self.rebuild_count = 0
+
+        register_shutdown_hook(self.stop, name='session-counters')
+
+    def set_store(self, store):
+        """設置持久化用的 session 存儲，載入分片並啟動刷新線程（需要重建時在刷新線程中進行）"""
+        self.store = store
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        try:
+            self._loaded = self._load()
+        except Exception as e:
+            logger.error(f"❌ 載入 session 計數器失敗: {str(e)}")
+
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def run():
+            if not self._loaded:
+                self._ensure_loaded()
+            while not self._stop.wait(self.flush_interval):
+                if not self._loaded:
+                    self._ensure_loaded()
+                self.flush()
+
+        self._thread = threading.Thread(target=run, name='session-counters', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止刷新線程並寫入剩餘增量"""
+        self._stop.set()
+        self.flush()
+
+    def _add(self, deltas: Dict[str, int]):
+        with self.lock:
+            for field, delta in deltas.items():
+                if field and delta:
+                    self._pending[field] = self._pending.get(field, 0) + delta
+
+    def session_created(self, expires_at):
+        self._add({TOTAL_FIELD: 1, _bucket_field(expires_at): 1})
+
+    def session_extended(self, old_expires_at, new_expires_at):
+        old_field = _bucket_field(old_expires_at)
+        new_field = _bucket_field(new_expires_at)
+        if old_field != new_field:
+            self._add({old_field: -1, new_field: 1})
+
+    def session_deleted(self, expires_at):
+        self._add({TOTAL_FIELD: -1, _bucket_field(expires_at): -1})
+
+    def _load(self) -> bool:
+        """讀取並合計所有分片，返回是否存在任何分片"""
+        shard_values = self.store.load_counter_shards()
+        totals = {}
+        for values in shard_values:
+            for field, value in values.items():
+                totals[field] = totals.get(field, 0) + int(value or 0)
+
+        with self.lock:
+            self._snapshot = totals
+            self.last_refresh = time.time()
+        return bool(shard_values)
+
+    def _ensure_loaded(self):
+        """分片尚不存在時，取得租約的 worker 重建計數，其他 worker 下次刷新時重試載入"""
+        try:
+            if self._load():
+                self._loaded = True
+                return
+            if not self.store.acquire_counter_lease(self.owner, self.lease_ttl):
+                logger.info("🔢 其他 worker 正在重建 session 計數器，等待分片")
+                return
+            # 取得租約前可能已有 worker 完成重建
+            if self._load():
+                self._loaded = True
+                return
+            self.rebuild()
+        except Exception as e:
+            logger.error(f"❌ 載入 session 計數器失敗: {str(e)}")
+
+    def flush(self) -> bool:
+        """寫入本地增量到隨機分片並刷新鏡像"""
+        if not self.store or not self.store.is_ready():
+            return False
+
+        # 分片載入前保留本地增量，避免寫入的增量被其他 worker 重建時的重置覆蓋
+        if not self._loaded:
+            return False
+
+        with self._flush_lock:
+            with self.lock:
+                pending = self._pending
+                self._pending = {}
+
+            try:
+                if pending:
+                    shard_id = f"shard_{random.randrange(self.shards)}"
+                    self.store.apply_counter_deltas(shard_id, pending)
+                    self.flush_count += 1
+            except Exception as e:
+                logger.error(f"❌ 寫入 session 計數器失敗: {str(e)}")
+                self._add(pending)
+                return False
+
+            # 空閒時按退避間隔讀取分片，避免每個刷新週期都讀取所有分片
+            if not pending and time.time() - self.last_refresh < self._current_refresh_interval:
+                return True
+
+            try:
+                previous = self._snapshot
+                self._load()
+                if pending or self._snapshot != previous:
+                    self._current_refresh_interval = self.refresh_interval
+                else:
+                    self._current_refresh_interval = min(self._current_refresh_interval * 2,
+                                                         self.max_refresh_interval)
+                self._prune()
+            except Exception as e:
+                logger.warning(f"刷新 session 計數器失敗: {e}")
+            return True
+
+    def _prune(self):
+        """刪除早已過期的分桶欄位，避免分片文檔無限增長"""
+        cutoff = int(time.time() // 60) - BUCKET_RETENTION_MINUTES
+        with self.lock:
+            stale = [field for field in self._snapshot
+                     if field.startswith(BUCKET_PREFIX) and _bucket_minute(field) < cutoff]
+        if stale:
+            self.store.drop_counter_fields(stale)
+            with self.lock:
+                for field in stale:
+                    self._snapshot.pop(field, None)
+
+    def rebuild(self) -> Dict:
+        """全量掃描 session 存儲重建計數（首次部署或計數漂移時使用）"""
+        with self._flush_lock:
+            totals = {TOTAL_FIELD: 0}
+            for _, session_data in self.store.iter_all():
+                totals[TOTAL_FIELD] += 1
+                field = _bucket_field(session_data.get('expires_at'))
+                if field:
+                    totals[field] = totals.get(field, 0) + 1
+
+            self.store.reset_counters(totals)
+            with self.lock:
+                self._snapshot = totals
+                self._pending = {}
+                self.last_refresh = time.time()
+            self._loaded = True
+            self.rebuild_count += 1
+
+        logger.info(f"🔢 Session 計數器已重建: total={totals[TOTAL_FIELD]}")
+        return totals
+
+    def get_counts(self, now: Optional[datetime] = None) -> Dict:
+        """返回 total / active / expired，僅讀取本地鏡像"""
+        current_minute = int((now.timestamp() if now else time.time()) // 60)
+        with self.lock:
+            merged = dict(self._snapshot)
+            for field, delta in self._pending.items():
+                merged[field] = merged.get(field, 0) + delta
+
+        total = max(0, merged.get(TOTAL_FIELD, 0))
+        # 當前分鐘的桶視為仍有效，誤差不超過一分鐘
+        active = sum(value for field, value in merged.items()
+                     if field.startswith(BUCKET_PREFIX) and _bucket_minute(field) >= current_minute)
+        active = min(max(0, active), total)
+        return {
+            'total_sessions': total,
+            'active_sessions': active,
+            'expired_sessions': total - active
+        }
+
+    def get_stats(self) -> Dict:
+        """獲取計數器狀態"""
+        with self.lock:
+            pending = len(self._pending)
+            buckets = sum(1 for field in self._snapshot if field.startswith(BUCKET_PREFIX))
+        return {
+            'shards': self.shards,
+            'loaded': self._loaded,
+            'flush_interval': self.flush_interval,
+            'refresh_interval': self._current_refresh_interval,
+            'pending_fields': pending,
+            'bucket_fields': buckets,
+            'flush_count': self.flush_count,
+            'rebuild_count': self.rebuild_count,
+            'last_refresh': datetime.fromtimestamp(self.last_refresh).isoformat() if self.last_refresh else None
+        }
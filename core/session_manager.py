@@ -1,27 +1,118 @@
 # session_manager.py - 修復時間格式問題版本
 import logging
 import time
-import secrets
 import hashlib
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 import os
 
+from core.session_cache import SessionCache, NegativeCache
+from core.activity_rollup import activity_rollup
+from core.invalidation_bus import invalidation_bus, EVENT_USER, EVENT_TOKEN, parse_user_event_key
+from core.session_counters import SessionCounters
+from core.session_tokens import SignedTokenCodec, RevocationList, is_signed_token, new_opaque_token, opaque_token_user_hash
+from core.session_store import SessionStore, FirestoreSessionStore, create_session_store
+from core.user_cache import user_cache, CACHED_FIELDS
+from core.user_projection import project
+from core.write_behind import MAX_BATCH_SIZE
+
 logger = logging.getLogger(__name__)
 
 class FirestoreSessionManager:
-    """基於 Firestore 的 Session 管理器 - 修復時間格式問題"""
+    """Session 管理器 - 預設使用 Firestore，也可透過 SESSION_STORE_BACKEND 切換存儲後端"""
     
-    def __init__(self, db=None):
+    def __init__(self, db=None, store: Optional[SessionStore] = None):
         self.db = db
         self.collection_name = 'user_sessions'
-        logger.info("🔥 Firestore Session Manager 初始化")
+        self.store = store or create_session_store()
+        
+        # 進程內 session 緩存，驗證時優先命中本地
+        self.session_cache = SessionCache(
+            max_size=int(os.environ.get('SESSION_CACHE_MAX_SIZE', 10000)),
+            ttl=int(os.environ.get('SESSION_CACHE_TTL', 30))
+        )
+        
+        # 近期被拒絕的令牌，命中時不再查詢存儲
+        self.negative_cache = NegativeCache(
+            max_size=int(os.environ.get('SESSION_NEGATIVE_CACHE_MAX_SIZE', 50000)),
+            ttl=int(os.environ.get('SESSION_NEGATIVE_CACHE_TTL', 60))
+        )
+        
+        # 其他 worker 撤銷令牌或終止用戶會話時同步失效本地緩存
+        invalidation_bus.subscribe(EVENT_USER, self._on_user_invalidated)
+        invalidation_bus.subscribe(EVENT_TOKEN, self._on_token_invalidated)
+        
+        # 增量維護的統計計數，避免統計接口全量掃描
+        self.counters = SessionCounters(
+            shards=int(os.environ.get('SESSION_COUNTER_SHARDS', 4)),
+            flush_interval=int(os.environ.get('SESSION_COUNTER_FLUSH_INTERVAL', 10)),
+            refresh_interval=int(os.environ.get('SESSION_COUNTER_REFRESH_INTERVAL', 60)),
+            max_refresh_interval=int(os.environ.get('SESSION_COUNTER_MAX_REFRESH_INTERVAL', 600))
+        )
+        
+        # 令牌模式：opaque（隨機令牌，查 Firestore 驗證）或 signed（HMAC 簽名，本地驗證）
+        self.token_mode = os.environ.get('SESSION_TOKEN_MODE', 'opaque').lower()
+        self.token_codec = None
+        self.revocations = None
+        if self.token_mode == 'signed':
+            signing_secret = os.environ.get('SESSION_SIGNING_SECRET')
+            if signing_secret:
+                self.token_codec = SignedTokenCodec(signing_secret)
+                self.revocations = RevocationList(
+                    refresh_interval=int(os.environ.get('SESSION_REVOCATION_REFRESH', 10))
+                )
+            else:
+                logger.error("❌ SESSION_TOKEN_MODE=signed 但未設定 SESSION_SIGNING_SECRET，改用 opaque 令牌")
+                self.token_mode = 'opaque'
+        
+        # opaque 令牌中 uuid hash 讀取提示的加密密鑰，未設置時令牌不附帶提示
+        hint_secret = os.environ.get('SESSION_TOKEN_HINT_KEY') or os.environ.get('SESSION_SIGNING_SECRET')
+        self.token_hint_key = hint_secret.encode('utf-8') if hint_secret else None
+        
+        logger.info(f"🔥 Session Manager 初始化 (store: {self.store.storage_type}, token mode: {self.token_mode})")
     
     def set_db(self, db):
         """設置 Firestore 數據庫實例"""
         self.db = db
+        if isinstance(self.store, FirestoreSessionStore):
+            self.store.set_db(db)
+        if self.revocations:
+            self.revocations.set_store(self.store)
+        self.counters.set_store(self.store)
         logger.info("✅ Firestore 數據庫實例已設置")
     
+    def _store_ready(self) -> bool:
+        """檢查存儲後端是否可用"""
+        if self.store.is_ready():
+            return True
+        logger.error("❌ Session 存儲未初始化")
+        return False
+    
+    def _on_user_invalidated(self, key: str):
+        """收到用戶變更廣播"""
+        self.session_cache.pop_user_hash(parse_user_event_key(key)[0])
+    
+    def _on_token_invalidated(self, token: str):
+        """收到令牌撤銷廣播"""
+        self.session_cache.pop(token)
+        self.negative_cache.add(token)
+    
+    def _drop_pending_update(self, token: str):
+        """丟棄某個 token 尚未寫入的更新（session 已刪除時）"""
+        self.store.discard_update(token)
+    
+    def flush_pending_updates(self) -> int:
+        """立即寫入緩衝中的 session 活動更新"""
+        return self.store.flush()
+    
+    def _cache_record(self, session_data: Dict) -> Dict:
+        """構建緩存用的 session 記錄（預先解析過期時間）"""
+        record = dict(session_data)
+        expires_at = self._parse_datetime(record.get('expires_at'))
+        record['expires_at'] = expires_at
+        record['_expires_epoch'] = expires_at.timestamp() if expires_at else None
+        return record
+    
     def _now_utc(self):
         """獲取 UTC 時間（有時區信息）"""
         return datetime.now(timezone.utc)
@@ -63,19 +154,29 @@ class FirestoreSessionManager:
         return None
     
     def generate_session_token(self, uuid: str, client_ip: str, session_timeout: int = 3600) -> str:
-        """生成會話令牌並存儲到 Firestore"""
+        """生成會話令牌並存儲到 session 存儲"""
         try:
-            if not self.db:
-                logger.error("❌ Firestore 數據庫未初始化")
+            if not self._store_ready():
                 raise Exception("Database not initialized")
             
-            token = secrets.token_urlsafe(32)
-            now = self._now_utc()
-            expires_at = now + timedelta(seconds=session_timeout)
+            uuid_hash = hashlib.sha256(uuid.encode()).hexdigest()
+            
+            if self.token_codec:
+                issued = self.token_codec.encode(uuid_hash, session_timeout)
+                token = issued['token']
+                doc_id = issued['claims']['sid']
+                now = datetime.fromtimestamp(issued['claims']['iat'] / 1000, tz=timezone.utc)
+                expires_at = datetime.fromtimestamp(issued['claims']['exp'], tz=timezone.utc)
+            else:
+                token = new_opaque_token(uuid_hash, self.token_hint_key)
+                doc_id = token
+                now = self._now_utc()
+                expires_at = now + timedelta(seconds=session_timeout)
             
             session_data = {
                 'uuid': uuid,
-                'token': token,
+                'uuid_hash': uuid_hash,
+                'token': doc_id,
                 'created_at': now,
                 'expires_at': expires_at,
                 'last_activity': now,
@@ -83,9 +184,12 @@ class FirestoreSessionManager:
                 'active': True
             }
             
-            # 存儲到 Firestore
-            session_ref = self.db.collection(self.collection_name).document(token)
-            session_ref.set(session_data)
+            # 存儲 session（簽名模式下僅供查詢與管理使用，驗證不再讀取）
+            self.negative_cache.discard(token)
+            self.store.create(doc_id, session_data)
+            self.counters.session_created(expires_at)
+            if not self.token_codec:
+                self.session_cache.set(token, self._cache_record(session_data))
             
             logger.info(f"✅ Session 已創建: {token[:16]}... for user {uuid[:8]}...")
             return token
@@ -95,81 +199,183 @@ class FirestoreSessionManager:
             raise
     
     def verify_session_token(self, token: str) -> Tuple[bool, Optional[Dict]]:
-        """驗證會話令牌 - 修復時間比較問題"""
+        """驗證會話令牌 - 優先使用本地緩存，活動時間延遲寫入"""
+        return self._verify_session(token, self.store.get)
+    
+    def verify_session_with_user(self, token: str, user_fields: Optional[List[str]] = None
+                                 ) -> Tuple[bool, Optional[Dict], Optional[Dict]]:
+        """驗證會話令牌並讀取用戶欄位，返回 (是否有效, session 資料, 用戶欄位)，用戶不存在時用戶欄位為 None
+
+        配置了提示密鑰時新格式 opaque 令牌附帶加密的 uuid hash：用戶數據在用戶緩存中時只需確認 session；否則在本地 session
+        緩存未命中時 session 與用戶文檔在同一次 get_all 中讀取。緩存命中和簽名令牌只需讀取用戶文檔
+        （同樣經過用戶緩存），只有舊格式令牌或非 Firestore 存儲在緩存未命中時仍需先讀 session 再讀用戶。
+        用戶文檔的讀取錯誤會拋出，由調用方處理。
+        """
+        hinted_hash = opaque_token_user_hash(token, self.token_hint_key)
+        cacheable = user_cache.covers(user_fields)
+        prefetched = {}
+        
+        if hinted_hash and cacheable:
+            hit, cached_user = user_cache.lookup(hinted_hash, user_fields)
+            if hit:
+                prefetched['user'] = cached_user
+        
+        def load_with_user(doc_id: str) -> Optional[Dict]:
+            read_started = time.time()
+            session_data, user_data = self.store.get_with_user(
+                doc_id, hinted_hash, CACHED_FIELDS if cacheable else user_fields
+            )
+            if user_data is not None and cacheable:
+                user_cache.store(hinted_hash, user_data, read_started)
+            prefetched['user'] = project(user_data, user_fields)
+            return session_data
+        
+        if hinted_hash and 'user' not in prefetched and isinstance(self.store, FirestoreSessionStore):
+            is_valid, session_data = self._verify_session(token, load_with_user)
+        else:
+            is_valid, session_data = self.verify_session_token(token)
+        if not is_valid:
+            return False, None, None
+        
+        uuid_hash = session_data.get('uuid_hash')
+        if not uuid_hash and session_data.get('uuid'):
+            uuid_hash = hashlib.sha256(session_data['uuid'].encode()).hexdigest()
+        if not uuid_hash:
+            return True, session_data, None
+        
+        # 令牌附帶的 hash 只是讀取提示，與 session 記錄不一致時以記錄為準重新讀取
+        if 'user' in prefetched and uuid_hash == hinted_hash:
+            return True, session_data, prefetched['user']
+        return True, session_data, user_cache.get_user(self.db, uuid_hash, user_fields)
+    
+    def _verify_session(self, token: str, load_session) -> Tuple[bool, Optional[Dict]]:
+        """驗證會話令牌，緩存未命中時用 load_session(token) 讀取 session 記錄"""
         try:
-            if not self.db:
-                logger.error("❌ Firestore 數據庫未初始化")
-                return False, None
-            
-            session_ref = self.db.collection(self.collection_name).document(token)
-            session_doc = session_ref.get()
+            if self.token_codec and is_signed_token(token):
+                return self._verify_signed_token(token)
             
-            if not session_doc.exists:
-                logger.debug(f"❌ Session 不存在: {token[:16]}...")
+            if not self._store_ready():
                 return False, None
             
-            session_data = session_doc.to_dict()
+            record = self.session_cache.get(token)
             
-            # 檢查是否被標記為非活躍
-            if not session_data.get('active', True):
-                logger.debug(f"❌ Session 已被停用: {token[:16]}...")
-                return False, None
+            if record is None:
+                if self.negative_cache.contains(token):
+                    logger.debug(f"❌ Session 近期已被拒絕: {token[:16]}...")
+                    return False, None
+                
+                session_data = load_session(token)
+                
+                if session_data is None:
+                    logger.debug(f"❌ Session 不存在: {token[:16]}...")
+                    self.negative_cache.add(token)
+                    return False, None
+                
+                record = self._cache_record(session_data)
+                
+                # 檢查是否被標記為非活躍
+                if not record.get('active', True):
+                    logger.debug(f"❌ Session 已被停用: {token[:16]}...")
+                    self.negative_cache.add(token)
+                    return False, None
+                
+                self.session_cache.set(token, record)
             
-            # 安全解析時間
-            expires_at = self._parse_datetime(session_data.get('expires_at'))
+            expires_at = record.get('expires_at')
             now = self._now_utc()
             
             # 檢查是否過期
             if expires_at and now > expires_at:
                 logger.debug(f"❌ Session 已過期: {token[:16]}... (expired: {expires_at}, now: {now})")
+                self.session_cache.pop(token)
+                self._drop_pending_update(token)
+                self.negative_cache.add(token)
                 # 刪除過期的 session
                 try:
-                    session_ref.delete()
+                    deleted = self.store.delete(token)
+                    if deleted is not None:
+                        self.counters.session_deleted(deleted.get('expires_at'))
                 except Exception as e:
                     logger.warning(f"刪除過期 session 失敗: {e}")
                 return False, None
             
-            # 更新最後活動時間
-            update_data = {
-                'last_activity': now
-            }
-            
-            # 如果快過期了，自動延長（少於5分鐘）
-            if expires_at:
-                time_left = (expires_at - now).total_seconds()
-                if time_left < 300:  # 少於5分鐘
-                    session_timeout = int(os.environ.get('SESSION_TIMEOUT', 3600))
-                    new_expires_at = now + timedelta(seconds=session_timeout)
-                    update_data['expires_at'] = new_expires_at
-                    logger.debug(f"🔄 Session 自動延長: {token[:16]}...")
-            
-            # 批量更新
-            try:
-                session_ref.update(update_data)
-                # 更新本地數據
-                session_data.update(update_data)
-            except Exception as e:
-                logger.warning(f"更新 session 活動時間失敗: {e}")
+            # 活動記錄進分鐘匯總，不再每次改寫 session 的 last_activity
+            # 匯總按用戶記錄，每個用戶附帶最近的 IP 與 session ID。opaque 令牌的 session ID 就是令牌本身，
+            # 寫入匯總等於把可用的憑證存進另一個集合，所以這裡只記錄 IP；簽名令牌的 sid 不是憑證，
+            # 由 _verify_signed_token 一併記錄
+            activity_rollup.record(record.get('uuid_hash') or hashlib.sha256(record['uuid'].encode()).hexdigest(),
+                                   client_ip=record.get('client_ip'))
+            
+            # 如果快過期了，自動延長（少於5分鐘），順帶更新 last_activity
+            if expires_at and (expires_at - now).total_seconds() < 300:
+                session_timeout = int(os.environ.get('SESSION_TIMEOUT', 3600))
+                update_data = {
+                    'last_activity': now,
+                    'expires_at': now + timedelta(seconds=session_timeout)
+                }
+                logger.debug(f"🔄 Session 自動延長: {token[:16]}...")
+                
+                # 延遲寫入，並同步更新本地記錄
+                self.store.update(token, update_data, uuid=record.get('uuid'))
+                self.counters.session_extended(expires_at, update_data['expires_at'])
+                record.update(update_data)
+                record['_expires_epoch'] = update_data['expires_at'].timestamp()
             
             logger.debug(f"✅ Session 驗證成功: {token[:16]}...")
-            return True, session_data
+            return True, {k: v for k, v in record.items() if not k.startswith('_')}
             
         except Exception as e:
             logger.error(f"❌ 驗證 session 失敗: {str(e)}")
             return False, None
     
+    def _verify_signed_token(self, token: str) -> Tuple[bool, Optional[Dict]]:
+        """驗證簽名令牌：只檢查簽名、過期時間和本地撤銷列表，不做任何 I/O
+
+        簽名令牌的有效期固定在令牌內，不會像 opaque 令牌一樣自動延長。
+        """
+        claims = self.token_codec.decode(token)
+        if claims is None:
+            logger.debug(f"❌ 簽名令牌無效: {token[:16]}...")
+            return False, None
+        
+        if time.time() > claims['exp']:
+            logger.debug(f"❌ 簽名令牌已過期: {claims['sid']}")
+            return False, None
+        
+        if self.revocations.is_revoked(claims['sid'], claims['uh'], claims['iat']):
+            logger.debug(f"❌ 簽名令牌已被撤銷: {claims['sid']}")
+            return False, None
+        
+        activity_rollup.record(claims['uh'], claims['sid'])
+        
+        return True, {
+            'uuid_hash': claims['uh'],
+            'token': claims['sid'],
+            'created_at': datetime.fromtimestamp(claims['iat'] / 1000, tz=timezone.utc),
+            'expires_at': datetime.fromtimestamp(claims['exp'], tz=timezone.utc),
+            'active': True
+        }
+    
     def revoke_session_token(self, token: str) -> bool:
         """撤銷會話令牌"""
         try:
-            if not self.db:
-                logger.error("❌ Firestore 數據庫未初始化")
+            if self.token_codec and is_signed_token(token):
+                claims = self.token_codec.decode(token)
+                if claims is None:
+                    return False
+                self.revocations.revoke_token(claims['sid'], claims['exp'])
+                # 令牌本身已撤銷，再刪除對應的 session 記錄
+                token = claims['sid']
+            
+            if not self._store_ready():
                 return False
             
-            session_ref = self.db.collection(self.collection_name).document(token)
-            session_doc = session_ref.get()
+            self._drop_pending_update(token)
+            invalidation_bus.publish(EVENT_TOKEN, token)
             
-            if session_doc.exists:
-                session_ref.delete()
+            deleted = self.store.delete(token)
+            if deleted is not None:
+                self.counters.session_deleted(deleted.get('expires_at'))
                 logger.info(f"✅ Session 已撤銷: {token[:16]}...")
                 return True
             else:
@@ -180,24 +386,39 @@ class FirestoreSessionManager:
             logger.error(f"❌ 撤銷 session 失敗: {str(e)}")
             return False
     
-    def terminate_user_sessions(self, uuid: str):
-        """終止用戶的所有會話"""
+    def terminate_user_sessions(self, uuid: str, issued_before: Optional[datetime] = None):
+        """終止用戶的所有會話
+
+        issued_before: 只終止在此時間之前創建的會話。異步調用時應傳入調用當下的時間，
+        避免誤刪在終止任務執行前剛創建的新會話。
+        """
         try:
-            if not self.db:
-                logger.error("❌ Firestore 數據庫未初始化")
+            cutoff = issued_before or self._now_utc()
+            
+            if self.revocations:
+                session_timeout = int(os.environ.get('SESSION_TIMEOUT', 3600))
+                uuid_hash = hashlib.sha256(uuid.encode()).hexdigest()
+                self.revocations.revoke_user(uuid_hash, cutoff, session_timeout)
+            
+            if not self._store_ready():
                 return
             
-            # 查詢該用戶的所有 session
-            sessions_ref = self.db.collection(self.collection_name)
-            user_sessions = sessions_ref.where('uuid', '==', uuid).where('active', '==', True).stream()
+            self.session_cache.pop_user(uuid)
             
-            deleted_count = 0
-            for session_doc in user_sessions:
-                try:
-                    session_doc.reference.delete()
-                    deleted_count += 1
-                except Exception as e:
-                    logger.warning(f"刪除 session 失敗: {e}")
+            # 讀取該用戶的 session 索引
+            to_delete = []
+            for doc_id, session_data in self.store.list_user_sessions(uuid, self._now_utc()):
+                created_at = self._parse_datetime(session_data.get('created_at'))
+                if created_at and created_at >= cutoff:
+                    continue
+                self._drop_pending_update(doc_id)
+                self.negative_cache.add(doc_id)
+                to_delete.append((doc_id, session_data))
+            
+            deleted_count = self.store.delete_many(to_delete) if to_delete else 0
+            self._on_sessions_deleted(to_delete)
+            if deleted_count:
+                invalidation_bus.publish(EVENT_USER, hashlib.sha256(uuid.encode()).hexdigest())
             
             logger.info(f"✅ 已終止用戶 {uuid[:8]}... 的 {deleted_count} 個會話")
             
@@ -207,22 +428,11 @@ class FirestoreSessionManager:
     def check_existing_session(self, uuid: str) -> bool:
         """檢查用戶是否有活躍會話"""
         try:
-            if not self.db:
-                logger.error("❌ Firestore 數據庫未初始化")
+            if not self._store_ready():
                 return False
             
-            now = self._now_utc()
-            
             # 查詢活躍且未過期的 session
-            sessions_ref = self.db.collection(self.collection_name)
-            active_sessions = sessions_ref.where('uuid', '==', uuid)\
-                                        .where('active', '==', True)\
-                                        .where('expires_at', '>', now)\
-                                        .limit(1)\
-                                        .stream()
-            
-            # 檢查是否有結果
-            for _ in active_sessions:
+            if self.store.has_active(uuid, self._now_utc()):
                 logger.debug(f"✅ 用戶 {uuid[:8]}... 有活躍會話")
                 return True
             
@@ -233,26 +443,24 @@ class FirestoreSessionManager:
             logger.error(f"❌ 檢查會話失敗: {str(e)}")
             return False
     
-    def cleanup_expired_sessions(self) -> int:
-        """清理過期的會話"""
+    def cleanup_expired_sessions(self, time_budget: Optional[float] = None) -> int:
+        """清理過期的會話 - 每頁最多 500 個，在時間預算內持續分頁直到清空"""
         try:
-            if not self.db:
-                logger.error("❌ Firestore 數據庫未初始化")
+            if not self._store_ready():
                 return 0
             
-            now = self._now_utc()
-            
-            # 查詢過期的 session
-            sessions_ref = self.db.collection(self.collection_name)
-            expired_sessions = sessions_ref.where('expires_at', '<', now).limit(100).stream()
-            
+            budget = time_budget if time_budget is not None else float(os.environ.get('TTL_SWEEP_TIME_BUDGET', 20))
+            deadline = time.time() + budget
             deleted_count = 0
-            for session_doc in expired_sessions:
-                try:
-                    session_doc.reference.delete()
-                    deleted_count += 1
-                except Exception as e:
-                    logger.warning(f"刪除過期 session 失敗: {e}")
+            
+            while True:
+                # 刪除過期的 session
+                expired = self.store.delete_expired(self._now_utc(), limit=MAX_BATCH_SIZE)
+                self._on_sessions_deleted(expired)
+                deleted_count += len(expired)
+                
+                if len(expired) < MAX_BATCH_SIZE or time.time() >= deadline:
+                    break
             
             if deleted_count > 0:
                 logger.info(f"🧹 已清理 {deleted_count} 個過期會話")
@@ -263,52 +471,55 @@ class FirestoreSessionManager:
             logger.error(f"❌ 清理過期會話失敗: {str(e)}")
             return 0
     
+    def _on_sessions_deleted(self, items: List[Tuple[str, Dict]]):
+        """session 刪除後同步本地緩存、延遲寫入與計數器"""
+        for doc_id, session_data in items:
+            self.session_cache.pop(doc_id)
+            self._drop_pending_update(doc_id)
+            self.counters.session_deleted(session_data.get('expires_at'))
+    
+    def handle_swept_sessions(self, items: List[Tuple[str, Dict]]):
+        """TTL 清理器直接刪除 session 文檔後的回調"""
+        self._on_sessions_deleted(items)
+        try:
+            self.store.forget(items)
+        except Exception as e:
+            logger.warning(f"清理 session 索引失敗: {e}")
+    
     def get_session_stats(self) -> Dict:
-        """獲取會話統計"""
+        """獲取會話統計 - 讀取增量維護的計數器，不掃描 session 集合"""
         try:
-            if not self.db:
+            if not self.store.is_ready():
                 return {
-                    'storage_type': 'firestore',
+                    'storage_type': self.store.storage_type,
                     'firestore_connected': False,
                     'error': 'Database not initialized'
                 }
             
             now = self._now_utc()
-            sessions_ref = self.db.collection(self.collection_name)
-            
-            # 計算總會話數
-            total_sessions = 0
-            active_sessions = 0
-            expired_sessions = 0
-            
-            # 獲取所有會話並統計
-            all_sessions = sessions_ref.stream()
-            for session_doc in all_sessions:
-                total_sessions += 1
-                session_data = session_doc.to_dict()
-                
-                expires_at = self._parse_datetime(session_data.get('expires_at'))
-                is_active = session_data.get('active', True)
-                is_expired = expires_at and now > expires_at
-                
-                if is_active and not is_expired:
-                    active_sessions += 1
-                elif is_expired:
-                    expired_sessions += 1
+            counts = self.counters.get_counts(now)
             
             return {
-                'storage_type': 'firestore',
-                'firestore_connected': True,
-                'total_sessions': total_sessions,
-                'active_sessions': active_sessions,
-                'expired_sessions': expired_sessions,
+                'storage_type': self.store.storage_type,
+                'firestore_connected': self.db is not None,
+                'total_sessions': counts['total_sessions'],
+                'active_sessions': counts['active_sessions'],
+                'expired_sessions': counts['expired_sessions'],
+                'counters': self.counters.get_stats(),
+                'token_mode': self.token_mode,
+                'session_cache': self.session_cache.get_stats(),
+                'negative_cache': self.negative_cache.get_stats(),
+                'user_cache': user_cache.get_stats(),
+                'activity_rollup': activity_rollup.get_stats(),
+                'store': self.store.get_metrics(),
+                'revocations': self.revocations.get_stats() if self.revocations else None,
                 'current_time': now.isoformat()
             }
             
         except Exception as e:
             logger.error(f"❌ 獲取會話統計失敗: {str(e)}")
             return {
-                'storage_type': 'firestore',
+                'storage_type': self.store.storage_type,
                 'firestore_connected': False,
                 'error': str(e)
             }
@@ -316,15 +527,11 @@ class FirestoreSessionManager:
     def get_user_sessions(self, uuid: str) -> list:
         """獲取用戶的所有會話"""
         try:
-            if not self.db:
+            if not self.store.is_ready():
                 return []
             
-            sessions_ref = self.db.collection(self.collection_name)
-            user_sessions = sessions_ref.where('uuid', '==', uuid).stream()
-            
             sessions = []
-            for session_doc in user_sessions:
-                session_data = session_doc.to_dict()
+            for _, session_data in self.store.find_by_uuid(uuid):
                 
                 created_at = self._parse_datetime(session_data.get('created_at'))
                 last_activity = self._parse_datetime(session_data.get('last_activity'))
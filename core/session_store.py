@@ -0,0 +1,760 @@
+"""
+session_store.py - Session 存儲後端（Firestore / 進程內記憶體 / SQLite WAL）
+"""
+from abc import ABC, abstractmethod
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from core.user_projection import USERS_COLLECTION, project
+from core.write_behind import WriteBehindFlusher, MAX_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# session 記錄中的時間欄位
+DATETIME_FIELDS = ('created_at', 'expires_at', 'last_activity')
+# session 文檔的全部欄位
+SESSION_FIELDS = ('uuid', 'uuid_hash', 'token', 'client_ip', 'active') + DATETIME_FIELDS
+# 計數分片的文檔 ID 前綴，以及重建計數時的租約文檔 ID
+COUNTER_SHARD_PREFIX = 'shard_'
+COUNTER_LEASE_ID = 'rebuild_lease'
+
+
+def _uuid_hash(data: Dict) -> Optional[str]:
+    """取得 session 記錄所屬用戶的 uuid hash"""
+    if data.get('uuid_hash'):
+        return data['uuid_hash']
+    if data.get('uuid'):
+        return hashlib.sha256(data['uuid'].encode()).hexdigest()
+    return None
+
+
+def _to_epoch(value) -> Optional[float]:
+    """將 datetime / Firestore Timestamp 轉為 epoch 秒"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    if hasattr(value, 'timestamp'):
+        return value.timestamp()
+    return None
+
+
+class SessionStore(ABC):
+    """Session 存儲介面
+
+    doc_id 對 opaque 令牌是令牌本身，對簽名令牌是其中的 session ID。
+    update 為活動時間這類可延遲的寫入，具體後端可以選擇合併後批量寫入。
+    """
+
+    storage_type = 'base'
+
+    @abstractmethod
+    def is_ready(self) -> bool:
+        ...
+
+    @abstractmethod
+    def get(self, doc_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def create(self, doc_id: str, data: Dict):
+        ...
+
+    @abstractmethod
+    def update(self, doc_id: str, fields: Dict, uuid: Optional[str] = None):
+        """uuid: session 所屬用戶，後端維護按用戶索引時用於同步過期時間"""
+        ...
+
+    def discard_update(self, doc_id: str):
+        """丟棄尚未寫入的延遲更新"""
+
+    def flush(self) -> int:
+        """寫入所有延遲更新"""
+        return 0
+
+    @abstractmethod
+    def delete(self, doc_id: str) -> Optional[Dict]:
+        """刪除 session，返回被刪除的記錄（不存在時返回 None）"""
+        ...
+
+    @abstractmethod
+    def delete_many(self, items: List[Tuple[str, Dict]]) -> int:
+        """批量刪除 (doc_id, 記錄)，記錄至少需包含 uuid"""
+        ...
+
+    @abstractmethod
+    def find_by_uuid(self, uuid: str, active_only: bool = False) -> List[Tuple[str, Dict]]:
+        ...
+
+    def list_user_sessions(self, uuid: str, now: datetime) -> List[Tuple[str, Dict]]:
+        """列出用戶未過期的 session（記錄至少包含 uuid、created_at、expires_at）"""
+        now_epoch = now.timestamp()
+        return [(doc_id, data) for doc_id, data in self.find_by_uuid(uuid, active_only=True)
+                if (_to_epoch(data.get('expires_at')) or 0) > now_epoch]
+
+    @abstractmethod
+    def has_active(self, uuid: str, now: datetime) -> bool:
+        ...
+
+    def forget(self, items: List[Tuple[str, Dict]]):
+        """session 已被外部刪除（例如 TTL 清理）後，清理後端的附屬數據"""
+
+    @abstractmethod
+    def delete_expired(self, now: datetime, limit: int = 100) -> List[Tuple[str, Dict]]:
+        """刪除過期 session，返回被刪除的 (doc_id, 記錄)"""
+        ...
+
+    @abstractmethod
+    def iter_all(self) -> Iterator[Tuple[str, Dict]]:
+        ...
+
+    @abstractmethod
+    def put_revocation(self, doc_id: str, data: Dict):
+        ...
+
+    @abstractmethod
+    def load_revocations(self, now: datetime) -> List[Dict]:
+        """載入未過期的撤銷記錄"""
+        ...
+
+    @abstractmethod
+    def apply_counter_deltas(self, shard_id: str, deltas: Dict[str, int]):
+        """將計數增量原子地累加到指定分片"""
+        ...
+
+    @abstractmethod
+    def load_counter_shards(self) -> List[Dict[str, int]]:
+        """讀取所有計數分片"""
+        ...
+
+    @abstractmethod
+    def drop_counter_fields(self, fields: List[str]):
+        """從所有分片中刪除指定欄位"""
+        ...
+
+    @abstractmethod
+    def reset_counters(self, values: Dict[str, int]):
+        """清空所有分片並寫入新的計數（同時釋放重建租約）"""
+        ...
+
+    def acquire_counter_lease(self, owner: str, ttl: int) -> bool:
+        """取得重建計數的租約，同一時間只有一個 worker 能持有；默認實現適用於單進程後端"""
+        return True
+
+    def get_metrics(self) -> Dict:
+        return {}
+
+
+class FirestoreSessionStore(SessionStore):
+    """Firestore 後端（原有行為），活動更新經合併式延遲寫入器批量提交
+
+    每個用戶另有一個索引文檔 user_session_index/{uuid_hash}，tokens 欄位記錄該用戶的
+    session ID 及其創建、過期時間，與 session 文檔在同一個 WriteBatch 中創建和刪除。
+    單會話檢查與強制登入終止只需讀取這一個文檔，不需要複合查詢。
+    索引文檔帶 complete 標記前（例如部署前已存在的 session）會回退到查詢並回填索引。
+    """
+
+    storage_type = 'firestore'
+
+    def __init__(self, collection_name: str = 'user_sessions', revocation_collection: str = 'session_revocations',
+                 counter_collection: str = 'session_counters', index_collection: str = 'user_session_index',
+                 flush_interval: int = 30):
+        self.db = None
+        self.collection_name = collection_name
+        self.revocation_collection = revocation_collection
+        self.counter_collection = counter_collection
+        self.index_collection = index_collection
+        self.activity_writer = WriteBehindFlusher(collection_name, flush_interval=flush_interval)
+
+    def set_db(self, db):
+        self.db = db
+        self.activity_writer.set_db(db)
+
+    def is_ready(self) -> bool:
+        return self.db is not None
+
+    def _ref(self, doc_id: str):
+        return self.db.collection(self.collection_name).document(doc_id)
+
+    def get(self, doc_id):
+        doc = self._ref(doc_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def get_with_user(self, doc_id: str, uuid_hash: str,
+                      user_fields: Optional[List[str]] = None) -> Tuple[Optional[Dict], Optional[Dict]]:
+        """一次 get_all 同時讀取 session 文檔與用戶文檔，返回 (session, 用戶欄位)，不存在的為 None
+
+        欄位遮罩對請求中的所有文檔生效，因此請求兩者的並集，讀取後再各自投影。
+        """
+        session_ref = self._ref(doc_id)
+        user_ref = self.db.collection(USERS_COLLECTION).document(uuid_hash)
+        field_paths = None
+        if user_fields is not None:
+            field_paths = list(SESSION_FIELDS) + [field for field in user_fields if field not in SESSION_FIELDS]
+
+        session_data = user_data = None
+        for doc in self.db.get_all([session_ref, user_ref], field_paths=field_paths):
+            if not doc.exists:
+                continue
+            if doc.reference.path == session_ref.path:
+                session_data = doc.to_dict() or {}
+            else:
+                user_data = project(doc.to_dict() or {}, user_fields)
+        return session_data, user_data
+
+    def _index_ref(self, uuid_hash: str):
+        return self.db.collection(self.index_collection).document(uuid_hash)
+
+    @staticmethod
+    def _index_entry(data: Dict) -> Dict:
+        return {'created_at': data.get('created_at'), 'expires_at': data.get('expires_at')}
+
+    def create(self, doc_id, data):
+        batch = self.db.batch()
+        batch.set(self._ref(doc_id), data)
+        batch.set(self._index_ref(_uuid_hash(data)), {'tokens': {doc_id: self._index_entry(data)}}, merge=True)
+        batch.commit()
+
+    def update(self, doc_id, fields, uuid=None):
+        self.activity_writer.enqueue(self._ref(doc_id), fields)
+        if uuid and 'expires_at' in fields:
+            # 延長過期時間時同步索引；同一用戶多個 session 的更新會合併到同一次寫入
+            field_path = FieldPath('tokens', doc_id, 'expires_at').to_api_repr()
+            self.activity_writer.enqueue(self._index_ref(_uuid_hash({'uuid': uuid})),
+                                         {field_path: fields['expires_at']})
+
+    def discard_update(self, doc_id):
+        if self.db:
+            self.activity_writer.discard(self._ref(doc_id))
+
+    def flush(self):
+        return self.activity_writer.flush()
+
+    def _remove_from_index(self, batch, items: List[Tuple[str, Dict]]):
+        """在批次中從各用戶索引移除指定 session"""
+        by_user = {}
+        for doc_id, data in items:
+            uuid_hash = _uuid_hash(data or {})
+            if uuid_hash:
+                by_user.setdefault(uuid_hash, []).append(doc_id)
+        for uuid_hash, doc_ids in by_user.items():
+            batch.set(self._index_ref(uuid_hash),
+                      {'tokens': {doc_id: firestore.DELETE_FIELD for doc_id in doc_ids}}, merge=True)
+
+    def delete(self, doc_id):
+        doc = self._ref(doc_id).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        self.delete_many([(doc_id, data)])
+        return data
+
+    def delete_many(self, items):
+        deleted = 0
+        # 每個 session 最多佔兩個操作（session 文檔 + 索引文檔）
+        chunk_size = MAX_BATCH_SIZE // 2
+        for i in range(0, len(items), chunk_size):
+            chunk = items[i:i + chunk_size]
+            batch = self.db.batch()
+            for doc_id, _ in chunk:
+                batch.delete(self._ref(doc_id))
+            self._remove_from_index(batch, chunk)
+            batch.commit()
+            deleted += len(chunk)
+        return deleted
+
+    def forget(self, items):
+        chunk_size = MAX_BATCH_SIZE
+        for i in range(0, len(items), chunk_size):
+            batch = self.db.batch()
+            self._remove_from_index(batch, items[i:i + chunk_size])
+            batch.commit()
+
+    def _load_index(self, uuid: str) -> Dict[str, Dict]:
+        """讀取用戶索引；索引尚未完整時查詢 session 集合並回填"""
+        uuid_hash = _uuid_hash({'uuid': uuid})
+        index_doc = self._index_ref(uuid_hash).get()
+        index_data = index_doc.to_dict() if index_doc.exists else {}
+        if index_data.get('complete'):
+            return index_data.get('tokens') or {}
+
+        tokens = {doc_id: self._index_entry(data) for doc_id, data in self.find_by_uuid(uuid, active_only=True)}
+        tokens.update(index_data.get('tokens') or {})
+        self._index_ref(uuid_hash).set({'tokens': tokens, 'complete': True}, merge=True)
+        return tokens
+
+    def list_user_sessions(self, uuid, now):
+        now_epoch = now.timestamp()
+        live, stale = [], []
+        for doc_id, entry in self._load_index(uuid).items():
+            # 沒有 created_at 的條目是 session 刪除後才寫入的延長更新，視為無效
+            if entry.get('created_at') is None or (_to_epoch(entry.get('expires_at')) or 0) <= now_epoch:
+                stale.append(doc_id)
+            else:
+                live.append((doc_id, dict(entry, uuid=uuid)))
+
+        if stale:
+            # 過期的 session 文檔由 TTL 清理器刪除，這裡只順便清理索引條目
+            self._index_ref(_uuid_hash({'uuid': uuid})).set(
+                {'tokens': {doc_id: firestore.DELETE_FIELD for doc_id in stale}}, merge=True
+            )
+        return live
+
+    def find_by_uuid(self, uuid, active_only=False):
+        query = self.db.collection(self.collection_name).where('uuid', '==', uuid)
+        if active_only:
+            query = query.where('active', '==', True)
+        return [(doc.id, doc.to_dict()) for doc in query.stream()]
+
+    def has_active(self, uuid, now):
+        return bool(self.list_user_sessions(uuid, now))
+
+    def delete_expired(self, now, limit=100):
+        expired = self.db.collection(self.collection_name).where('expires_at', '<', now).limit(limit).stream()
+        items = [(doc.id, doc.to_dict()) for doc in expired]
+        for doc_id, _ in items:
+            self.discard_update(doc_id)
+        if items:
+            self.delete_many(items)
+        return items
+
+    def iter_all(self):
+        for doc in self.db.collection(self.collection_name).stream():
+            yield doc.id, doc.to_dict()
+
+    def put_revocation(self, doc_id, data):
+        self.db.collection(self.revocation_collection).document(doc_id).set(data)
+
+    def load_revocations(self, now):
+        docs = self.db.collection(self.revocation_collection).where('expires_at', '>', now).stream()
+        return [doc.to_dict() for doc in docs]
+
+    def apply_counter_deltas(self, shard_id, deltas):
+        self.db.collection(self.counter_collection).document(shard_id).set(
+            {field: firestore.Increment(delta) for field, delta in deltas.items()}, merge=True
+        )
+
+    def load_counter_shards(self):
+        return [doc.to_dict() or {} for doc in self.db.collection(self.counter_collection).stream()
+                if doc.id.startswith(COUNTER_SHARD_PREFIX)]
+
+    def drop_counter_fields(self, fields):
+        batch = self.db.batch()
+        for doc in self.db.collection(self.counter_collection).stream():
+            if doc.id.startswith(COUNTER_SHARD_PREFIX):
+                batch.update(doc.reference, {field: firestore.DELETE_FIELD for field in fields})
+        batch.commit()
+
+    def reset_counters(self, values):
+        batch = self.db.batch()
+        for doc in self.db.collection(self.counter_collection).stream():
+            batch.delete(doc.reference)
+        batch.set(self.db.collection(self.counter_collection).document(f"{COUNTER_SHARD_PREFIX}0"), values)
+        batch.commit()
+
+    def acquire_counter_lease(self, owner, ttl):
+        lease_ref = self.db.collection(self.counter_collection).document(COUNTER_LEASE_ID)
+        now = datetime.now(timezone.utc)
+
+        @firestore.transactional
+        def claim(transaction):
+            snapshot = lease_ref.get(transaction=transaction)
+            if snapshot.exists:
+                lease = snapshot.to_dict() or {}
+                if lease.get('owner') != owner and (_to_epoch(lease.get('expires_at')) or 0) > now.timestamp():
+                    return False
+            transaction.set(lease_ref, {'owner': owner, 'expires_at': now + timedelta(seconds=ttl)})
+            return True
+
+        return claim(self.db.transaction())
+
+    def get_metrics(self):
+        return {'activity_writer': self.activity_writer.get_metrics()}
+
+
+class MemorySessionStore(SessionStore):
+    """進程內記憶體後端
+
+    只適用於單進程部署與本地基準測試：多個 gunicorn worker 之間不共享 session。
+    """
+
+    storage_type = 'memory'
+
+    def __init__(self):
+        self._sessions = {}  # doc_id -> data
+        self._user_index = {}  # uuid -> set(doc_id)
+        self._revocations = {}  # doc_id -> data
+        self._counters = {}  # shard_id -> {field: value}
+        self.lock = threading.RLock()
+
+    def is_ready(self):
+        return True
+
+    def get(self, doc_id):
+        with self.lock:
+            data = self._sessions.get(doc_id)
+            return dict(data) if data is not None else None
+
+    def create(self, doc_id, data):
+        with self.lock:
+            self._sessions[doc_id] = dict(data)
+            self._user_index.setdefault(data.get('uuid'), set()).add(doc_id)
+
+    def update(self, doc_id, fields, uuid=None):
+        with self.lock:
+            if doc_id in self._sessions:
+                self._sessions[doc_id].update(fields)
+
+    def delete(self, doc_id):
+        with self.lock:
+            data = self._sessions.pop(doc_id, None)
+            if data is None:
+                return None
+            uuid = data.get('uuid')
+            doc_ids = self._user_index.get(uuid)
+            if doc_ids is not None:
+                doc_ids.discard(doc_id)
+                if not doc_ids:
+                    del self._user_index[uuid]
+            return data
+
+    def delete_many(self, items):
+        with self.lock:
+            return sum(1 for doc_id, _ in items if self.delete(doc_id) is not None)
+
+    def find_by_uuid(self, uuid, active_only=False):
+        with self.lock:
+            results = []
+            for doc_id in self._user_index.get(uuid, ()):
+                data = self._sessions[doc_id]
+                if active_only and not data.get('active', True):
+                    continue
+                results.append((doc_id, dict(data)))
+            return results
+
+    def has_active(self, uuid, now):
+        now_epoch = now.timestamp()
+        with self.lock:
+            for doc_id in self._user_index.get(uuid, ()):
+                data = self._sessions[doc_id]
+                expires_epoch = _to_epoch(data.get('expires_at'))
+                if data.get('active', True) and expires_epoch and expires_epoch > now_epoch:
+                    return True
+            return False
+
+    def delete_expired(self, now, limit=100):
+        now_epoch = now.timestamp()
+        with self.lock:
+            expired = [doc_id for doc_id, data in self._sessions.items()
+                       if (_to_epoch(data.get('expires_at')) or now_epoch) < now_epoch][:limit]
+            return [(doc_id, self.delete(doc_id)) for doc_id in expired]
+
+    def iter_all(self):
+        with self.lock:
+            items = [(doc_id, dict(data)) for doc_id, data in self._sessions.items()]
+        return iter(items)
+
+    def put_revocation(self, doc_id, data):
+        with self.lock:
+            self._revocations[doc_id] = dict(data)
+
+    def load_revocations(self, now):
+        now_epoch = now.timestamp()
+        with self.lock:
+            return [dict(data) for data in self._revocations.values()
+                    if (_to_epoch(data.get('expires_at')) or 0) > now_epoch]
+
+    def apply_counter_deltas(self, shard_id, deltas):
+        with self.lock:
+            shard = self._counters.setdefault(shard_id, {})
+            for field, delta in deltas.items():
+                shard[field] = shard.get(field, 0) + delta
+
+    def load_counter_shards(self):
+        with self.lock:
+            return [dict(shard) for shard in self._counters.values()]
+
+    def drop_counter_fields(self, fields):
+        with self.lock:
+            for shard in self._counters.values():
+                for field in fields:
+                    shard.pop(field, None)
+
+    def reset_counters(self, values):
+        with self.lock:
+            self._counters = {f"{COUNTER_SHARD_PREFIX}0": dict(values)}
+
+    def get_metrics(self):
+        return {'sessions_in_memory': len(self._sessions)}
+
+
+class SQLiteSessionStore(SessionStore):
+    """本地 SQLite（WAL 模式）後端
+
+    同一台主機上的多個 worker 共享同一個數據庫文件，WAL 模式下讀寫互不阻塞。
+    """
+
+    storage_type = 'sqlite'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._init_schema()
+
+    def _conn(self) -> sqlite3.Connection:
+        """每個線程使用獨立的連接（fork 後的子進程會重新連接）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_schema(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_sessions (
+                doc_id TEXT PRIMARY KEY,
+                uuid TEXT,
+                active INTEGER NOT NULL DEFAULT 1,
+                created_at REAL,
+                expires_at REAL,
+                data TEXT NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_uuid ON user_sessions (uuid, active, expires_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON user_sessions (expires_at)')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS session_revocations (
+                doc_id TEXT PRIMARY KEY,
+                expires_at REAL,
+                data TEXT NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS session_counters (
+                shard_id TEXT NOT NULL,
+                field TEXT NOT NULL,
+                value INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (shard_id, field)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS session_counter_lease (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+
+    @staticmethod
+    def _dumps(data: Dict) -> str:
+        return json.dumps(data, default=lambda v: v.isoformat() if isinstance(v, datetime) else str(v))
+
+    @staticmethod
+    def _loads(text: str) -> Dict:
+        data = json.loads(text)
+        for field in DATETIME_FIELDS:
+            if isinstance(data.get(field), str):
+                try:
+                    data[field] = datetime.fromisoformat(data[field])
+                except ValueError:
+                    pass
+        return data
+
+    def is_ready(self):
+        return True
+
+    def get(self, doc_id):
+        row = self._conn().execute('SELECT data FROM user_sessions WHERE doc_id = ?', (doc_id,)).fetchone()
+        return self._loads(row[0]) if row else None
+
+    def create(self, doc_id, data):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO user_sessions (doc_id, uuid, active, created_at, expires_at, data) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (doc_id, data.get('uuid'), 1 if data.get('active', True) else 0,
+             _to_epoch(data.get('created_at')), _to_epoch(data.get('expires_at')), self._dumps(data))
+        )
+
+    def update(self, doc_id, fields, uuid=None):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM user_sessions WHERE doc_id = ?', (doc_id,)).fetchone()
+            if row:
+                data = self._loads(row[0])
+                data.update(fields)
+                conn.execute(
+                    'UPDATE user_sessions SET active = ?, expires_at = ?, data = ? WHERE doc_id = ?',
+                    (1 if data.get('active', True) else 0, _to_epoch(data.get('expires_at')),
+                     self._dumps(data), doc_id)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete(self, doc_id):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM user_sessions WHERE doc_id = ?', (doc_id,)).fetchone()
+            if row:
+                conn.execute('DELETE FROM user_sessions WHERE doc_id = ?', (doc_id,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return self._loads(row[0]) if row else None
+
+    def delete_many(self, items):
+        if not items:
+            return 0
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = conn.executemany('DELETE FROM user_sessions WHERE doc_id = ?', [(d,) for d, _ in items])
+            conn.execute('COMMIT')
+            return cursor.rowcount
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def find_by_uuid(self, uuid, active_only=False):
+        sql = 'SELECT doc_id, data FROM user_sessions WHERE uuid = ?'
+        if active_only:
+            sql += ' AND active = 1'
+        rows = self._conn().execute(sql, (uuid,)).fetchall()
+        return [(doc_id, self._loads(data)) for doc_id, data in rows]
+
+    def has_active(self, uuid, now):
+        row = self._conn().execute(
+            'SELECT 1 FROM user_sessions WHERE uuid = ? AND active = 1 AND expires_at > ? LIMIT 1',
+            (uuid, now.timestamp())
+        ).fetchone()
+        return row is not None
+
+    def delete_expired(self, now, limit=100):
+        rows = self._conn().execute(
+            'SELECT doc_id, data FROM user_sessions WHERE expires_at < ? LIMIT ?', (now.timestamp(), limit)
+        ).fetchall()
+        items = [(doc_id, self._loads(data)) for doc_id, data in rows]
+        self.delete_many(items)
+        return items
+
+    def iter_all(self):
+        for doc_id, data in self._conn().execute('SELECT doc_id, data FROM user_sessions'):
+            yield doc_id, self._loads(data)
+
+    def put_revocation(self, doc_id, data):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO session_revocations (doc_id, expires_at, data) VALUES (?, ?, ?)',
+            (doc_id, _to_epoch(data.get('expires_at')), self._dumps(data))
+        )
+
+    def load_revocations(self, now):
+        conn = self._conn()
+        conn.execute('DELETE FROM session_revocations WHERE expires_at <= ?', (now.timestamp(),))
+        rows = conn.execute('SELECT data FROM session_revocations').fetchall()
+        results = []
+        for (text,) in rows:
+            data = json.loads(text)
+            if isinstance(data.get('expires_at'), str):
+                data['expires_at'] = datetime.fromisoformat(data['expires_at'])
+            results.append(data)
+        return results
+
+    def apply_counter_deltas(self, shard_id, deltas):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT INTO session_counters (shard_id, field, value) VALUES (?, ?, ?) '
+                'ON CONFLICT (shard_id, field) DO UPDATE SET value = value + excluded.value',
+                [(shard_id, field, delta) for field, delta in deltas.items()]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def load_counter_shards(self):
+        shards = {}
+        for shard_id, field, value in self._conn().execute('SELECT shard_id, field, value FROM session_counters'):
+            shards.setdefault(shard_id, {})[field] = value
+        return list(shards.values())
+
+    def drop_counter_fields(self, fields):
+        self._conn().executemany('DELETE FROM session_counters WHERE field = ?', [(f,) for f in fields])
+
+    def reset_counters(self, values):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM session_counters')
+            conn.executemany(
+                'INSERT INTO session_counters (shard_id, field, value) VALUES (?, ?, ?)',
+                [(f"{COUNTER_SHARD_PREFIX}0", field, value) for field, value in values.items()]
+            )
+            conn.execute('DELETE FROM session_counter_lease')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def acquire_counter_lease(self, owner, ttl):
+        conn = self._conn()
+        now = datetime.now(timezone.utc).timestamp()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT owner, expires_at FROM session_counter_lease WHERE id = 0').fetchone()
+            acquired = row is None or row[0] == owner or row[1] <= now
+            if acquired:
+                conn.execute('INSERT OR REPLACE INTO session_counter_lease (id, owner, expires_at) VALUES (0, ?, ?)',
+                             (owner, now + ttl))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return acquired
+
+    def get_metrics(self):
+        return {'sqlite_path': self.path}
+
+
+def create_session_store(backend: Optional[str] = None) -> SessionStore:
+    """根據配置創建 session 存儲後端（SESSION_STORE_BACKEND: firestore / memory / sqlite）"""
+    backend = (backend or os.environ.get('SESSION_STORE_BACKEND', 'firestore')).lower()
+
+    if backend == 'memory':
+        logger.warning("⚠️ 使用進程內記憶體 session 存儲，多個 worker 之間不共享 session")
+        return MemorySessionStore()
+
+    if backend == 'sqlite':
+        path = os.environ.get('SESSION_SQLITE_PATH', '/tmp/scrilab_sessions.db')
+        logger.info(f"🗄️ 使用 SQLite session 存儲: {path}")
+        return SQLiteSessionStore(path)
+
+    if backend != 'firestore':
+        logger.warning(f"⚠️ 未知的 session 存儲後端 '{backend}'，改用 Firestore")
+
+    return FirestoreSessionStore(flush_interval=int(os.environ.get('SESSION_FLUSH_INTERVAL', 30)))
@@ -0,0 +1,257 @@
+"""
+session_tokens.py - HMAC 簽名的無狀態 Session 令牌、opaque 令牌格式與撤銷列表
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from core.shutdown import register_shutdown_hook
+
+logger = logging.getLogger(__name__)
+
+SIGNED_TOKEN_PREFIX = 'st1.'
+SIGNED_TOKEN_MAX_LENGTH = 512
+# opaque 令牌：43 字符隨機部分 + '.' + 43 字符加密的 uuid hash；舊格式只有隨機部分
+OPAQUE_TOKEN_MAX_LENGTH = 100
+OPAQUE_HINT_CONTEXT = b'opaque-user-hint:'
+
+
+def is_signed_token(token: str) -> bool:
+    """判斷是否為簽名令牌格式"""
+    return isinstance(token, str) and token.startswith(SIGNED_TOKEN_PREFIX)
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text: str) -> bytes:
+    padding = '=' * (-len(text) % 4)
+    return base64.urlsafe_b64decode(text + padding)
+
+
+def _hint_mask(hint_key: bytes, random_part: str) -> bytes:
+    """以令牌的隨機部分為 nonce，由伺服器密鑰派生 32 字節掩碼"""
+    return hmac.new(hint_key, OPAQUE_HINT_CONTEXT + random_part.encode('ascii'), hashlib.sha256).digest()
+
+
+def new_opaque_token(uuid_hash: str, hint_key: Optional[bytes] = None) -> str:
+    """生成 opaque 令牌：<base64url(32 隨機字節)>.<base64url(uuid hash XOR 掩碼)>
+
+    令牌本身仍是 session 文檔 ID；附帶的 uuid hash 讓驗證時不必先讀 session
+    就能確定用戶文檔位置，兩個文檔可以在同一次 get_all 中讀取。uuid hash 用每個令牌
+    不同的掩碼加密，沒有密鑰時無法從令牌關聯到用戶；未配置密鑰時只生成隨機部分。
+    """
+    random_part = secrets.token_urlsafe(32)
+    if not hint_key:
+        return random_part
+    masked = bytes(a ^ b for a, b in zip(bytes.fromhex(uuid_hash), _hint_mask(hint_key, random_part)))
+    return f"{random_part}.{_b64encode(masked)}"
+
+
+def opaque_token_user_hash(token: str, hint_key: Optional[bytes] = None) -> Optional[str]:
+    """解出 opaque 令牌附帶的 uuid hash，簽名令牌、舊格式令牌或未配置密鑰時返回 None
+
+    結果僅作讀取提示，需與 session 記錄核對（密鑰更換後解出的值不會匹配）。
+    """
+    if not hint_key or not isinstance(token, str) or is_signed_token(token):
+        return None
+    random_part, separator, hint = token.partition('.')
+    if not separator or len(hint) != 43:
+        return None
+    try:
+        raw = _b64decode(hint)
+        mask = _hint_mask(hint_key, random_part)
+    except Exception:
+        return None
+    if len(raw) != 32:
+        return None
+    return bytes(a ^ b for a, b in zip(raw, mask)).hex()
+
+
+class SignedTokenCodec:
+    """簽名令牌編解碼器
+
+    令牌格式：st1.<base64url(payload)>.<base64url(HMAC-SHA256)>
+    payload 包含 sid（session ID）、uh（uuid hash）、iat（毫秒）、exp（秒）。
+    令牌中只攜帶 uuid 的 hash，不攜帶原始序號本身。
+    """
+
+    def __init__(self, secret: str):
+        if not secret:
+            raise ValueError("Signing secret is required")
+        self._key = secret.encode('utf-8')
+
+    def _sign(self, signing_input: str) -> str:
+        digest = hmac.new(self._key, signing_input.encode('ascii'), hashlib.sha256).digest()
+        return _b64encode(digest)
+
+    def encode(self, uuid_hash: str, session_timeout: int) -> Dict:
+        """簽發新令牌，返回令牌字符串及其聲明"""
+        now = time.time()
+        claims = {
+            'sid': secrets.token_urlsafe(12),
+            'uh': uuid_hash,
+            'iat': int(now * 1000),
+            'exp': int(now) + session_timeout
+        }
+        payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+        signing_input = SIGNED_TOKEN_PREFIX + payload
+        return {
+            'token': f"{signing_input}.{self._sign(signing_input)}",
+            'claims': claims
+        }
+
+    def decode(self, token: str) -> Optional[Dict]:
+        """驗證簽名並解出聲明，簽名或格式無效時返回 None（不檢查過期）"""
+        if not is_signed_token(token) or len(token) > SIGNED_TOKEN_MAX_LENGTH:
+            return None
+
+        try:
+            signing_input, signature = token.rsplit('.', 1)
+            if not hmac.compare_digest(signature, self._sign(signing_input)):
+                return None
+
+            claims = json.loads(_b64decode(signing_input[len(SIGNED_TOKEN_PREFIX):]))
+            if not all(key in claims for key in ('sid', 'uh', 'iat', 'exp')):
+                return None
+            return claims
+        except Exception:
+            return None
+
+
+class RevocationList:
+    """簽名令牌的撤銷列表
+
+    本地保存被撤銷的 session ID 以及按用戶撤銷的時間點，並定期從 session 存儲
+    刷新其他 worker / 實例寫入的撤銷記錄。驗證時只查本地字典，不做任何 I/O。
+    """
+
+    def __init__(self, refresh_interval: int = 10):
+        self.store = None
+        self.refresh_interval = refresh_interval
+        self._revoked_tokens = {}  # sid -> 令牌過期時間 (epoch 秒)
+        self._revoked_users = {}  # uuid_hash -> (revoked_before 毫秒, 記錄過期時間 epoch 秒)
+        self.lock = threading.RLock()
+        self.last_refresh = 0
+        self._stop = threading.Event()
+        self._refresh_thread = None
+
+        register_shutdown_hook(self.stop, name='revocation-refresh')
+
+    def set_store(self, store):
+        """設置持久化用的 session 存儲並啟動刷新線程"""
+        self.store = store
+        self.refresh()
+
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(self.refresh_interval):
+                self.refresh()
+
+        self._refresh_thread = threading.Thread(target=run, name='revocation-refresh', daemon=True)
+        self._refresh_thread.start()
+
+    def stop(self):
+        """停止刷新線程"""
+        self._stop.set()
+        if self._refresh_thread and self._refresh_thread is not threading.current_thread():
+            self._refresh_thread.join(timeout=5)
+
+    def revoke_token(self, sid: str, expires_epoch: int):
+        """撤銷單個令牌"""
+        with self.lock:
+            self._revoked_tokens[sid] = expires_epoch
+
+        self._persist(sid, {
+            'kind': 'token',
+            'sid': sid,
+            'expires_at': datetime.fromtimestamp(expires_epoch, tz=timezone.utc)
+        })
+
+    def revoke_user(self, uuid_hash: str, revoked_before: datetime, max_session_timeout: int):
+        """撤銷某用戶在指定時間點之前簽發的所有令牌"""
+        revoked_before_ms = int(revoked_before.timestamp() * 1000)
+        expires_epoch = int(revoked_before.timestamp()) + max_session_timeout
+
+        with self.lock:
+            current = self._revoked_users.get(uuid_hash)
+            if current and current[0] >= revoked_before_ms:
+                return
+            self._revoked_users[uuid_hash] = (revoked_before_ms, expires_epoch)
+
+        self._persist(f"user_{uuid_hash}", {
+            'kind': 'user',
+            'uuid_hash': uuid_hash,
+            'revoked_before_ms': revoked_before_ms,
+            'expires_at': revoked_before + timedelta(seconds=max_session_timeout)
+        })
+
+    def is_revoked(self, sid: str, uuid_hash: str, issued_at_ms: int) -> bool:
+        """檢查令牌是否已被撤銷"""
+        with self.lock:
+            if sid in self._revoked_tokens:
+                return True
+            user_entry = self._revoked_users.get(uuid_hash)
+            return bool(user_entry and issued_at_ms < user_entry[0])
+
+    def _persist(self, doc_id: str, data: Dict):
+        """寫入 session 存儲，讓其他 worker 在下次刷新時看到"""
+        if not self.store or not self.store.is_ready():
+            return
+        try:
+            self.store.put_revocation(doc_id, data)
+        except Exception as e:
+            logger.error(f"❌ 寫入撤銷記錄失敗: {str(e)}")
+
+    def refresh(self):
+        """從 session 存儲重新載入未過期的撤銷記錄，並清理本地過期條目"""
+        now = time.time()
+
+        remote_tokens = {}
+        remote_users = {}
+        if self.store and self.store.is_ready():
+            try:
+                now_dt = datetime.fromtimestamp(now, tz=timezone.utc)
+                for data in self.store.load_revocations(now_dt):
+                    expires_at = data.get('expires_at')
+                    expires_epoch = int(expires_at.timestamp()) if hasattr(expires_at, 'timestamp') else int(now)
+                    if data.get('kind') == 'user':
+                        remote_users[data.get('uuid_hash')] = (data.get('revoked_before_ms', 0), expires_epoch)
+                    else:
+                        remote_tokens[data.get('sid')] = expires_epoch
+            except Exception as e:
+                logger.warning(f"刷新撤銷列表失敗: {e}")
+
+        with self.lock:
+            for sid, expires_epoch in remote_tokens.items():
+                self._revoked_tokens[sid] = expires_epoch
+            for uuid_hash, entry in remote_users.items():
+                current = self._revoked_users.get(uuid_hash)
+                if not current or current[0] < entry[0]:
+                    self._revoked_users[uuid_hash] = entry
+
+            self._revoked_tokens = {sid: exp for sid, exp in self._revoked_tokens.items() if exp > now}
+            self._revoked_users = {h: entry for h, entry in self._revoked_users.items() if entry[1] > now}
+            self.last_refresh = now
+
+    def get_stats(self) -> Dict:
+        """獲取撤銷列表統計"""
+        with self.lock:
+            return {
+                'revoked_tokens': len(self._revoked_tokens),
+                'revoked_users': len(self._revoked_users),
+                'refresh_interval': self.refresh_interval,
+                'last_refresh': datetime.fromtimestamp(self.last_refresh).isoformat() if self.last_refresh else None
+            }
@@ -0,0 +1,87 @@
+"""
+shutdown.py - 進程關閉鉤子（SIGTERM / 正常退出時刷新緩衝數據）
+"""
+import atexit
+import logging
+import signal
+import sys
+import threading
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+_hooks = []
+_hooks_lock = threading.Lock()
+_run_lock = threading.Lock()
+_hooks_ran = False
+_installed = False
+_previous_sigterm_handler = None
+
+# SIGTERM 且沒有上層處理器時，最多等待鉤子執行的秒數
+SHUTDOWN_TIMEOUT = 10
+
+
+def register_shutdown_hook(hook: Callable[[], object], name: str = None, first: bool = False):
+    """註冊一個在進程關閉時執行的鉤子（按註冊順序執行，每個只執行一次；first 為 True 時排在已註冊鉤子之前）"""
+    entry = (name or getattr(hook, '__qualname__', repr(hook)), hook)
+    with _hooks_lock:
+        if first:
+            _hooks.insert(0, entry)
+        else:
+            _hooks.append(entry)
+    _install()
+
+
+def run_shutdown_hooks():
+    """執行所有關閉鉤子，可安全地重複調用"""
+    global _hooks_ran
+
+    with _run_lock:
+        if _hooks_ran:
+            return
+        _hooks_ran = True
+
+        with _hooks_lock:
+            hooks = list(_hooks)
+
+        for name, hook in hooks:
+            try:
+                hook()
+                logger.info(f"✅ 關閉鉤子已執行: {name}")
+            except Exception as e:
+                logger.error(f"❌ 關閉鉤子執行失敗 {name}: {str(e)}")
+
+
+def _handle_sigterm(signum, frame):
+    """SIGTERM 處理：在獨立線程中執行鉤子，避免與主線程持有的鎖死鎖"""
+    worker = threading.Thread(target=run_shutdown_hooks, name='shutdown-hooks', daemon=True)
+    worker.start()
+
+    previous = _previous_sigterm_handler
+    if callable(previous):
+        # 例如 gunicorn worker 的優雅關閉處理器；進程退出前 atexit 會等待鉤子完成
+        previous(signum, frame)
+        return
+
+    worker.join(SHUTDOWN_TIMEOUT)
+    if previous == signal.SIG_IGN:
+        return
+    sys.exit(128 + signum)
+
+
+def _install():
+    """安裝 atexit 與 SIGTERM 處理器（只安裝一次）"""
+    global _installed, _previous_sigterm_handler
+
+    if _installed:
+        return
+    _installed = True
+
+    atexit.register(run_shutdown_hooks)
+
+    try:
+        _previous_sigterm_handler = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, _handle_sigterm)
+    except ValueError:
+        # 只能在主線程安裝信號處理器，其他情況依賴 atexit
+        logger.debug("非主線程，跳過 SIGTERM 處理器安裝")
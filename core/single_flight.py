@@ -0,0 +1,80 @@
+"""
+single_flight.py - 同鍵並發請求合併（同一時刻只執行一次，其他調用者共享結果）
+"""
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class _Call:
+    """一次進行中的調用"""
+
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """同鍵並發調用合併器
+
+    同一個 key 在執行期間到達的調用不會再次執行 fn，而是等待第一個調用（leader）
+    完成後共享其結果或異常。調用完成即移除，不緩存結果。
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> _Call
+        self.lock = threading.Lock()
+
+        self.executions = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """執行 fn 或等待同鍵的進行中調用，返回 (結果, 是否為共享結果)"""
+        with self.lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executions += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+        return call.result, False
+
+    def __len__(self):
+        return len(self._calls)
+
+    def get_stats(self) -> Dict:
+        """獲取合併統計"""
+        total = self.executions + self.coalesced
+        return {
+            'in_flight': len(self._calls),
+            'executions': self.executions,
+            'coalesced': self.coalesced,
+            'max_waiters': self.max_waiters,
+            'coalesce_rate': (self.coalesced / total * 100) if total > 0 else 0
+        }
@@ -0,0 +1,64 @@
+"""
+striped_lock.py - 分段鎖（按鍵映射到固定數量的鎖，只有同一分段的鍵互相等待）
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Hashable
+
+
+class StripedLock:
+    """分段鎖
+
+    鍵經哈希映射到 stripes 個鎖之一：同一個鍵總是使用同一把鎖，不同鍵大多落在不同的鎖上，
+    只在哈希衝突時才互相等待。鎖的數量固定，不隨鍵的數量增長，也不需要清理。
+    stripes 為 1 時等同於一把全局鎖。
+    """
+
+    def __init__(self, stripes: int = 64, reentrant: bool = False):
+        self.stripes = max(1, stripes)
+        factory = threading.RLock if reentrant else threading.Lock
+        self._locks = [factory() for _ in range(self.stripes)]
+        self._stats_lock = threading.Lock()
+
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def lock_for(self, key: Hashable):
+        """鍵對應的鎖"""
+        return self._locks[hash(key) % self.stripes]
+
+    @contextmanager
+    def hold(self, key: Hashable):
+        """持有鍵對應的鎖，並記錄是否需要等待"""
+        lock = self.lock_for(key)
+        if lock.acquire(blocking=False):
+            waited = None
+        else:
+            start = time.perf_counter()
+            lock.acquire()
+            waited = time.perf_counter() - start
+        try:
+            with self._stats_lock:
+                self.acquisitions += 1
+                if waited is not None:
+                    self.contended += 1
+                    self.total_wait += waited
+                    self.max_wait = max(self.max_wait, waited)
+            yield
+        finally:
+            lock.release()
+
+    def get_stats(self) -> Dict:
+        """獲取鎖統計"""
+        with self._stats_lock:
+            return {
+                'stripes': self.stripes,
+                'acquisitions': self.acquisitions,
+                'contended': self.contended,
+                'contention_rate': (self.contended / self.acquisitions * 100) if self.acquisitions else 0,
+                'avg_wait_ms': round(self.total_wait / self.contended * 1000, 3) if self.contended else 0,
+                'max_wait_ms': round(self.max_wait * 1000, 3)
+            }
@@ -0,0 +1,222 @@
+"""
+ttl_cache.py - 通用的有界緩存（LRU + 逐條 TTL，條目數與字節上限，可選過期後先返回舊值再後台刷新）
+"""
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from core.job_executor import job_executor, QUEUE_CACHE_REFRESH
+from core.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_size(value, _depth: int = 0) -> int:
+    """粗略估計值佔用的字節數（遞歸計入容器內容，深度有限）"""
+    size = sys.getsizeof(value)
+    if _depth >= 4:
+        return size
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += estimate_size(key, _depth + 1) + estimate_size(item, _depth + 1)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += estimate_size(item, _depth + 1)
+    return size
+
+
+class TTLCache:
+    """有界 LRU + TTL 緩存
+
+    條目按最近使用順序存放在 OrderedDict 中，讀取、寫入、淘汰都是 O(1)：超過 max_size 條或
+    max_bytes 字節時從最久未使用的一端淘汰，不需要定期排序或全量掃描。每個條目可以有自己的 TTL，
+    過期條目在讀取時移除，寫入時順帶清理最久未使用一端的過期條目。
+
+    stale_while_revalidate 秒大於 0 時，經 get_or_load 讀取已過期但仍在這個寬限期內的條目會
+    直接返回舊值，並在任務執行器的 cache_refresh 隊列中後台刷新（同一鍵同時只刷新一次）；
+    完全沒有或超出寬限期時同步加載，同一鍵的並發加載只執行一次。
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 300, max_bytes: Optional[int] = None,
+                 stale_while_revalidate: float = 0, sizeof: Callable[[Any], int] = estimate_size,
+                 name: str = 'cache'):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stale_while_revalidate = stale_while_revalidate
+        self.sizeof = sizeof
+
+        self._entries = OrderedDict()  # key -> (value, 過期時間, 寬限期結束時間, 字節數)
+        self._bytes = 0
+        self._refreshing = set()
+        self._flight = SingleFlight()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.oversized = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def _lookup(self, key: Hashable, now: float):
+        """返回 (條目, 是否新鮮)；過期且超出寬限期的條目被移除（調用方需持有鎖）"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, False
+        if now < entry[1]:
+            self._entries.move_to_end(key)
+            return entry, True
+        if now < entry[2]:
+            return entry, False
+        self._remove(key)
+        self.expirations += 1
+        return None, False
+
+    def get(self, key: Hashable, default=None):
+        """讀取未過期的值，不存在或已過期返回 default"""
+        with self.lock:
+            entry, fresh = self._lookup(key, time.time())
+            if fresh:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return default
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            return self._lookup(key, time.time())[1]
+
+    def set(self, key: Hashable, value, ttl: Optional[float] = None):
+        """寫入值，ttl 為 None 時使用默認 TTL"""
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        size = self.sizeof(value) if self.max_bytes else 0
+
+        with self.lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes and size > self.max_bytes:
+                # 單個值已超過字節上限，不緩存
+                self.oversized += 1
+                return
+
+            self._entries[key] = (value, expires_at, expires_at + self.stale_while_revalidate, size)
+            self._bytes += size
+            self._purge_head(now)
+            while len(self._entries) > self.max_size or (self.max_bytes and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _purge_head(self, now: float, limit: int = 2):
+        """清理最久未使用一端已超出寬限期的條目（每次寫入最多 limit 個，攤銷 O(1)）"""
+        for _ in range(limit):
+            if len(self._entries) <= 1:
+                return
+            key, entry = next(iter(self._entries.items()))
+            if now < entry[2]:
+                return
+            self._remove(key)
+            self.expirations += 1
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float] = None):
+        """讀取值，未命中時調用 loader 加載並寫入緩存"""
+        with self.lock:
+            entry, fresh = self._lookup(key, time.time())
+            if fresh:
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self.stale_hits += 1
+                refresh = key not in self._refreshing
+                if refresh:
+                    self._refreshing.add(key)
+            else:
+                self.misses += 1
+
+        if entry is not None:
+            if refresh and job_executor.submit(QUEUE_CACHE_REFRESH, self._refresh, key, loader, ttl) is None:
+                with self.lock:
+                    self._refreshing.discard(key)
+            return entry[0]
+
+        value, shared = self._flight.do(key, loader)
+        if not shared:
+            self.set(key, value, ttl)
+        return value
+
+    def _refresh(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float]):
+        """後台刷新：失敗時保留舊值，直到寬限期結束"""
+        try:
+            value = loader()
+        except Exception as e:
+            with self.lock:
+                self.refresh_failures += 1
+            logger.warning(f"緩存 {self.name} 後台刷新失敗: {str(e)}")
+        else:
+            self.set(key, value, ttl)
+            with self.lock:
+                self.refreshes += 1
+        finally:
+            with self.lock:
+                self._refreshing.discard(key)
+
+    def pop(self, key: Hashable, default=None):
+        """移除條目，返回其值（不論是否過期）"""
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry[0]
+
+    def purge_expired(self) -> int:
+        """移除所有已超出寬限期的條目（全量掃描），返回移除數"""
+        now = time.time()
+        with self.lock:
+            expired = [key for key, entry in self._entries.items() if now >= entry[2]]
+            for key in expired:
+                self._remove(key)
+            self.expirations += len(expired)
+            return len(expired)
+
+    def clear(self):
+        """清空緩存"""
+        with self.lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key: Hashable):
+        """移除條目並更新字節數（調用方需持有鎖）"""
+        self._bytes -= self._entries.pop(key)[3]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self) -> Dict:
+        """獲取緩存統計"""
+        with self.lock:
+            total = self.hits + self.stale_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'bytes': self._bytes if self.max_bytes else None,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'stale_while_revalidate': self.stale_while_revalidate,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'oversized': self.oversized,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures,
+                'hit_rate': ((self.hits + self.stale_hits) / total * 100) if total > 0 else 0
+            }
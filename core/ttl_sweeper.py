@@ -0,0 +1,172 @@
+"""
+ttl_sweeper.py - 通用 TTL 清理器（游標分頁 + WriteBatch 批量刪除 + 每輪時間預算）
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from core.write_behind import MAX_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class SweepTarget:
+    """一個需要清理的集合：field 早於 (現在 - retention) 的文檔會被刪除"""
+
+    def __init__(self, collection: str, field: str = 'expires_at', retention: timedelta = timedelta(0),
+                 page_size: int = MAX_BATCH_SIZE,
+                 on_delete: Optional[Callable[[List[Tuple[str, Dict]]], None]] = None):
+        self.collection = collection
+        self.field = field
+        self.retention = retention
+        self.page_size = min(page_size, MAX_BATCH_SIZE)
+        self.on_delete = on_delete
+
+        self.cursor = None  # 上一頁最後一個文檔快照，下輪從此處繼續
+        self.runs = 0
+        self.deleted_total = 0
+        self.last_deleted = 0
+        self.last_duration = 0.0
+        self.last_run_at = None
+        self.drained = False
+        self.errors = 0
+
+    def get_stats(self) -> Dict:
+        return {
+            'field': self.field,
+            'retention_seconds': int(self.retention.total_seconds()),
+            'runs': self.runs,
+            'deleted_total': self.deleted_total,
+            'last_deleted': self.last_deleted,
+            'last_duration_ms': round(self.last_duration * 1000, 2),
+            'last_throughput_per_sec': round(self.last_deleted / self.last_duration, 2) if self.last_duration else 0,
+            'drained': self.drained,
+            'resuming': self.cursor is not None,
+            'errors': self.errors,
+            'last_run_at': datetime.fromtimestamp(self.last_run_at).isoformat() if self.last_run_at else None
+        }
+
+
+class TTLSweeper:
+    """通用 TTL 清理器
+
+    每個集合按過期欄位排序分頁讀取，每頁以一個 WriteBatch 刪除。一輪清理受時間預算限制，
+    預算用完時保存游標，下一輪從游標處繼續；讀到不滿一頁即視為已清空並重置游標。
+    """
+
+    def __init__(self, time_budget: float = 20.0):
+        self.db = None
+        self.time_budget = time_budget
+        self.targets = {}  # 名稱 -> SweepTarget
+        self.lock = threading.Lock()
+
+    def set_db(self, db):
+        """設置 Firestore 數據庫實例"""
+        self.db = db
+
+    def register(self, name: str, collection: Optional[str] = None, field: str = 'expires_at',
+                 retention: timedelta = timedelta(0), page_size: int = MAX_BATCH_SIZE,
+                 on_delete: Optional[Callable[[List[Tuple[str, Dict]]], None]] = None) -> SweepTarget:
+        """註冊清理目標（同名重複註冊會覆蓋）"""
+        target = SweepTarget(collection or name, field, retention, page_size, on_delete)
+        self.targets[name] = target
+        return target
+
+    def sweep(self, name: str, time_budget: Optional[float] = None) -> int:
+        """清理單個目標，返回本輪刪除的文檔數"""
+        target = self.targets[name]
+        budget = self.time_budget if time_budget is None else time_budget
+        deadline = time.time() + budget
+
+        start_time = time.time()
+        deleted = 0
+        target.drained = False
+        cutoff = datetime.now(timezone.utc) - target.retention
+
+        try:
+            while time.time() < deadline:
+                query = self.db.collection(target.collection)\
+                               .where(target.field, '<', cutoff)\
+                               .order_by(target.field)\
+                               .limit(target.page_size)
+                if target.cursor is not None:
+                    query = query.start_after(target.cursor)
+
+                docs = list(query.stream())
+                if docs:
+                    batch = self.db.batch()
+                    for doc in docs:
+                        batch.delete(doc.reference)
+                    batch.commit()
+                    deleted += len(docs)
+
+                    if target.on_delete:
+                        try:
+                            target.on_delete([(doc.id, doc.to_dict()) for doc in docs])
+                        except Exception as e:
+                            logger.warning(f"[{name}] 清理回調失敗: {e}")
+
+                if len(docs) < target.page_size:
+                    target.cursor = None
+                    target.drained = True
+                    break
+                target.cursor = docs[-1]
+
+        except Exception as e:
+            target.errors += 1
+            logger.error(f"❌ [{name}] TTL 清理失敗: {str(e)}")
+
+        target.runs += 1
+        target.deleted_total += deleted
+        target.last_deleted = deleted
+        target.last_duration = time.time() - start_time
+        target.last_run_at = time.time()
+
+        if deleted > 0:
+            logger.info(f"🧹 [{name}] 清理了 {deleted} 個過期文檔，耗時 {target.last_duration:.2f}s"
+                        f"{'' if target.drained else '（未清完，下輪繼續）'}")
+        return deleted
+
+    def run(self, time_budget: Optional[float] = None) -> Dict[str, int]:
+        """依次清理所有目標，總耗時不超過時間預算；返回各目標刪除數"""
+        if self.db is None:
+            return {}
+
+        if not self.lock.acquire(blocking=False):
+            logger.debug("TTL 清理正在進行中，跳過本輪")
+            return {}
+
+        try:
+            budget = self.time_budget if time_budget is None else time_budget
+            deadline = time.time() + budget
+            results = {}
+            names = list(self.targets)
+            for index, name in enumerate(names):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                # 把剩餘預算平均分給尚未清理的目標，避免某個大集合佔滿整輪
+                results[name] = self.sweep(name, remaining / (len(names) - index))
+            return results
+        finally:
+            self.lock.release()
+
+    def get_stats(self) -> Dict:
+        """獲取各目標的清理統計"""
+        return {
+            'time_budget': self.time_budget,
+            'targets': {name: target.get_stats() for name, target in self.targets.items()}
+        }
+
+
+# 全局 TTL 清理器實例
+ttl_sweeper = TTLSweeper(time_budget=float(os.environ.get('TTL_SWEEP_TIME_BUDGET', 20)))
+
+
+def init_ttl_sweeper(db):
+    """初始化 TTL 清理器"""
+    ttl_sweeper.set_db(db)
+    return ttl_sweeper
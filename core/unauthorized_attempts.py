@@ -0,0 +1,271 @@
+"""
+unauthorized_attempts.py - 未授權登入嘗試的分鐘窗口匯總（按 IP + uuid hash 前綴聚合，批量寫入）
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from firebase_admin import firestore
+
+from core.shutdown import register_shutdown_hook
+from core.write_behind import MAX_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'unauthorized_attempt_windows'
+# 每個窗口最多保留的不同 User-Agent 數
+MAX_USER_AGENTS = 5
+
+
+def _minute_key(epoch_minute: int) -> str:
+    return datetime.fromtimestamp(epoch_minute * 60, tz=timezone.utc).strftime('%Y%m%d%H%M')
+
+
+def window_doc_id(epoch_minute: int, client_ip: str, hash_prefix: str) -> str:
+    """窗口文檔 ID：{YYYYMMDDHHMM}_{IP}_{前綴}（IP 中的 / 替換為 _）"""
+    return f"{_minute_key(epoch_minute)}_{client_ip.replace('/', '_')}_{hash_prefix}"
+
+
+class UnauthorizedAttemptAggregator:
+    """未授權嘗試匯總
+
+    每次失敗只在本地 (分鐘, client_ip, uuid_hash 前綴) 窗口中累加次數並更新首次/最後時間，不做 I/O。
+    每個刷新間隔把各窗口以 WriteBatch 寫入 unauthorized_attempt_windows，次數用 Increment、
+    首次/最後時間用 Minimum/Maximum（epoch 秒），多個 worker 寫同一窗口會自動合併。
+    暴力嘗試時寫入量取決於 IP 數 × 前綴數 × 分鐘數，與嘗試次數無關。
+    """
+
+    def __init__(self, collection_name: str = COLLECTION, flush_interval: int = 30,
+                 prefix_length: int = 2, retention_days: int = 30, max_pending: int = 10000):
+        self.db = None
+        self.collection_name = collection_name
+        self.flush_interval = flush_interval
+        self.prefix_length = prefix_length
+        self.retention_days = retention_days
+        self.max_pending = max_pending
+
+        self._windows = {}  # (epoch 分鐘, client_ip, 前綴) -> [次數, 首次, 最後, set(User-Agent)]
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.recorded = 0
+        self.dropped = 0
+        self.flush_count = 0
+        self.docs_written = 0
+        self.failed = 0
+
+        register_shutdown_hook(self.stop, name='unauthorized-attempts')
+
+    def set_db(self, db):
+        """設置 Firestore 數據庫實例並啟動刷新線程"""
+        self.db = db
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(self.flush_interval):
+                self.flush()
+
+        self._thread = threading.Thread(target=run, name='unauthorized-attempts', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止刷新線程並寫入剩餘數據"""
+        self._stop.set()
+        self.flush()
+
+    def record(self, uuid_hash: str, client_ip: str, user_agent: Optional[str] = None,
+               now: Optional[float] = None):
+        """記錄一次未授權嘗試"""
+        now = time.time() if now is None else now
+        key = (int(now // 60), client_ip or 'unknown', (uuid_hash or '')[:self.prefix_length])
+        with self.lock:
+            window = self._windows.get(key)
+            if window is None:
+                if len(self._windows) >= self.max_pending:
+                    # 窗口數已達上限（例如偽造大量來源 IP），只計數不再保存
+                    self.dropped += 1
+                    return
+                window = self._windows[key] = [0, now, now, set()]
+            window[0] += 1
+            window[1] = min(window[1], now)
+            window[2] = max(window[2], now)
+            if user_agent and len(window[3]) < MAX_USER_AGENTS:
+                window[3].add(user_agent)
+            self.recorded += 1
+
+    def flush(self) -> int:
+        """寫入所有本地窗口，返回寫入的文檔數"""
+        if self.db is None:
+            return 0
+
+        with self._flush_lock:
+            with self.lock:
+                windows = self._windows
+                self._windows = {}
+
+            if not windows:
+                return 0
+
+            items = list(windows.items())
+            written = 0
+            for i in range(0, len(items), MAX_BATCH_SIZE):
+                chunk = items[i:i + MAX_BATCH_SIZE]
+                try:
+                    batch = self.db.batch()
+                    for key, window in chunk:
+                        batch.set(self._doc_ref(key), self._doc_fields(key, window), merge=True)
+                    batch.commit()
+                    written += len(chunk)
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"❌ 寫入未授權嘗試匯總失敗: {str(e)}")
+                    self._restore(chunk)
+
+            self.flush_count += 1
+            self.docs_written += written
+            return written
+
+    def _doc_ref(self, key):
+        minute, client_ip, prefix = key
+        return self.db.collection(self.collection_name).document(window_doc_id(minute, client_ip, prefix))
+
+    def _doc_fields(self, key, window) -> Dict:
+        minute, client_ip, prefix = key
+        count, first_seen, last_seen, user_agents = window
+        minute_at = datetime.fromtimestamp(minute * 60, tz=timezone.utc)
+        fields = {
+            'minute': minute_at,
+            'client_ip': client_ip,
+            'uuid_hash_prefix': prefix,
+            'count': firestore.Increment(count),
+            'first_seen': firestore.Minimum(first_seen),
+            'last_seen': firestore.Maximum(last_seen),
+            'expires_at': minute_at + timedelta(days=self.retention_days)
+        }
+        if user_agents:
+            fields['user_agents'] = firestore.ArrayUnion(sorted(user_agents))
+        return fields
+
+    def _restore(self, chunk):
+        """寫入失敗的窗口放回本地，下次刷新時重試"""
+        with self.lock:
+            for key, window in chunk:
+                current = self._windows.get(key)
+                if current is None:
+                    self._windows[key] = window
+                    continue
+                current[0] += window[0]
+                current[1] = min(current[1], window[1])
+                current[2] = max(current[2], window[2])
+                current[3].update(window[3])
+
+    # === 查詢 ===
+
+    def recent_windows(self, minutes: int = 60, client_ip: Optional[str] = None,
+                       limit: int = 5000) -> List[Dict]:
+        """最近幾分鐘的嘗試窗口（合併本地尚未寫入的窗口），按最後時間倒序"""
+        since_minute = int(time.time() // 60) - minutes + 1
+        windows = {}
+
+        if self.db is not None:
+            since = datetime.fromtimestamp(since_minute * 60, tz=timezone.utc)
+            docs = self.db.collection(self.collection_name).where('minute', '>=', since).limit(limit).stream()
+            for doc in docs:
+                data = doc.to_dict()
+                if client_ip and data.get('client_ip') != client_ip:
+                    continue
+                windows[doc.id] = {
+                    'minute': data.get('minute'),
+                    'client_ip': data.get('client_ip'),
+                    'uuid_hash_prefix': data.get('uuid_hash_prefix'),
+                    'count': data.get('count', 0),
+                    'first_seen': data.get('first_seen'),
+                    'last_seen': data.get('last_seen'),
+                    'user_agents': list(data.get('user_agents') or [])
+                }
+
+        with self.lock:
+            local = [(key, list(window[:3]) + [set(window[3])]) for key, window in self._windows.items()
+                     if key[0] >= since_minute and (not client_ip or key[1] == client_ip)]
+        for (minute, ip, prefix), (count, first_seen, last_seen, user_agents) in local:
+            doc_id = window_doc_id(minute, ip, prefix)
+            window = windows.get(doc_id)
+            if window is None:
+                windows[doc_id] = {
+                    'minute': datetime.fromtimestamp(minute * 60, tz=timezone.utc),
+                    'client_ip': ip,
+                    'uuid_hash_prefix': prefix,
+                    'count': count,
+                    'first_seen': first_seen,
+                    'last_seen': last_seen,
+                    'user_agents': sorted(user_agents)
+                }
+                continue
+            window['count'] += count
+            window['first_seen'] = min(window['first_seen'] or first_seen, first_seen)
+            window['last_seen'] = max(window['last_seen'] or last_seen, last_seen)
+            window['user_agents'] = sorted(set(window['user_agents']) | user_agents)
+
+        return sorted(windows.values(), key=lambda w: w['last_seen'] or 0, reverse=True)
+
+    def attacks_by_ip(self, minutes: int = 60, min_count: int = 1) -> List[Dict]:
+        """按 IP 匯總最近幾分鐘的嘗試：總次數、窗口數、首次/最後時間與涉及的前綴，按次數倒序"""
+        by_ip = {}
+        for window in self.recent_windows(minutes):
+            ip = window['client_ip']
+            summary = by_ip.get(ip)
+            if summary is None:
+                summary = by_ip[ip] = {
+                    'client_ip': ip, 'attempts': 0, 'windows': 0,
+                    'first_seen': window['first_seen'], 'last_seen': window['last_seen'],
+                    'uuid_hash_prefixes': set(), 'user_agents': set()
+                }
+            summary['attempts'] += window['count']
+            summary['windows'] += 1
+            summary['first_seen'] = min(summary['first_seen'], window['first_seen'])
+            summary['last_seen'] = max(summary['last_seen'], window['last_seen'])
+            summary['uuid_hash_prefixes'].add(window['uuid_hash_prefix'])
+            summary['user_agents'].update(window['user_agents'])
+
+        result = []
+        for summary in by_ip.values():
+            if summary['attempts'] < min_count:
+                continue
+            summary['uuid_hash_prefixes'] = sorted(summary['uuid_hash_prefixes'])
+            summary['user_agents'] = sorted(summary['user_agents'])
+            result.append(summary)
+        result.sort(key=lambda s: s['attempts'], reverse=True)
+        return result
+
+    def get_stats(self) -> Dict:
+        """獲取匯總統計"""
+        with self.lock:
+            pending_windows = len(self._windows)
+            pending_attempts = sum(window[0] for window in self._windows.values())
+        return {
+            'flush_interval': self.flush_interval,
+            'prefix_length': self.prefix_length,
+            'recorded': self.recorded,
+            'dropped': self.dropped,
+            'pending_windows': pending_windows,
+            'pending_attempts': pending_attempts,
+            'flush_count': self.flush_count,
+            'docs_written': self.docs_written,
+            'failed': self.failed
+        }
+
+
+# 全局未授權嘗試匯總實例
+unauthorized_attempts = UnauthorizedAttemptAggregator(
+    flush_interval=int(os.environ.get('UNAUTHORIZED_ATTEMPTS_FLUSH_INTERVAL', 30)),
+    prefix_length=int(os.environ.get('UNAUTHORIZED_ATTEMPTS_PREFIX_LENGTH', 2)),
+    retention_days=int(os.environ.get('UNAUTHORIZED_ATTEMPTS_RETENTION_DAYS', 30))
+)
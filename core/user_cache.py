@@ -0,0 +1,202 @@
+"""
+user_cache.py - authorized_users 的進程內讀穿緩存（TTL + 版本號失效）
+"""
+import copy
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from core.invalidation_bus import invalidation_bus, EVENT_USER, user_event_key, parse_user_event_key
+from core.user_projection import FULL_CLIENT_FIELDS, AUTH_FIELDS, get_user_fields, get_users_fields, project
+
+logger = logging.getLogger(__name__)
+
+# 用戶文檔的版本號欄位，每次修改以下緩存欄位時由寫入方更新
+VERSION_FIELD = 'version'
+# 緩存的欄位：登入與會話驗證的完整響應（已包含下載/手冊驗證與 Discord 驗證所需欄位）加上版本號
+# login_count / last_login 由登入記錄寫入，不更新版本號，緩存中的值最多落後一個 TTL
+CACHED_FIELDS = FULL_CLIENT_FIELDS + (VERSION_FIELD,)
+
+# 失效記錄保留秒數，需長於一次 Firestore 讀取可能花費的時間
+FLOOR_RETENTION = 120
+
+_version_lock = threading.Lock()
+_last_version = 0
+
+
+def new_user_version() -> int:
+    """新的用戶文檔版本號：微秒時間戳，同一進程內嚴格遞增"""
+    global _last_version
+    with _version_lock:
+        _last_version = max(int(time.time() * 1_000_000), _last_version + 1)
+        return _last_version
+
+
+def publish_user_change(uuid_hash: str, version: Optional[int] = None):
+    """用戶文檔寫入後廣播變更，各 worker 淘汰比 version 舊的緩存"""
+    invalidation_bus.publish(EVENT_USER, user_event_key(uuid_hash, version))
+
+
+class UserRecordCache:
+    """authorized_users 的讀穿緩存
+
+    uuid_hash -> CACHED_FIELDS 投影及其版本號。寫入方修改用戶文檔時同時寫入新的 version，
+    並經緩存失效廣播發布 uuid_hash:version；各 worker 收到後立即淘汰版本較舊的條目，
+    並記下這個版本作為下限：廣播之前發出、之後才返回的舊讀取結果不會再被寫入緩存。
+    沒有版本號的廣播按時間處理，拒絕在廣播之前開始的讀取。TTL 只是兜底。
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: int = 30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # uuid_hash -> (cached_at, version, data)
+        self._floors = OrderedDict()  # uuid_hash -> (最低可接受版本或 None, 失效時間)
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_rejected = 0
+
+    @staticmethod
+    def covers(fields: Optional[Iterable[str]]) -> bool:
+        """請求的欄位能否由緩存提供（完整文檔不緩存）"""
+        return fields is not None and all(field in CACHED_FIELDS for field in fields)
+
+    def lookup(self, uuid_hash: str, fields: Sequence[str]) -> Tuple[bool, Optional[Dict]]:
+        """查詢緩存，返回 (是否命中, 指定欄位)"""
+        now = time.time()
+        with self.lock:
+            entry = self._entries.get(uuid_hash)
+            if entry is None or now - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[uuid_hash]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(uuid_hash)
+            self.hits += 1
+            data = entry[2]
+        return True, copy.deepcopy(project(data, fields))
+
+    def store(self, uuid_hash: str, data: Dict, read_started: float) -> bool:
+        """寫入讀取結果（data 需包含 CACHED_FIELDS 中存在的欄位），讀取結果已過時返回 False"""
+        version = int(data.get(VERSION_FIELD) or 0)
+        with self.lock:
+            floor = self._floors.get(uuid_hash)
+            if floor is not None:
+                floor_version, invalidated_at = floor
+                if (version < floor_version) if floor_version is not None else (read_started < invalidated_at):
+                    self.stale_rejected += 1
+                    return False
+
+            current = self._entries.get(uuid_hash)
+            if current is not None and current[1] > version:
+                self.stale_rejected += 1
+                return False
+
+            self._entries[uuid_hash] = (time.time(), version, project(data, CACHED_FIELDS))
+            self._entries.move_to_end(uuid_hash)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, uuid_hash: str, version: Optional[int] = None):
+        """淘汰版本低於 version 的條目（version 為 None 時無條件淘汰），並記錄失效下限"""
+        now = time.time()
+        with self.lock:
+            entry = self._entries.get(uuid_hash)
+            if entry is not None and (version is None or entry[1] < version):
+                del self._entries[uuid_hash]
+                self.invalidations += 1
+
+            previous = self._floors.pop(uuid_hash, None)
+            if version is not None and previous is not None and previous[0] is not None:
+                version = max(version, previous[0])
+            self._floors[uuid_hash] = (version, now)
+
+            # 失效記錄按時間順序排列，從最舊的開始清理
+            while self._floors:
+                oldest_hash, (_, invalidated_at) = next(iter(self._floors.items()))
+                if now - invalidated_at <= FLOOR_RETENTION and len(self._floors) <= self.max_size:
+                    break
+                del self._floors[oldest_hash]
+
+    def on_user_event(self, key: str):
+        """緩存失效廣播的訂閱者"""
+        uuid_hash, version = parse_user_event_key(key)
+        self.invalidate(uuid_hash, version)
+
+    def get_user(self, db, uuid_hash: str, fields: Optional[Sequence[str]] = AUTH_FIELDS) -> Optional[Dict]:
+        """讀穿查詢單個用戶的指定欄位，用戶不存在返回 None；fields 為 None 時直接讀取完整文檔"""
+        if not self.covers(fields):
+            return get_user_fields(db, uuid_hash, fields)
+
+        hit, data = self.lookup(uuid_hash, fields)
+        if hit:
+            return data
+
+        read_started = time.time()
+        data = get_user_fields(db, uuid_hash, CACHED_FIELDS)
+        if data is not None:
+            self.store(uuid_hash, data, read_started)
+        return project(data, fields)
+
+    def get_users(self, db, uuid_hashes: Iterable[str], fields: Optional[Sequence[str]] = AUTH_FIELDS) -> Dict[str, Dict]:
+        """讀穿批量查詢，未命中的用戶在一次 get_all 中讀取；不存在的用戶不包含在結果中"""
+        if not self.covers(fields):
+            return get_users_fields(db, uuid_hashes, fields)
+
+        results = {}
+        missing = []
+        for uuid_hash in dict.fromkeys(uuid_hashes):
+            hit, data = self.lookup(uuid_hash, fields)
+            if hit:
+                results[uuid_hash] = data
+            else:
+                missing.append(uuid_hash)
+
+        if missing:
+            read_started = time.time()
+            for uuid_hash, data in get_users_fields(db, missing, CACHED_FIELDS).items():
+                self.store(uuid_hash, data, read_started)
+                results[uuid_hash] = project(data, fields)
+        return results
+
+    def clear(self):
+        """清空緩存"""
+        with self.lock:
+            self._entries.clear()
+            self._floors.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self) -> Dict:
+        """獲取緩存統計"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'stale_rejected': self.stale_rejected,
+                'tracked_floors': len(self._floors),
+                'hit_rate': (self.hits / total * 100) if total > 0 else 0
+            }
+
+
+# 全局用戶緩存實例
+user_cache = UserRecordCache(
+    max_size=int(os.environ.get('USER_CACHE_MAX_SIZE', 10000)),
+    ttl=int(os.environ.get('USER_CACHE_TTL', 30))
+)
+invalidation_bus.subscribe(EVENT_USER, user_cache.on_user_event)
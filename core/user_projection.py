@@ -0,0 +1,60 @@
+"""
+user_projection.py - authorized_users 熱路徑讀取的欄位投影（只向 Firestore 請求需要的欄位）
+"""
+import os
+from typing import Dict, Iterable, Optional, Sequence
+
+USERS_COLLECTION = 'authorized_users'
+
+# 判斷帳號是否可用所需的欄位
+ACCESS_FIELDS = ('active', 'expires_at')
+# 登入與會話驗證需要的欄位
+AUTH_FIELDS = ACCESS_FIELDS + ('permissions',)
+# AUTH_RESPONSE_SCHEMA=slim 時 /auth/validate 返回給客戶端的 user_data 欄位
+CLIENT_FIELDS = AUTH_FIELDS + ('display_name',)
+# 完整響應的欄位：創建、管理後台、付款/退款與登入記錄寫入 authorized_users 的所有欄位
+# （版本號除外）。新增用戶文檔欄位並需要返回給客戶端時，需同時加到這裡
+FULL_CLIENT_FIELDS = CLIENT_FIELDS + (
+    'original_uuid', 'plan_type', 'created_at', 'created_by', 'notes',
+    'login_count', 'last_login', 'last_login_ip',
+    'payment_id', 'payment_status', 'gumroad_data',
+    'updated_at', 'updated_by', 'status_changed_at', 'status_changed_by',
+    'deactivated_at', 'deactivation_reason', 'deactivated_by'
+)
+
+# 默認返回完整響應（兼容舊客戶端），客戶端遷移後可設置 AUTH_RESPONSE_SCHEMA=slim
+# /auth/login 始終返回完整響應
+FULL_RESPONSE = os.environ.get('AUTH_RESPONSE_SCHEMA', 'full').lower() != 'slim'
+
+
+def client_fields() -> Sequence[str]:
+    """/auth/validate 返回給客戶端的欄位"""
+    return FULL_CLIENT_FIELDS if FULL_RESPONSE else CLIENT_FIELDS
+
+
+def get_user_fields(db, uuid_hash: str, fields: Optional[Iterable[str]] = AUTH_FIELDS) -> Optional[Dict]:
+    """讀取單個用戶的指定欄位，用戶不存在返回 None；fields 為 None 時讀取完整文檔"""
+    user_ref = db.collection(USERS_COLLECTION).document(uuid_hash)
+    if fields is None:
+        user_doc = user_ref.get()
+    else:
+        user_doc = user_ref.get(field_paths=list(fields))
+    if not user_doc.exists:
+        return None
+    return user_doc.to_dict() or {}
+
+
+def get_users_fields(db, uuid_hashes: Iterable[str], fields: Optional[Iterable[str]] = AUTH_FIELDS) -> Dict[str, Dict]:
+    """批量讀取多個用戶的指定欄位（一次 get_all），返回 uuid_hash -> 欄位；不存在的用戶不包含在結果中"""
+    refs = [db.collection(USERS_COLLECTION).document(uuid_hash) for uuid_hash in uuid_hashes]
+    if not refs:
+        return {}
+    field_paths = None if fields is None else list(fields)
+    return {doc.id: doc.to_dict() or {} for doc in db.get_all(refs, field_paths=field_paths) if doc.exists}
+
+
+def project(user_data: Optional[Dict], fields: Optional[Iterable[str]]) -> Optional[Dict]:
+    """從已讀取的用戶資料中取出指定欄位"""
+    if user_data is None or fields is None:
+        return user_data
+    return {field: user_data[field] for field in fields if field in user_data}
@@ -0,0 +1,173 @@
+"""
+write_behind.py - 合併式延遲寫入器（按文檔合併更新，定時以 WriteBatch 批量提交）
+"""
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from core.shutdown import register_shutdown_hook
+
+logger = logging.getLogger(__name__)
+
+# Firestore 單個 WriteBatch 最多 500 個操作
+MAX_BATCH_SIZE = 500
+
+
+class WriteBehindFlusher:
+    """合併式延遲寫入器
+
+    同一文檔在刷新間隔內的多次更新會合併成一次寫入，刷新時按最多 500 個操作
+    分塊提交 WriteBatch。進程收到 SIGTERM 或正常退出時會再刷新一次。
+
+    merge: 自定義合併函數 (舊欄位, 新欄位) -> 合併後欄位，預設後寫覆蓋前寫。
+    """
+
+    def __init__(self, name: str, flush_interval: int = 30, max_batch_size: int = MAX_BATCH_SIZE,
+                 merge: Optional[Callable[[Dict, Dict], Dict]] = None):
+        self.name = name
+        self.db = None
+        self.flush_interval = flush_interval
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_SIZE)
+        self.merge = merge
+
+        self._pending = {}  # 文檔路徑 -> (doc_ref, 欄位)
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # 指標
+        self.enqueued = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+        self.flush_count = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.last_flush_at = None
+
+        register_shutdown_hook(self.stop, name=f"write-behind:{name}")
+
+    def set_db(self, db):
+        """設置 Firestore 數據庫實例並啟動刷新線程"""
+        self.db = db
+        self.start()
+
+    def start(self):
+        """啟動後台刷新線程"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(self.flush_interval):
+                self.flush()
+
+        self._thread = threading.Thread(target=run, name=f"write-behind-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止刷新線程並寫入剩餘數據"""
+        self._stop.set()
+        self.flush()
+
+    def enqueue(self, doc_ref, fields: Dict):
+        """加入待寫入更新，同一文檔的未刷新更新會合併"""
+        key = doc_ref.path
+        with self._pending_lock:
+            self.enqueued += 1
+            existing = self._pending.get(key)
+            if existing is None:
+                self._pending[key] = (doc_ref, dict(fields))
+                return
+
+            self.coalesced += 1
+            if self.merge:
+                merged = self.merge(existing[1], fields)
+            else:
+                merged = existing[1]
+                merged.update(fields)
+            self._pending[key] = (existing[0], merged)
+
+    def discard(self, doc_ref) -> bool:
+        """丟棄某文檔尚未寫入的更新（例如文檔已被刪除）"""
+        with self._pending_lock:
+            return self._pending.pop(doc_ref.path, None) is not None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self) -> int:
+        """立即寫入所有待寫入更新，返回成功寫入的文檔數"""
+        with self._flush_lock:
+            with self._pending_lock:
+                pending = self._pending
+                self._pending = {}
+
+            if not pending:
+                return 0
+
+            if not self.db:
+                # 數據庫尚未就緒，放回隊列等待下次刷新
+                with self._pending_lock:
+                    for key, item in pending.items():
+                        self._pending.setdefault(key, item)
+                return 0
+
+            start_time = time.time()
+            items = list(pending.values())
+            written = 0
+
+            for i in range(0, len(items), self.max_batch_size):
+                written += self._commit_chunk(items[i:i + self.max_batch_size])
+
+            latency = time.time() - start_time
+            self.flush_count += 1
+            self.written += written
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.total_flush_latency += latency
+            self.last_flush_at = time.time()
+
+            logger.debug(f"💾 [{self.name}] 已寫入 {written}/{len(items)} 個文檔，耗時 {latency * 1000:.1f}ms")
+            return written
+
+    def _commit_chunk(self, chunk) -> int:
+        """以單個 WriteBatch 提交一組更新；批次失敗時逐個重試"""
+        try:
+            batch = self.db.batch()
+            for doc_ref, fields in chunk:
+                batch.update(doc_ref, fields)
+            batch.commit()
+            return len(chunk)
+        except Exception as e:
+            # 只要有一個文檔已被刪除，整個批次都會失敗，改為逐個寫入並跳過不存在的文檔
+            logger.debug(f"[{self.name}] 批量寫入失敗，改為逐個寫入: {e}")
+
+        written = 0
+        for doc_ref, fields in chunk:
+            try:
+                doc_ref.update(fields)
+                written += 1
+            except Exception as e:
+                self.failed += 1
+                logger.debug(f"[{self.name}] 寫入 {doc_ref.path} 失敗: {e}")
+        return written
+
+    def get_metrics(self) -> Dict:
+        """獲取寫入器指標"""
+        return {
+            'queue_depth': len(self._pending),
+            'enqueued': self.enqueued,
+            'coalesced': self.coalesced,
+            'written': self.written,
+            'failed': self.failed,
+            'flush_count': self.flush_count,
+            'flush_interval': self.flush_interval,
+            'last_flush_latency_ms': round(self.last_flush_latency * 1000, 2),
+            'max_flush_latency_ms': round(self.max_flush_latency * 1000, 2),
+            'avg_flush_latency_ms': round(self.total_flush_latency / self.flush_count * 1000, 2) if self.flush_count else 0
+        }
@@ -5,7 +5,8 @@ import discord
 from discord.ext import commands
 import logging
 from .config import *
-from .verification import verify_user_uuid, is_rate_limited, record_failed_attempt
+from core.license_verifier import license_verifier
+from .verification import VERIFY_FIELDS, is_rate_limited, record_failed_attempt
 import asyncio
 
 # 設定日誌
@@ -283,14 +284,14 @@ class AdvancedVerificationModal(discord.ui.Modal):
         
         try:
             # 驗證序號
-            is_valid, result = await verify_user_uuid(uuid, self.bot.db)
+            result = await license_verifier.verify_async(self.bot.db, uuid, VERIFY_FIELDS, source='discord')
             
-            if is_valid:
+            if result.valid:
                 # 驗證成功處理
-                await self.handle_successful_verification(interaction, result)
+                await self.handle_successful_verification(interaction, result.user_data)
             else:
                 # 驗證失敗處理
-                await self.handle_failed_verification(interaction, result, user_id)
+                await self.handle_failed_verification(interaction, result.message, user_id)
                 
         except Exception as e:
             logger.error(f"❌ 驗證過程出錯: {str(e)}")
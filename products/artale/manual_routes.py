@@ -2,13 +2,13 @@
 manual_routes.py - 操作手冊路由處理（序號驗證版）
 """
 from flask import Blueprint, render_template_string, request, jsonify
-import hashlib
 import logging
-from collections import defaultdict
-import time
 
-# 簡單的驗證失敗計數器
-failed_attempts = defaultdict(list)  # IP -> [timestamp1, timestamp2, ...]
+from core.license_verifier import license_verifier
+from core.rate_limiter import rate_limiter, RateLimitPolicy
+
+# 驗證失敗計數（與所有 worker 共享）：5分鐘內最多5次失敗
+FAILED_ATTEMPT_POLICY = RateLimitPolicy(max_requests=5, time_window=300)
 # Google Drive 影片配置
 GOOGLE_DRIVE_CONFIG = {
     'setup_video_id': '1ORAhVAQh9MNT72hjX2M-mc4lX0zEeTYy',  # 設定教學影片 ID
@@ -17,16 +17,15 @@ GOOGLE_DRIVE_CONFIG = {
 
 def is_rate_limited(ip):
     """檢查是否超過速率限制"""
-    now = time.time()
-    # 清理5分鐘前的記錄
-    failed_attempts[ip] = [t for t in failed_attempts[ip] if now - t < 300]
-    
-    # 5分鐘內超過5次失敗就封鎖
-    return len(failed_attempts[ip]) >= 5
+    return not rate_limiter.peek('manual_verify_failures', ip, FAILED_ATTEMPT_POLICY)
 
 def record_failed_attempt(ip):
     """記錄失敗嘗試"""
-    failed_attempts[ip].append(time.time())
+    rate_limiter.consume('manual_verify_failures', ip, FAILED_ATTEMPT_POLICY)
+
+def clear_failed_attempts(ip):
+    """清除失敗記錄"""
+    rate_limiter.reset('manual_verify_failures', ip)
 
 
 logger = logging.getLogger(__name__)
@@ -34,45 +33,6 @@ logger = logging.getLogger(__name__)
 # 創建操作手冊藍圖
 manual_bp = Blueprint('manual', __name__, url_prefix='/manual')
 
-# 驗證用戶序號的函數
-def verify_user_uuid(uuid_string):
-    """驗證用戶UUID是否有效"""
-    try:
-        from app import db
-        if not db:
-            return False, "認證服務不可用"
-        
-        uuid_hash = hashlib.sha256(uuid_string.encode()).hexdigest()
-        user_ref = db.collection('authorized_users').document(uuid_hash)
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
-            return False, "序號無效"
-        
-        user_data = user_doc.to_dict()
-        
-        # 檢查用戶狀態
-        if not user_data.get('active', False):
-            return False, "帳號已被停用"
-        
-        # 檢查有效期（如果有的話）
-        if 'expires_at' in user_data:
-            from datetime import datetime
-            expires_at = user_data['expires_at']
-            if isinstance(expires_at, str):
-                expires_at = datetime.fromisoformat(expires_at.replace('Z', ''))
-            elif hasattr(expires_at, 'timestamp'):
-                expires_at = datetime.fromtimestamp(expires_at.timestamp())
-            
-            if datetime.now() > expires_at:
-                return False, "帳號已過期"
-        
-        return True, "驗證成功"
-        
-    except Exception as e:
-        logger.error(f"UUID驗證錯誤: {str(e)}")
-        return False, "驗證服務錯誤"
-
 # 操作手冊 HTML 模板（序號驗證版）
 MANUAL_TEMPLATE_WITH_AUTH = r"""
 <!DOCTYPE html>
@@ -3260,12 +3220,13 @@ def verify_uuid():
             }), 400
         
         # 驗證UUID
-        is_valid, message = verify_user_uuid(uuid)
+        from app import db
+        result = license_verifier.verify(db, uuid, source='manual')
+        message = result.message
         
-        if is_valid:
+        if result.valid:
             # 成功時清除失敗記錄
-            if client_ip in failed_attempts:
-                del failed_attempts[client_ip]
+            clear_failed_attempts(client_ip)
             return jsonify({
                 'success': True,
                 'message': message
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+heartbeat_simulation.py
+本地模擬客戶端按 next_check_after 心跳時 /auth/validate 的總請求速率
+
+模擬一個 worker：容量為 capacity 次/秒，超出的請求返回 503。
+固定間隔模式下所有客戶端每 base_interval 秒驗證一次；自適應模式下客戶端遵守
+響應中的 next_check_after。中途有一批客戶端同時上線（例如維護結束後重連），
+比較兩種模式下的請求速率和錯誤率。
+自適應模式下檢查：成功響應給出的間隔不會越過帳號到期時間超過 1 秒（不滿足時退出碼非零）。
+
+用法：
+    python utils/heartbeat_simulation.py
+    python utils/heartbeat_simulation.py --clients 1500 --surge 3000 --capacity 40
+"""
+import argparse
+import heapq
+import os
+import random
+import sys
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.heartbeat_advisor import HeartbeatAdvisor  # noqa: E402
+
+
+def simulate(mode, clients, surge, surge_at, duration, capacity, base_interval, near_expiry, seed):
+    """運行一次模擬，返回每分鐘的統計"""
+    rng = random.Random(seed)
+    random.seed(seed)
+    advisor = HeartbeatAdvisor(base_interval=base_interval, target_rps=capacity * 0.8,
+                               memory_signal=False)
+    advisor.started_at = 0
+
+    events = []  # (下次驗證時間, 客戶端編號)
+    expiry = {}  # 客戶端編號 -> 帳號到期時間
+    for client in range(clients):
+        heapq.heappush(events, (rng.uniform(0, base_interval), client))
+        if rng.random() < near_expiry:
+            expiry[client] = rng.uniform(0, duration)
+    for client in range(clients, clients + surge):
+        # 重連風暴：所有新客戶端在 5 秒內同時上線
+        heapq.heappush(events, (surge_at + rng.uniform(0, 5), client))
+
+    served = defaultdict(int)  # 秒 -> 已處理請求數
+    minutes = defaultdict(lambda: {'requests': 0, 'errors': 0, 'peak': 0, 'hints': [], 'clients': set()})
+    late_detections = []
+    last_overloaded = {}  # 客戶端編號 -> 上一次驗證是否返回 503
+
+    while events:
+        now, client = heapq.heappop(events)
+        if now >= duration:
+            break
+
+        second = int(now)
+        overloaded = served[second] >= capacity
+        served[second] += 1
+        status_code = 503 if overloaded else 200
+        advisor.record(status_code, now=now)
+
+        expires_at = expiry.get(client)
+        if expires_at is not None and now >= expires_at and not overloaded:
+            late = now - expires_at
+            # 由成功響應排定的驗證必須在到期後 1 秒內發生；503 響應沒有帳號信息，不在保證範圍內，
+            # 首次驗證前已到期的客戶端也不在範圍內
+            scheduled = last_overloaded.get(client) is False
+            late_detections.append((late, scheduled))
+            if mode == 'adaptive' and scheduled:
+                assert late <= 1.0, f"客戶端 {client} 到期 {late:.1f}s 後才被發現"
+            continue  # 帳號到期，客戶端退出
+        last_overloaded[client] = overloaded
+
+        if mode == 'fixed':
+            interval = base_interval
+        else:
+            expires_in = (expires_at - now) if expires_at is not None and not overloaded else None
+            interval = advisor.next_check_after(expires_in, now=now)
+            if expires_in is not None:
+                assert now + interval <= expires_at + 1.0, f"間隔 {interval}s 越過到期時間"
+
+        stats = minutes[second // 60]
+        stats['requests'] += 1
+        stats['errors'] += overloaded
+        stats['peak'] = max(stats['peak'], served[second])
+        stats['hints'].append(interval)
+        stats['clients'].add(client)
+
+        heapq.heappush(events, (now + interval, client))
+
+    return minutes, late_detections
+
+
+def print_report(mode, minutes, late_detections):
+    print(f"\n=== {mode} ===")
+    print(f"{'分鐘':>4} {'客戶端':>6} {'平均rps':>8} {'峰值rps':>8} {'錯誤率':>7} {'間隔中位數':>10}")
+    for minute in sorted(minutes):
+        stats = minutes[minute]
+        hints = sorted(stats['hints'])
+        median = hints[len(hints) // 2] if hints else 0
+        error_rate = stats['errors'] / stats['requests'] * 100 if stats['requests'] else 0
+        print(f"{minute:>4} {len(stats['clients']):>6} {stats['requests'] / 60:>8.1f} "
+              f"{stats['peak']:>8} {error_rate:>6.1f}% {median:>9}s")
+
+    total = sum(stats['requests'] for stats in minutes.values())
+    errors = sum(stats['errors'] for stats in minutes.values())
+    print(f"總請求 {total}，503 {errors} ({errors / total * 100 if total else 0:.1f}%)")
+    for label, delays in (('上次驗證成功', [late for late, scheduled in late_detections if scheduled]),
+                          ('上次驗證 503 或首次驗證', [late for late, scheduled in late_detections if not scheduled])):
+        if delays:
+            print(f"帳號到期發現延遲（{label}）: 平均 {sum(delays) / len(delays):.1f}s，"
+                  f"最長 {max(delays):.1f}s（{len(delays)} 個）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模擬自適應心跳間隔下的驗證請求速率')
+    parser.add_argument('--clients', type=int, default=1000, help='初始在線客戶端數')
+    parser.add_argument('--surge', type=int, default=2000, help='中途同時上線的客戶端數')
+    parser.add_argument('--surge-at', type=int, default=300, help='同時上線的時間（秒）')
+    parser.add_argument('--duration', type=int, default=1200, help='模擬時長（秒）')
+    parser.add_argument('--capacity', type=int, default=40, help='worker 每秒可處理的驗證請求數')
+    parser.add_argument('--base-interval', type=int, default=60, help='基礎心跳間隔（秒）')
+    parser.add_argument('--near-expiry', type=float, default=0.05, help='模擬期間帳號到期的客戶端比例')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    for mode in ('fixed', 'adaptive'):
+        minutes, late_detections = simulate(mode, args.clients, args.surge, args.surge_at, args.duration,
+                                            args.capacity, args.base_interval, args.near_expiry, args.seed)
+        print_report(mode, minutes, late_detections)
+
+
+if __name__ == "__main__":
+    main()
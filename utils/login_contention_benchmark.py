@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+login_contention_benchmark.py
+登入認證鎖的爭用基準（gthread worker 內多線程並發登入，Firestore 替身注入固定 RTT）
+
+對比一把全局認證鎖（分段數 1，等同原來的 auth_lock）與按 uuid_hash 分段的鎖：
+每個線程代表 gthread worker 的一個請求線程，登入各不相同的帳號（用戶緩存均未命中，
+每次登入都有一次 Firestore 往返）。全局鎖下吞吐量不隨線程數增長；分段鎖下隨線程數近似線性增長。
+最後一組測試所有線程登入同一帳號：同一帳號的登入仍然串行，第一次之後命中用戶緩存，
+鎖內不再有往返。
+
+用法：
+    python utils/login_contention_benchmark.py
+    python utils/login_contention_benchmark.py --rtt 0.03 --threads 1 4 16 --logins 400
+"""
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from core.route_handlers import RouteHandlers  # noqa: E402
+from core.striped_lock import StripedLock  # noqa: E402
+from core.user_cache import user_cache  # noqa: E402
+from core.user_projection import USERS_COLLECTION  # noqa: E402
+from validate_latency_benchmark import RttFirestore  # noqa: E402
+
+
+class IdleSessionManager:
+    """沒有現有會話的 session 管理器（只測認證鎖內的路徑）"""
+
+    def terminate_user_sessions(self, uuid, before=None):
+        return 0
+
+    def check_existing_session(self, uuid):
+        return False
+
+
+def seed(db, count):
+    """寫入 count 個有效用戶，返回序號列表"""
+    expires_at = (datetime.now() + timedelta(days=30)).isoformat()
+    uuids = []
+    for index in range(count):
+        uuid = f"artale_bench_{index:06d}"
+        db.docs[f"{USERS_COLLECTION}/{hashlib.sha256(uuid.encode()).hexdigest()}"] = {
+            'active': True, 'expires_at': expires_at, 'display_name': f"user {index}",
+            'permissions': {'script_access': True}
+        }
+        uuids.append(uuid)
+    return uuids
+
+
+def run(name, rtt, threads, logins, stripes, same_account):
+    db = RttFirestore(rtt)
+    uuids = seed(db, 1 if same_account else logins)
+    handlers = RouteHandlers(db, IdleSessionManager())
+    handlers.auth_locks = StripedLock(stripes=stripes)
+    user_cache.clear()
+
+    def worker(index):
+        for position in range(index, logins, threads):
+            uuid = uuids[0] if same_account else uuids[position]
+            success, message, _ = handlers.authenticate_user_optimized(uuid, True, '127.0.0.1')
+            assert success, message
+
+    pool = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stats = handlers.auth_locks.get_stats()
+    print(f"{name:<14} 線程 {threads:>3}  {logins / elapsed:>8.1f} 次登入/秒  "
+          f"爭用 {stats['contention_rate']:>5.1f}%  平均等待 {stats['avg_wait_ms']:>7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='登入認證鎖爭用')
+    parser.add_argument('--rtt', type=float, default=0.02, help='每次 Firestore 往返秒數')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='並發線程數')
+    parser.add_argument('--logins', type=int, default=200, help='每組測試的登入次數')
+    parser.add_argument('--stripes', type=int, default=64, help='分段鎖的分段數')
+    args = parser.parse_args()
+
+    print(f"RTT {args.rtt * 1000:.0f} ms，每組 {args.logins} 次登入\n")
+    for threads in args.threads:
+        run('全局鎖', args.rtt, threads, args.logins, 1, False)
+        run('分段鎖', args.rtt, threads, args.logins, args.stripes, False)
+    print()
+    run('分段鎖（同帳號）', args.rtt, max(args.threads), args.logins, args.stripes, True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+rate_limit_benchmark.py
+令牌桶速率限制器的單次檢查耗時微基準
+
+對比舊版「每 IP 一個時間戳列表、每次檢查重建列表」的做法與新的令牌桶：
+大量不同 IP 隨機訪問同一路由，並測試 max_keys 小於 IP 數時的 LRU 淘汰路徑，
+以及多 worker 共用的共享記憶體後端（含跨進程鎖的開銷）。少量熱點 IP 持續接近上限時，
+舊版的列表長度接近 max_requests，令牌桶的耗時不變。每項取多輪中最快的一輪。
+最後檢查共享記憶體表的探測窗口全部被封鎖時，新鍵不會覆蓋已封鎖的鍵（不滿足時退出碼非零）。
+
+用法：
+    python utils/rate_limit_benchmark.py
+    python utils/rate_limit_benchmark.py --ips 10000 --checks 500000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.rate_limiter import RateLimitPolicy, TokenBucketRateLimiter  # noqa: E402
+from core.rate_limit_backends import (  # noqa: E402
+    MemoryRateLimitBackend, SharedMemoryRateLimitBackend, RESULT_BLOCKED, RESULT_NEW_BLOCK
+)
+
+
+def timestamp_list_check(records, client_ip, now, max_requests, time_window):
+    """舊版做法：過濾並重建該 IP 的時間戳列表"""
+    valid_records = [t for t in records[client_ip] if now - t < time_window]
+    if len(valid_records) >= max_requests:
+        return False
+    valid_records.append(now)
+    records[client_ip] = valid_records
+    return True
+
+
+def run(name, make_check, ips, checks, step=0.001, repeat=3):
+    """make_check() 返回新的 check(ip, now)，每輪使用新的狀態"""
+    sequence = [random.choice(ips) for _ in range(checks)]
+    best = None
+    for _ in range(repeat):
+        check = make_check()
+        # 模擬時間按請求均勻推進，讓桶有補充的機會
+        start = time.perf_counter()
+        for index, client_ip in enumerate(sequence):
+            check(client_ip, 1_000_000 + index * step)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<32} {best / checks * 1e9:>8.0f} ns/次  ({checks / best:,.0f} 次/秒)")
+
+
+def check_blocked_window(directory):
+    """同一探測窗口內的鍵全部被封鎖後，新鍵不得覆蓋其中任何一個"""
+    backend = SharedMemoryRateLimitBackend(os.path.join(directory, 'probe'),
+                                           slots=SharedMemoryRateLimitBackend.PROBE_WINDOW, stripes=1)
+    keys = [f"login|probe-{index}" for index in range(backend.PROBE_WINDOW + 1)]
+    now = 1_000_000.0
+    for key in keys[:-1]:
+        backend.take(key, 1, 0.01, 1800, 1, now)
+        assert backend.take(key, 1, 0.01, 1800, 1, now)[0] == RESULT_NEW_BLOCK
+    for _ in range(3):
+        backend.take(keys[-1], 1, 0.01, 1800, 1, now)
+    blocked = sum(backend.take(key, 1, 0.01, 1800, 1, now + 1)[0] == RESULT_BLOCKED for key in keys)
+    assert blocked == len(keys), f"探測窗口已滿時有 {len(keys) - blocked} 個已封鎖的鍵被覆蓋"
+    print(f"探測窗口全部封鎖：{len(keys)} 個鍵仍處於封鎖狀態（溢出 {backend.overflows} 次）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='速率限制器單次檢查耗時')
+    parser.add_argument('--ips', type=int, default=10000, help='不同 IP 數')
+    parser.add_argument('--checks', type=int, default=200000, help='檢查次數')
+    parser.add_argument('--max-requests', type=int, default=60)
+    parser.add_argument('--time-window', type=int, default=60)
+    parser.add_argument('--hot-ips', type=int, default=20, help='熱點 IP 數')
+    args = parser.parse_args()
+
+    random.seed(1)
+    ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(args.ips)]
+    policy = RateLimitPolicy(args.max_requests, args.time_window)
+    print(f"{args.ips} 個 IP，{args.checks} 次檢查，策略 {args.max_requests} 次/{args.time_window}s\n")
+
+    def timestamp_lists():
+        records = defaultdict(list)
+        return lambda ip, now: timestamp_list_check(records, ip, now, args.max_requests, args.time_window)
+
+    def token_bucket(backend_factory):
+        def make():
+            # 舊版做法不含記憶體檢查，這裡同樣關閉
+            limiter = token_bucket.last = TokenBucketRateLimiter(backend_factory(), memory_threshold=None)
+            return lambda ip, now: limiter.check('validate_session', ip, policy, now)
+        return make
+
+    with tempfile.TemporaryDirectory() as directory:
+        def shared_memory():
+            path = os.path.join(directory, 'rate_limit')
+            if os.path.exists(path):
+                os.unlink(path)
+            return SharedMemoryRateLimitBackend(path, slots=args.ips * 2)
+
+        run('時間戳列表（舊版）', timestamp_lists, ips, args.checks)
+        run('令牌桶（進程內）', token_bucket(lambda: MemoryRateLimitBackend(max_keys=args.ips * 2)),
+            ips, args.checks)
+        run('令牌桶（進程內，max_keys = IP 數 / 2）',
+            token_bucket(lambda: MemoryRateLimitBackend(max_keys=args.ips // 2)), ips, args.checks)
+        evicting = token_bucket.last
+        run('令牌桶（共享記憶體）', token_bucket(shared_memory), ips, args.checks)
+
+        # 熱點 IP：每個 IP 每秒約一次請求，舊版列表保持接近 max_requests 個時間戳
+        hot_ips = ips[:args.hot_ips]
+        step = args.time_window / args.max_requests / len(hot_ips)
+        print(f"\n{len(hot_ips)} 個熱點 IP，每個約 {args.max_requests} 次/{args.time_window}s")
+        run('時間戳列表（舊版，熱點）', timestamp_lists, hot_ips, args.checks, step)
+        run('令牌桶（進程內，熱點）', token_bucket(lambda: MemoryRateLimitBackend(max_keys=args.ips * 2)),
+            hot_ips, args.checks, step)
+        run('令牌桶（共享記憶體，熱點）', token_bucket(shared_memory), hot_ips, args.checks, step)
+
+        print(f"\n進程內淘汰次數: {evicting.backend.evictions}，常駐鍵數: {len(evicting)}")
+        check_blocked_window(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+validate_latency_benchmark.py
+/auth/validate 讀取路徑的延遲基準（Firestore 替身注入固定 RTT）
+
+對比三種讀取方式（均使用默認的 AUTH_RESPONSE_SCHEMA 響應欄位）：
+  - 原有做法：先讀 user_sessions/{token}，得到 uuid hash 後再讀 authorized_users/{hash}，不經過用戶緩存
+  - 未設置提示密鑰（代碼默認）：令牌不附帶 uuid hash，先讀 session 再經用戶緩存讀取用戶文檔
+  - 設置提示密鑰（SESSION_TOKEN_HINT_KEY，render.yaml 中自動生成）：令牌附帶加密的 uuid hash，
+    緩存未命中時兩個文檔在同一次 get_all 中讀取
+分別測量本地 session / 用戶緩存未命中（冷）與命中（熱）的情況，以及提示密鑰下舊格式令牌的回退。
+最後檢查同一用戶第二次登入與驗證由用戶緩存提供，不再讀取用戶文檔（不滿足時退出碼非零）。
+
+用法：
+    python utils/validate_latency_benchmark.py
+    python utils/validate_latency_benchmark.py --rtt 0.03 --sessions 200
+"""
+import argparse
+import hashlib
+import os
+import secrets
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.session_manager import FirestoreSessionManager  # noqa: E402
+from core.session_store import FirestoreSessionStore  # noqa: E402
+from core.session_tokens import new_opaque_token  # noqa: E402
+from core.license_verifier import license_verifier  # noqa: E402
+from core.user_cache import user_cache  # noqa: E402
+from core.user_projection import (  # noqa: E402
+    FULL_CLIENT_FIELDS, FULL_RESPONSE, USERS_COLLECTION, client_fields, get_user_fields
+)
+
+
+class _Snapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _DocumentRef:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def _snapshot(self, field_paths=None):
+        if self.path.startswith(f"{USERS_COLLECTION}/"):
+            self._client.user_reads += 1
+        data = self._client.docs.get(self.path)
+        if data is not None and field_paths is not None:
+            data = {field: data[field] for field in field_paths if field in data}
+        return _Snapshot(self, data)
+
+    def get(self, field_paths=None):
+        self._client.round_trip()
+        return self._snapshot(field_paths)
+
+
+class _Collection:
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def document(self, doc_id):
+        return _DocumentRef(self._client, f"{self._name}/{doc_id}")
+
+
+class RttFirestore:
+    """記憶體中的 Firestore 替身：只支持文檔讀取，每次 get / get_all 固定耗時一個 RTT"""
+
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.docs = {}
+        self.round_trips = 0
+        self.user_reads = 0
+
+    def round_trip(self):
+        self.round_trips += 1
+        time.sleep(self.rtt)
+
+    def collection(self, name):
+        return _Collection(self, name)
+
+    def get_all(self, refs, field_paths=None):
+        self.round_trip()
+        return [ref._snapshot(field_paths) for ref in refs]
+
+
+def seed(db, sessions, legacy, hint_key):
+    """寫入 sessions 個用戶及其 session，返回令牌列表"""
+    now = datetime.now(timezone.utc)
+    tokens = []
+    for index in range(sessions):
+        uuid = f"artale_bench_{index:06d}"
+        uuid_hash = hashlib.sha256(uuid.encode()).hexdigest()
+        token = secrets.token_urlsafe(32) if legacy else new_opaque_token(uuid_hash, hint_key)
+        db.docs[f"{USERS_COLLECTION}/{uuid_hash}"] = {
+            'active': True, 'expires_at': None, 'display_name': f"user {index}",
+            'permissions': {'script_access': True}, 'created_at': now, 'login_count': index,
+            'notes': 'x' * 512
+        }
+        db.docs[f"user_sessions/{token}"] = {
+            'uuid': uuid, 'uuid_hash': uuid_hash, 'token': token, 'created_at': now,
+            'expires_at': now + timedelta(hours=1), 'last_activity': now,
+            'client_ip': '127.0.0.1', 'active': True
+        }
+        tokens.append(token)
+    return tokens
+
+
+def sequential(manager, token):
+    """原有做法：驗證令牌後再讀取用戶文檔"""
+    is_valid, session_data = manager.verify_session_token(token)
+    assert is_valid
+    assert get_user_fields(manager.db, session_data['uuid_hash'], client_fields()) is not None
+
+
+def combined(manager, token):
+    is_valid, _, user_data = manager.verify_session_with_user(token, client_fields())
+    assert is_valid and user_data is not None
+
+
+def new_manager(db, hint_key):
+    store = FirestoreSessionStore()
+    store.set_db(db)
+    manager = FirestoreSessionManager(db=db, store=store)
+    manager.token_hint_key = hint_key
+    return manager
+
+
+def run(name, validate, rtt, sessions, legacy, warm, hint_key=None):
+    db = RttFirestore(rtt)
+    manager = new_manager(db, hint_key)
+    tokens = seed(db, sessions, legacy, manager.token_hint_key)
+    user_cache.clear()
+    if warm:
+        for token in tokens:
+            validate(manager, token)
+    else:
+        manager.session_cache.clear()
+
+    db.round_trips = 0
+    durations = []
+    for token in tokens:
+        start = time.perf_counter()
+        validate(manager, token)
+        durations.append((time.perf_counter() - start) * 1000)
+
+    durations.sort()
+    p95 = durations[int(len(durations) * 0.95) - 1]
+    print(f"{name:<32} p50 {statistics.median(durations):>7.2f} ms  p95 {p95:>7.2f} ms  "
+          f"往返 {db.round_trips / sessions:.2f} 次/驗證")
+
+
+def check_user_cache(sessions, hint_key):
+    """同一用戶第二次登入（license_verifier）與驗證（默認響應欄位）不應再讀取用戶文檔"""
+    db = RttFirestore(0)
+    manager = new_manager(db, hint_key)
+    tokens = seed(db, sessions, False, manager.token_hint_key)
+    uuid_hashes = [hashlib.sha256(f"artale_bench_{index:06d}".encode()).hexdigest() for index in range(sessions)]
+
+    for label, check in (
+        ('登入', lambda i: license_verifier.verify_hash(db, uuid_hashes[i], FULL_CLIENT_FIELDS, source='bench').valid),
+        ('驗證', lambda i: manager.verify_session_with_user(tokens[i], client_fields())[2] is not None),
+    ):
+        user_cache.clear()
+        manager.session_cache.clear()
+        for index in range(sessions):
+            assert check(index)
+        db.user_reads = 0
+        for index in range(sessions):
+            assert check(index)
+        assert db.user_reads == 0, f"第二次{label}讀取了 {db.user_reads} 次用戶文檔"
+        print(f"第二次{label}（{'設置' if hint_key else '未設置'}提示密鑰）：用戶文檔讀取 0 次")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/auth/validate 讀取路徑延遲')
+    parser.add_argument('--rtt', type=float, default=0.02, help='每次 Firestore 往返秒數')
+    parser.add_argument('--sessions', type=int, default=100, help='會話數（每個會話驗證一次）')
+    args = parser.parse_args()
+    hint_key = secrets.token_hex(32).encode('utf-8')
+
+    print(f"RTT {args.rtt * 1000:.0f} ms，{args.sessions} 個會話，"
+          f"響應欄位 {'完整' if FULL_RESPONSE else '精簡'}\n")
+    for warm in (False, True):
+        label = '熱緩存' if warm else '冷緩存'
+        run(f"原有做法（{label}）", sequential, args.rtt, args.sessions, False, warm)
+        run(f"未設置提示密鑰（{label}）", combined, args.rtt, args.sessions, False, warm)
+        run(f"設置提示密鑰（{label}）", combined, args.rtt, args.sessions, False, warm, hint_key)
+    run('設置提示密鑰（舊令牌，冷緩存）', combined, args.rtt, args.sessions, True, False, hint_key)
+    print()
+    check_user_cache(args.sessions, None)
+    check_user_cache(args.sessions, hint_key)
+
+
+if __name__ == "__main__":
+    main()